@@ -28,8 +28,10 @@ from app.extensions import mail, cache, mdb, uploads
 from app.jobs import init_schedule
 from app.models import User
 from app.mongosupport import MongoSupportJSONEncoder
-from app.tools import SSLSMTPHandler, helpers
+from app.tools import SSLSMTPHandler, QueueSMTPHandler, helpers
 from app.tools.converters import ListConverter, BSONObjectIdConverter
+from app.tools.executor import executor
+from app.tools.httpclient import http
 
 DEFAULT_APP_NAME = 'app'
 
@@ -85,6 +87,8 @@ def configure_extensions(app):
     mail.init_app(app)
     cache.init_app(app)
     mdb.init_app(app)
+    executor.init_app(app)
+    http.init_app(app)
 
 
 def configure_login(app):
@@ -247,10 +251,15 @@ def configure_logging(app):
                    subject,
                    (app.config['MAIL_USERNAME'], app.config['MAIL_PASSWORD'])]
     if app.config['MAIL_USE_SSL']:
-        mail_handler = SSLSMTPHandler(*mail_config)
+        smtp_handler = SSLSMTPHandler(*mail_config)
     else:
-        mail_handler = SMTPHandler(*mail_config)
+        smtp_handler = SMTPHandler(*mail_config)
 
+    # 在后台线程中发送错误邮件, 一段时间内的错误合并成一封摘要邮件, 相同的错误只发送一次
+    mail_handler = QueueSMTPHandler(smtp_handler,
+                                    capacity=app.config.get('ERROR_MAIL_CAPACITY', 50),
+                                    interval=app.config.get('ERROR_MAIL_INTERVAL', 60),
+                                    dedup_window=app.config.get('ERROR_MAIL_DEDUP_WINDOW', 600))
     mail_handler.setLevel(logging.ERROR)
     app.logger.addHandler(mail_handler)
 
@@ -16,6 +16,11 @@ BABEL_DEFAULT_TIMEZONE = 'Asia/Shanghai'
 DEBUG_LOG = 'logs/debug.log'
 ERROR_LOG = 'logs/error.log'
 
+# 错误邮件, 参考app.tools.sslsmtphandler.QueueSMTPHandler
+ERROR_MAIL_CAPACITY = 50
+ERROR_MAIL_INTERVAL = 60
+ERROR_MAIL_DEDUP_WINDOW = 600
+
 ADMINS = ['okosioc@gmail.com']
 
 MAIL_SERVER = 'smtp.flask-boot.com'
@@ -26,8 +31,37 @@ MAIL_USERNAME = 'support@flask-boot.com'
 MAIL_PASSWORD = ''
 MAIL_DEFAULT_SENDER = 'support@flask-boot.com'
 
+# 邮件发送队列, 参考app.tools.mailer.MailDispatcher
+MAIL_QUEUE_SIZE = 1000
+MAIL_QUEUE_TIMEOUT = 5
+MAIL_WORKERS = 2
+MAIL_BATCH_SIZE = 20
+MAIL_MAX_RETRIES = 3
+MAIL_RETRY_BACKOFF = 2
+
+# 后台任务线程池, 参考app.tools.executor.TaskExecutor
+TASK_WORKERS = 4
+TASK_QUEUE_SIZE = 100
+TASK_QUEUE_TIMEOUT = 5
+
+# 共享的http client, 参考app.tools.httpclient.HttpClient
+HTTP_POOL_SIZE = 10
+HTTP_MAX_RETRIES = 5
+HTTP_CONNECT_TIMEOUT = 5
+HTTP_READ_TIMEOUT = 30
+HTTP_CACHE_TTL = 86400
+HTTP_CACHE_MAX_AGE = 30 * 86400
+HTTP_CACHE_MAX_SIZE = 512 * 1024 * 1024
+
+# 博文评论的保存方式, embedded - 保存在博文中, bucket - 分页保存在post_comments中, 切换前请执行python manage.py migrate_comments
+BLOG_COMMENT_STORAGE = 'embedded'
+BLOG_COMMENT_PAGE_SIZE = 50
+
 MONGODB_DATABASE = 'flask-boot'
 MONGODB_HOST = 'localhost'
 MONGODB_PORT = 27017
 MONGODB_USERNAME = None
 MONGODB_PASSWORD = None
+# 查询结果缓存, lru - 进程内的LRU缓存, 其他进程的写入不会使其失效; flask_caching - 使用Flask-Caching的共享缓存
+MONGODB_QUERY_CACHE = 'lru'
+MONGODB_QUERY_CACHE_SIZE = 1000
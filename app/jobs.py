@@ -10,13 +10,19 @@
 """
 
 import os
+import signal
+import socket
 import threading
 import time
+import traceback
 from collections import Counter
+from datetime import datetime, timedelta
 
+import pymongo
 import schedule
+from pymongo import ReturnDocument
 
-from app.models import Post
+from app.models import Post, JobStatus, Job
 
 post_view_times_counter = Counter()
 
@@ -29,13 +35,10 @@ def update_view_times(app):
     d = dict(post_view_times_counter)
     post_view_times_counter.clear()
     for k, v in d.iteritems():
-        p = Post.find_one({'_id': k})
-        if p:
-            try:
-                p.viewTimes += v
-                p.save()
-            except:
-                app.logger.exception('Failed when updating the viewTime for album %s' % p._id)
+        try:
+            Post.update_one({'_id': k}, {'$inc': {'viewTimes': v}})
+        except:
+            app.logger.exception('Failed when updating the viewTime for album %s' % k)
 
 
 def run_schedule(app):
@@ -60,3 +63,154 @@ def init_schedule(app):
         # Python threads don't die when the main thread exits, unless they are daemon threads.
         t.setDaemon(True)
         t.start()
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Durable job queue - 任务保存在MongoDB中, 由manage.py worker启动的独立进程执行
+#
+
+# {name:(handler, lease seconds)}
+job_handlers = {}
+
+
+def job(name, lease=300):
+    """
+    注册任务处理函数, 处理函数的参数为app以及enqueue时指定的参数.
+    执行期间worker每隔lease / 3秒续约一次, 超过lease秒没有续约时, 会被认为worker已经挂掉, 可以被其他worker重新领取.
+    """
+
+    def decorator(f):
+        job_handlers[name] = (f, lease)
+        return f
+
+    return decorator
+
+
+def enqueue(name, priority=0, max_attempts=3, delay=0, **params):
+    """
+    添加一个任务, 参数必须可以被转化为JSON.
+    """
+    j = Job()
+    j.name = unicode(name)
+    j.priority = priority
+    j.maxAttempts = max_attempts
+    j.runAfter = datetime.now() + timedelta(seconds=delay)
+    j.set_params(params)
+    j.save()
+    return j
+
+
+def claim_job(worker, names=None):
+    """
+    原子地领取一个可以执行的任务, 包括等待执行的任务以及租约已经过期的任务.
+    """
+    now = datetime.now()
+    condition = {'$or': [{'status': JobStatus.PENDING, 'runAfter': {'$lte': now}},
+                         {'status': JobStatus.RUNNING, 'leaseExpire': {'$lt': now}}]}
+    condition['name'] = {'$in': names or job_handlers.keys()}
+    # 先按照默认租约领取, 领取后再根据任务设置租约
+    return Job.find_one_and_update(condition,
+                                   {'$set': {'status': JobStatus.RUNNING, 'worker': worker, 'updateTime': now,
+                                             'leaseExpire': now + timedelta(seconds=300)},
+                                    '$inc': {'attempts': 1}},
+                                   sort=[('priority', pymongo.DESCENDING), ('runAfter', pymongo.ASCENDING)],
+                                   return_document=ReturnDocument.AFTER)
+
+
+def _finish_job(j, worker, status, error=None, run_after=None):
+    """
+    只有仍然持有租约的worker才可以更新任务状态.
+    """
+    update = {'status': status, 'updateTime': datetime.now()}
+    if error:
+        update['error'] = error
+    if run_after:
+        update['runAfter'] = run_after
+    Job.update_one({'_id': j._id, 'worker': worker}, {'$set': update})
+
+
+def run_job(app, j, worker):
+    """
+    执行一个已经领取的任务, 失败后按指数退避重试.
+    """
+    handler, lease = job_handlers[j.name]
+    if j.attempts > j.maxAttempts:
+        _finish_job(j, worker, JobStatus.FAILED, u'Lease expired after %s attempts' % j.maxAttempts)
+        return
+
+    _renew_lease(j, worker, lease)
+    done = threading.Event()
+    heartbeat = threading.Thread(target=_heartbeat, args=(app, j, worker, lease, done))
+    heartbeat.setDaemon(True)
+    heartbeat.start()
+    try:
+        with app.app_context():
+            handler(app, **j.get_params())
+    except Exception:
+        app.logger.exception('Failed when running job %s/%s' % (j._id, j.name))
+        error = unicode(traceback.format_exc(), errors='replace')
+        if j.attempts < j.maxAttempts:
+            _finish_job(j, worker, JobStatus.PENDING, error, datetime.now() + timedelta(seconds=30 * 2 ** j.attempts))
+        else:
+            _finish_job(j, worker, JobStatus.FAILED, error)
+    else:
+        _finish_job(j, worker, JobStatus.DONE)
+    finally:
+        done.set()
+        heartbeat.join()
+
+
+def _renew_lease(j, worker, lease):
+    Job.update_one({'_id': j._id, 'worker': worker, 'status': JobStatus.RUNNING},
+                   {'$set': {'leaseExpire': datetime.now() + timedelta(seconds=lease)}})
+
+
+def _heartbeat(app, j, worker, lease, done):
+    """
+    任务执行期间每隔lease / 3秒续约, 避免执行时间超过lease的任务被其他worker重新领取.
+    """
+    while not done.wait(lease / 3.0):
+        try:
+            _renew_lease(j, worker, lease)
+        except Exception:
+            app.logger.exception('Failed when renewing lease of job %s/%s' % (j._id, j.name))
+
+
+def run_worker(app, names=None, concurrency=1, poll=1):
+    """
+    启动worker, 每个线程循环领取并执行任务, 收到SIGTERM/SIGINT后执行完当前任务再退出.
+    """
+    unknown = set(names or []) - set(job_handlers)
+    if unknown:
+        raise ValueError('No handlers registered for jobs %s' % list(unknown))
+
+    stopping = threading.Event()
+
+    def work(i):
+        worker = u'%s-%s-%s' % (socket.gethostname(), os.getpid(), i)
+        while not stopping.is_set():
+            try:
+                j = claim_job(worker, names)
+            except Exception:
+                app.logger.exception('Failed when claiming job')
+                j = None
+            if j:
+                run_job(app, j, worker)
+            else:
+                stopping.wait(poll)
+
+    def stop(signum, frame):
+        app.logger.info('Worker received signal %s, stopping' % signum)
+        stopping.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    app.logger.info('Worker started for jobs %s with concurrency %s' % (names or job_handlers.keys(), concurrency))
+    threads = [threading.Thread(target=work, args=(i,)) for i in range(concurrency)]
+    for t in threads:
+        t.setDaemon(True)
+        t.start()
+    # 主线程需要保持可以接收信号
+    while any(t.is_alive() for t in threads):
+        time.sleep(0.5)
@@ -9,6 +9,7 @@
     :date: 16/6/11
 """
 from user import User
-from blog import Post, Tag
+from blog import Post, Tag, PostComments
 from seo import KeywordLevel, KeywordStatus, Keyword
-from config import Config
\ No newline at end of file
+from config import Config
+from job import JobStatus, Job
@@ -11,6 +11,7 @@
 from datetime import datetime
 
 from bson.objectid import ObjectId
+from pymongo import ReturnDocument
 from werkzeug.utils import cached_property
 
 from app.extensions import mdb
@@ -35,6 +36,11 @@ class Tag(Model):
 @mdb.register
 class Post(Model):
     __collection__ = 'posts'
+    # 站点地图根据变更日志增量更新
+    __changelog__ = True
+    __versioned__ = True
+    # 浏览次数和评论计数器频繁递增, 不需要让正在编辑的博文产生冲突
+    unversioned_fields = ['viewTimes', 'commentCount']
     structure = {
         'uid': ObjectId,
         'pics': [unicode],
@@ -43,6 +49,7 @@ class Post(Model):
         'tids': [ObjectId],  # 相关标签
         'createTime': datetime,
         'viewTimes': int,
+        'commentCount': int,  # 评论计数器, 参考next_comment_id
         'comments': [{
             'id': int,
             'uid': ObjectId,  # 发表评论人
@@ -58,9 +65,29 @@ class Post(Model):
     }
 
     required_fields = ['uid', 'title', 'body', 'tids', 'createTime']
+    # commentCount不设置默认值, 避免加载旧的博文再保存时覆盖为0
     default_values = {'createTime': datetime.now, 'viewTimes': 0}
     indexes = [{'fields': 'tids'}, {'fields': 'createTime'}]
 
+    @classmethod
+    def next_comment_id(cls, post_id):
+        """
+        使用服务器端的计数器分配评论id, 博文不存在时返回None.
+        没有计数器的旧博文, 先根据已有评论的最大id初始化计数器.
+        """
+        while True:
+            post = cls.find_one_and_update({'_id': post_id, 'commentCount': {'$exists': True}},
+                                           {'$inc': {'commentCount': 1}}, {'commentCount': True},
+                                           return_document=ReturnDocument.AFTER)
+            if post:
+                return post.commentCount - 1
+
+            post = cls.find_one({'_id': post_id}, {'comments.id': True})
+            if not post:
+                return None
+            count = max([c['id'] for c in post.get('comments', [])] or [-1]) + 1
+            cls.update_one({'_id': post_id, 'commentCount': {'$exists': False}}, {'$set': {'commentCount': count}})
+
     @cached_property
     def author(self):
         author = User.find_one({'_id': self.uid})
@@ -68,6 +95,34 @@ class Post(Model):
 
     @cached_property
     def tags(self):
-        ids = list(self.tids)
-        tag_dict = {t._id: t for t in Tag.find({'_id': {'$in': ids}})}
-        return [tag_dict[id] for id in ids if id in tag_dict]
+        return Tag.get_many(self.tids)
+
+
+@mdb.register
+class PostComments(Model):
+    """
+    BLOG_COMMENT_STORAGE = 'bucket'时, 评论按id分页保存在此collection中, 每页最多BLOG_COMMENT_PAGE_SIZE条,
+    id为n的评论保存在第n // BLOG_COMMENT_PAGE_SIZE页, 页内新评论在前.
+    """
+    __collection__ = 'post_comments'
+    structure = {
+        'postId': ObjectId,
+        'page': int,
+        'size': int,  # 当前页的评论数
+        'comments': [{
+            'id': int,
+            'uid': ObjectId,
+            'content': unicode,
+            'time': datetime,
+            'replys': [{
+                'uid': ObjectId,
+                'rid': ObjectId,
+                'content': unicode,
+                'time': datetime
+            }]
+        }]
+    }
+
+    required_fields = ['postId', 'page', 'size']
+    default_values = {'size': 0}
+    indexes = [{'fields': ['postId', 'page'], 'unique': True}]
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+    job
+    ~~~~~~~~~~~~~~
+
+    Durable background job.
+
+    :copyright: (c) 2026 by flask-boot contributors.
+    :date: 2026/10/18
+"""
+
+import json
+from datetime import datetime
+
+import pymongo
+
+from app.extensions import mdb
+from app.mongosupport import Model, IN, MongoSupportJSONEncoder
+
+
+class JobStatus(object):
+    """
+    任务状态.
+    """
+    PENDING = u'pending'  # 等待执行
+    RUNNING = u'running'  # 已被某个worker领取, 租约过期后可以被重新领取
+    DONE = u'done'  # 执行成功
+    FAILED = u'failed'  # 超过最大重试次数
+
+
+@mdb.register
+class Job(Model):
+    __collection__ = 'jobs'
+    structure = {
+        'name': unicode,  # 任务名, 对应app.jobs.job注册的处理函数
+        'params': unicode,  # JSON格式的参数
+        'status': IN(JobStatus.PENDING, JobStatus.RUNNING, JobStatus.DONE, JobStatus.FAILED),
+        'priority': int,  # 数字越大越先执行
+        'attempts': int,  # 已经执行的次数
+        'maxAttempts': int,
+        'worker': unicode,  # 领取该任务的worker
+        'leaseExpire': datetime,  # 租约到期时间
+        'runAfter': datetime,  # 在此时间之后才可以执行, 用于延迟执行以及重试退避
+        'error': unicode,  # 最后一次失败的原因
+        'createTime': datetime,
+        'updateTime': datetime,
+    }
+
+    required_fields = ['name', 'params', 'status', 'priority', 'attempts', 'maxAttempts', 'runAfter', 'createTime']
+    default_values = {'params': u'{}', 'status': JobStatus.PENDING, 'priority': 0, 'attempts': 0, 'maxAttempts': 3,
+                      'runAfter': datetime.now, 'createTime': datetime.now}
+    indexes = [
+        {'fields': ['status', ('priority', pymongo.DESCENDING), 'runAfter']},
+        {'fields': ['status', 'leaseExpire']},
+    ]
+
+    def get_params(self):
+        return json.loads(self.params)
+
+    def set_params(self, params):
+        self.params = unicode(json.dumps(params, cls=MongoSupportJSONEncoder))
@@ -42,6 +42,8 @@ class KeywordStatus(object):
 @mdb.register
 class Keyword(Model):
     __collection__ = 'keywords'
+    # 页面编辑与后台分析任务可能同时修改同一个关键词
+    __versioned__ = True
     structure = {
         'name': unicode,
         'level': IN(KeywordLevel.SITE, KeywordLevel.LONG_TAIL),
@@ -55,8 +57,8 @@ class Keyword(Model):
             'title': unicode,
             'body': unicode
         },
-        'processed': int,  # 如果是站点关键词, 表示其下已经处理的长尾词数量
-        'total': int,  # 如果是站点关键词, 表示其下长尾词数量
+        'processed': int,  # 如果是站点关键词, 表示其下已经处理的长尾词数量, 参考counter_caches
+        'total': int,  # 如果是站点关键词, 表示其下长尾词数量, 参考counter_caches
         'refer': unicode,  # 相关链接
         'owner': unicode,  # 负责人
         'remarks': unicode,  # 备注
@@ -70,6 +72,13 @@ class Keyword(Model):
         {'fields': ['level', 'owner', ('baiduIndex', pymongo.DESCENDING)]},
         {'fields': ['parentId', ('baiduIndex', pymongo.DESCENDING)]}
     ]
+    # 长尾关键词增删或者状态变化时, 自动更新其站点关键词的total/processed
+    counter_caches = [
+        {'parent': 'parentId', 'counter': 'total'},
+        {'parent': 'parentId', 'counter': 'processed', 'filter': {'status': KeywordStatus.PROCESSED}},
+    ]
+    # 计数器由长尾关键词维护, 不参与乐观锁
+    unversioned_fields = ['processed', 'total']
 
     @cached_property
     def sons(self):
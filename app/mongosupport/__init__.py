@@ -11,4 +11,5 @@
 
 from flask_mongosupport import MongoSupport, Pagination, populate_model, type_converters, convert_from_string
 from mongosupport import Model, IN, MongoSupportJSONEncoder, connect, MongoSupportError, DataError, StructureError, \
-    ConnectionError
+    ConnectionError, ConflictError, pre_save, post_save, pre_delete, post_delete, pre_bulk_update, post_bulk_update, \
+    changed_paths, Pipeline, Query, QueryCache, set_query_cache
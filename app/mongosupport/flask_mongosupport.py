@@ -13,7 +13,7 @@ import re
 from datetime import datetime
 from math import ceil
 
-from mongosupport import connect, get_db, DATETIME_FORMATS, IN, DotDictProxy, DotListProxy
+from mongosupport import connect, get_db, parse_datetime, IN, DotDictProxy, DotListProxy, QueryCache, set_query_cache
 
 # Find the stack on which we want to store the database connection.
 # Starting with Flask 0.9, the _app_ctx_stack is the correct one,
@@ -62,6 +62,12 @@ class MongoSupport(object):
 
         connect(conn_settings.pop('db'), **conn_settings)
 
+        # 查询结果缓存, 参考Model.cached_find, flask_caching - 使用Flask-Caching的缓存, 需要先初始化Flask-Caching
+        if app.config.get('MONGODB_QUERY_CACHE') == 'flask_caching':
+            set_query_cache(app.extensions['cache'].values()[0])
+        else:
+            set_query_cache(QueryCache(app.config.get('MONGODB_QUERY_CACHE_SIZE', 1000)))
+
         # Register extension with app only to say "I'm here"
         app.extensions = getattr(app, 'extensions', {})
         app.extensions['mongosupport'] = self
@@ -295,7 +301,8 @@ def populate_model(multidict, model_cls, set_default=True):
     """
     d = {}
     valid_paths = model_cls._valid_paths
-    model_prefix = model_cls.__name__.lower() + '.'
+    model_name = model_cls.__name__
+    model_prefix = model_name.lower() + '.'
     for key, value in multidict.iteritems():
         # NOTE: Blank string skipped
         if not value:
@@ -315,9 +322,10 @@ def populate_model(multidict, model_cls, set_default=True):
             try:
                 if isinstance(value, list):  # Value should be instance of list
                     t = valid_paths[path + '.$']
-                    converted_value = [convert_from_string(v, t) for v in value if v]
+                    hint = (model_name, path + '.$')
+                    converted_value = [convert_from_string(v, t, hint) for v in value if v]
                 else:
-                    converted_value = convert_from_string(value, t)
+                    converted_value = convert_from_string(value, t, (model_name, path))
             except ValueError, e:
                 raise ValueError("%s: can not convert %s to %s" % (key, value, t))
         else:
@@ -336,9 +344,10 @@ def _normalized_path(path, list_char='-'):
 class DefaultTypeConverter(object):
     """
     用于将表单的字符串转化为对应类型的值.
+    hint用于标识转化的字段, 如(模型名, 字段路径), 转换器可以据此缓存一些信息.
     """
 
-    def _convert_from_string(self, string_value, type):
+    def _convert_from_string(self, string_value, type, hint=None):
         try:
             return type(string_value)
         except ValueError:
@@ -350,7 +359,7 @@ class BoolConverter(DefaultTypeConverter):
     unicode -> bool
     """
 
-    def _convert_from_string(self, string_value, type):
+    def _convert_from_string(self, string_value, type, hint=None):
         return string_value.strip().lower() in ("yes", "true")
 
 
@@ -359,13 +368,11 @@ class DatetimeConverter(DefaultTypeConverter):
     unicode -> datetime
     """
 
-    def _convert_from_string(self, string_value, type):
-        for fmt in DATETIME_FORMATS:
-            try:
-                return datetime.strptime(string_value, fmt)
-            except ValueError:
-                pass
-        raise ValueError("can not convert %s to %s" % (string_value, type.__name__))
+    def _convert_from_string(self, string_value, type, hint=None):
+        try:
+            return parse_datetime(string_value, hint)
+        except ValueError:
+            raise ValueError("can not convert %s to %s" % (string_value, type.__name__))
 
 
 type_converters = {
@@ -375,7 +382,7 @@ type_converters = {
 }
 
 
-def convert_from_string(string_value, t):
+def convert_from_string(string_value, t, hint=None):
     if isinstance(string_value, t):
         return string_value
 
@@ -383,4 +390,4 @@ def convert_from_string(string_value, t):
         converter = type_converters[t]
     else:
         converter = type_converters[None]
-    return converter._convert_from_string(string_value, t)
+    return converter._convert_from_string(string_value, t, hint)
@@ -9,16 +9,33 @@
     :date: 16/5/25
 """
 
+import calendar
+import importlib
 import json
+import os
 import re
-from collections import MutableSequence, MutableMapping
+import threading
+import time
+from collections import MutableSequence, MutableMapping, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from copy import deepcopy
-from datetime import datetime
+from datetime import datetime, timedelta
+from types import FunctionType
 
 import pymongo
+from blinker import Namespace
+from bson import BSON, json_util
 from bson.objectid import ObjectId
-from pymongo import MongoClient, ReadPreference, uri_parser, WriteConcern
+from bson.son import SON
+from pymongo import MongoClient, ReadPreference, ReturnDocument, uri_parser, WriteConcern
 from pymongo.cursor import Cursor as PyMongoCursor
+from pymongo.errors import AutoReconnect, CursorNotFound
+from pymongo.results import UpdateResult, DeleteResult
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 
 # ----------------------------------------------------------------------------------------------------------------------
@@ -100,6 +117,37 @@ class OR(SchemaOperator):
 DATETIME_FORMATS = ['%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S.%fZ', '%Y:%m:%d %H:%M:%S',
                     '%Y-%m-%d']
 
+# 与DATETIME_FORMATS一一对应的正则, 只匹配补零后的定长格式, 其他写法(如2016-5-3)交给strptime处理
+_DATETIME_PATTERNS = [
+    re.compile(r'(\d{4})-(\d{2})-(\d{2}) (\d{2}):(\d{2}):(\d{2})\Z'),
+    re.compile(r'(\d{4})-(\d{2})-(\d{2}) (\d{2}):(\d{2}):(\d{2})\.(\d{1,6})\Z'),
+    re.compile(r'(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})\.(\d{1,6})Z\Z'),
+    re.compile(r'(\d{4}):(\d{2}):(\d{2}) (\d{2}):(\d{2}):(\d{2})\Z'),
+    re.compile(r'(\d{4})-(\d{2})-(\d{2})\Z'),
+]
+
+# {hint:index of DATETIME_FORMATS}, 记录某个字段上次匹配的格式
+_datetime_format_hints = {}
+
+# 变更日志, 参考Model.__changelog__
+CHANGELOG_COLLECTION = 'changes'
+# 变更日志保留的秒数, 超过后由mongodb的TTL索引自动删除
+CHANGELOG_TTL = 30 * 24 * 3600
+
+# 记录物化聚合结果的刷新时间, 参考Pipeline.materialize
+MATERIALIZED_COLLECTION = 'materialized'
+
+# iterate遇到游标失效或者网络错误时的最大连续重试次数, 以及第n次重试前等待的秒数为n * ITERATE_RETRY_DELAY
+ITERATE_RETRIES = 5
+ITERATE_RETRY_DELAY = 1
+
+# parallel_scan为每个区间采样的_id数量, 采样越多区间大小越均匀
+SCAN_SAMPLES = 20
+
+# get_many每次$in查询的id数量, 以及并发查询的线程数
+GET_MANY_CHUNK_SIZE = 1000
+GET_MANY_WORKERS = 4
+
 # 字段允许使用的类型
 # https://api.mongodb.com/python/current/api/bson/son.html
 AUTHORIZED_TYPES = [
@@ -115,11 +163,90 @@ AUTHORIZED_TYPES = [
     ObjectId,
 ]
 
+# 可以使用$inc/$mul更新的类型
+NUMBER_TYPES = (int, long, float)
+
+# 更新操作中表示数组元素的路径片段, 如comments.0.content, comments.$.content, comments.$[c].content
+_ARRAY_TOKEN = re.compile(r'(?<=\.)(\d+|\$|\$\[\w*\])(?=\.|\Z)')
+
 
 # ----------------------------------------------------------------------------------------------------------------------
 # Conversions
 #
 
+def _guess_datetime_format(value):
+    """
+    根据长度和分隔符猜测日期格式.
+    """
+    n = len(value)
+    if n == 10:
+        return 4
+    if n == 19:
+        return 3 if value[4:5] == ':' else 0
+    if value[10:11] == 'T':
+        return 2
+    return 1
+
+
+def _match_datetime(value, index):
+    m = _DATETIME_PATTERNS[index].match(value)
+    if not m:
+        return None
+    g = m.groups()
+    if len(g) == 3:
+        return datetime(int(g[0]), int(g[1]), int(g[2]))
+    microsecond = int(g[6].ljust(6, '0')) if len(g) == 7 else 0
+    return datetime(int(g[0]), int(g[1]), int(g[2]), int(g[3]), int(g[4]), int(g[5]), microsecond)
+
+
+def parse_datetime(value, hint=None):
+    """
+    将字符串转化为datetime, 支持DATETIME_FORMATS中定义的所有格式.
+    优先尝试hint(如模型名+字段路径)上次匹配的格式, 然后按长度和分隔符猜测格式, 都不匹配时再逐个尝试strptime.
+    """
+    last = _datetime_format_hints.get(hint) if hint is not None else None
+    if last is not None:
+        dt = _match_datetime(value, last)
+        if dt is not None:
+            return dt
+
+    guessed = _guess_datetime_format(value)
+    if guessed != last:
+        dt = _match_datetime(value, guessed)
+        if dt is not None:
+            if hint is not None:
+                _datetime_format_hints[hint] = guessed
+            return dt
+
+    for i, fmt in enumerate(DATETIME_FORMATS):
+        try:
+            dt = datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+        if hint is not None:
+            _datetime_format_hints[hint] = i
+        return dt
+
+    raise ValueError("can not convert %s to datetime" % value)
+
+
+# 查询条件中可以使用的兼容类型, 如float字段可以使用int比较
+_COMPATIBLE_TYPES = {int: (int, long), long: (int, long), float: (int, long, float), unicode: basestring}
+
+
+def check_value(value, t):
+    """
+    校验查询条件中的值是否为字段类型, 不做任何转换, 请求参数等字符串需要先通过convert_from_string转化.
+    """
+    if value is None or t is None:
+        return value
+    for x in (t if isinstance(t, tuple) else (t,)):
+        # bool是int的子类
+        if isinstance(value, _COMPATIBLE_TYPES.get(x, x)) and (x is bool or not isinstance(value, bool)):
+            return value
+    raise ValueError("%r is not an instance of %s" % (value, t))
+
+
 class MongoSupportJSONEncoder(json.JSONEncoder):
     def default(self, o):
         if isinstance(o, ObjectId):
@@ -159,6 +286,206 @@ class ConnectionError(MongoSupportError):
     pass
 
 
+class ConflictError(MongoSupportError):
+    """
+    __versioned__的数据模型保存时, 文档已经被其他请求修改, 可以reload之后重试.
+    """
+    pass
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Signals - 可以用于缓存失效/冗余字段维护等, 没有接收者时不会构建信号参数
+#
+
+_signals = Namespace()
+
+# sender为数据模型类, 参数document/created, save替换整个文档, 无法得知修改了哪些字段
+pre_save = _signals.signal('pre-save')
+post_save = _signals.signal('post-save')
+# sender为数据模型类, 参数document
+pre_delete = _signals.signal('pre-delete')
+post_delete = _signals.signal('post-delete')
+# sender为数据模型类, 由类方法update_one/update_many/replace_one/find_one_and_update触发,
+# 参数filter/update/changed/many, post_bulk_update另外传入result, changed为更新操作涉及的字段路径
+# bulk_write中的多个操作不触发信号
+pre_bulk_update = _signals.signal('pre-bulk-update')
+post_bulk_update = _signals.signal('post-bulk-update')
+
+
+def changed_paths(update):
+    """
+    返回更新操作涉及的字段路径, 如{'$set': {'a.b': 1}, '$inc': {'c': 1}}返回['a.b', 'c'], 替换文档时返回所有的顶层字段.
+    """
+    if not any(k.startswith('$') for k in update):
+        return sorted(update)
+
+    paths = set()
+    for op, fields in update.iteritems():
+        paths.update(fields)
+        if op == '$rename':
+            paths.update(fields.itervalues())
+    return sorted(paths)
+
+
+def _match_filter(doc, filter):
+    """
+    判断文档是否满足简单的过滤条件, 只支持顶层字段的等于和$in.
+    """
+    for k, v in (filter or {}).iteritems():
+        if isinstance(v, dict) and '$in' in v:
+            if doc.get(k) not in v['$in']:
+                return False
+        elif doc.get(k) != v:
+            return False
+    return True
+
+
+def _filter_expr(filter):
+    """
+    将简单的过滤条件转化为聚合表达式.
+    """
+    exprs = []
+    for k, v in (filter or {}).iteritems():
+        if isinstance(v, dict) and '$in' in v:
+            exprs.append({'$in': ['$' + k, v['$in']]})
+        else:
+            exprs.append({'$eq': ['$' + k, v]})
+    return {'$and': exprs} if exprs else True
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Query - 查询条件构建器, 根据数据结构转换和校验查询条件中的值
+#
+
+def filter_key(filter):
+    """
+    返回查询条件的规范化表示, 字段按名字排序, 可以作为计数或者查询结果的缓存键.
+    """
+    return json_util.dumps(filter, sort_keys=True)
+
+
+class Query(dict):
+    """
+    查询条件, 本身就是一个dict, 可以直接传给find/count等方法, 使用&和|组合, 如:
+    query = (Keyword.q.level == 1) & Keyword.q.status.in_([u'bare', u'processed'])
+    Keyword.find(query)
+    注意&和|的优先级高于比较运算符, 需要加上括号.
+    """
+
+    __hash__ = None
+
+    def __and__(self, other):
+        merged = Query(self)
+        for k, v in other.iteritems():
+            if k not in merged:
+                merged[k] = v
+            elif k == '$and':
+                merged[k] = merged[k] + v
+            elif _is_operators(merged[k]) and _is_operators(v) and not set(merged[k]).intersection(v):
+                merged[k] = dict(merged[k], **v)
+            else:
+                # 同一个字段的条件无法合并
+                return Query({'$and': [dict(self), dict(other)]})
+        return merged
+
+    def __or__(self, other):
+        if not self or not other:
+            return Query()
+        return Query({'$or': _or_operands(self) + _or_operands(other)})
+
+    @property
+    def key(self):
+        return filter_key(self)
+
+
+def _is_operators(value):
+    return isinstance(value, dict) and value and all(k.startswith('$') for k in value)
+
+
+def _or_operands(query):
+    return list(query['$or']) if query.keys() == ['$or'] else [dict(query)]
+
+
+class QueryField(object):
+    """
+    查询条件中的字段, 通过Model.q.<field>或者Model.q['<path>']获取, 数组可以省略$, 如Post.q.comments.uid.
+    """
+
+    __slots__ = ('_model', '_path')
+    __hash__ = None
+
+    def __init__(self, model, path):
+        self._model = model
+        self._path = path
+
+    def __getattr__(self, key):
+        if key.startswith('__'):
+            raise AttributeError(key)
+        return self[key]
+
+    def __getitem__(self, path):
+        return QueryField(self._model, path if not self._path else '%s.%s' % (self._path, path))
+
+    def _condition(self, op, value, many=False):
+        model = self._model
+        valid = model._check_path(self._path)
+        t = model._valid_paths.get(valid)
+        if isinstance(t, list):
+            t = model._valid_paths.get(valid + '.$')
+        elif isinstance(t, dict):
+            t = None
+        try:
+            value = [check_value(v, t) for v in value] if many else check_value(value, t)
+        except ValueError, e:
+            raise DataError("%s: %s" % (self._path, e))
+        # 查询时不需要$
+        path = '.'.join(k for k in self._path.split('.') if k != '$')
+        return Query({path: value if op is None else {op: value}})
+
+    def __eq__(self, value):
+        return self._condition(None, value)
+
+    def __ne__(self, value):
+        return self._condition('$ne', value)
+
+    def __lt__(self, value):
+        return self._condition('$lt', value)
+
+    def __le__(self, value):
+        return self._condition('$lte', value)
+
+    def __gt__(self, value):
+        return self._condition('$gt', value)
+
+    def __ge__(self, value):
+        return self._condition('$gte', value)
+
+    def in_(self, values):
+        return self._condition('$in', self._operands(values), True)
+
+    def nin_(self, values):
+        return self._condition('$nin', self._operands(values), True)
+
+    def _operands(self, values):
+        # 字符串和dict也可以迭代, 但不是合法的操作数
+        if not isinstance(values, (list, tuple, set, frozenset)):
+            raise DataError("%s: %r is not a list" % (self._path, values))
+        return list(values)
+
+    def exists(self, exists=True):
+        self._model._check_path(self._path)
+        return Query({'.'.join(k for k in self._path.split('.') if k != '$'): {'$exists': exists}})
+
+
+class QueryDescriptor(object):
+    """
+    Model.q, 返回查询条件的根字段.
+    """
+
+    def __get__(self, instance, owner):
+        return QueryField(owner, '')
+
+
 # ----------------------------------------------------------------------------------------------------------------------
 # Metaclass
 #
@@ -173,21 +500,25 @@ class ModelMetaclass(type):
             return type.__new__(mcs, name, bases, attrs)
 
         # 保护字段, 使用dot notation的方式访问数据的时候, 跳过这些保护字段
-        attrs['_protected_field_names'] = {'_protected_field_names', '_valid_paths', 'validation_errors'}
+        protected = {'_protected_field_names', '_valid_paths', 'validation_errors', '_proxies'}
         # 父类及其父类的所有类属性
         for mro in bases[0].__mro__:
-            attrs['_protected_field_names'] = attrs['_protected_field_names'].union(set(mro.__dict__))
-        attrs['_protected_field_names'] = list(attrs['_protected_field_names'])
+            protected.update(k for k, v in mro.__dict__.iteritems() if not isinstance(v, FieldDescriptor))
+        attrs['_protected_field_names'] = frozenset(protected)
 
         # 添加保留字段
         if '_id' not in attrs['structure']:
             attrs['structure']['_id'] = ObjectId
+        if attrs.get('__versioned__', getattr(bases[0], '__versioned__', False)) and '_v' not in attrs['structure']:
+            attrs['structure']['_v'] = int
 
         # 验证数据结构
         attrs['_valid_paths'] = {}
         mcs._validate_structure(name, attrs)
         attrs['_valid_paths'] = {k.replace(name + '.', ''): v for k, v in attrs['_valid_paths'].iteritems() if
                                  not k == name}
+        # 路径对应的结构定义, 用于校验更新操作, 参考Model._get_struct
+        attrs['_path_structs'] = mcs._build_path_structs(attrs['structure'])
 
         '''
         print "Init model class %s with valid paths {" % name
@@ -202,6 +533,15 @@ class ModelMetaclass(type):
         # 验证其他描述符, 如必填/验证器/默认值/索引等
         mcs._validate_descriptors(name, attrs)
 
+        # 预先计算默认值的设置步骤
+        mcs._build_default_plan(attrs, attrs.get('default_values', getattr(bases[0], 'default_values', {})))
+
+        # 为每个顶层字段生成描述符, 支持dot notation的方式访问, 跳过类中已经定义的同名属性
+        if attrs.get('use_dot_notation', getattr(bases[0], 'use_dot_notation', True)):
+            for key, struct in attrs['structure'].iteritems():
+                if key not in attrs:
+                    attrs[key] = FieldDescriptor(key, struct)
+
         return type.__new__(mcs, name, bases, attrs)
 
     @classmethod
@@ -292,6 +632,55 @@ class ModelMetaclass(type):
                 return True
         return False
 
+    @classmethod
+    def _build_path_structs(mcs, struct, path=None, paths=None):
+        """
+        返回{路径:结构定义}, 数组元素使用$表示, 与_valid_paths的路径一致.
+        """
+        paths = {} if paths is None else paths
+        if path is not None:
+            paths[path] = struct
+        if isinstance(struct, dict):
+            for key in struct:
+                mcs._build_path_structs(struct[key], key if path is None else '%s.%s' % (path, key), paths)
+        elif isinstance(struct, list):
+            mcs._build_path_structs(struct[0], '%s.$' % path, paths)
+        return paths
+
+    @classmethod
+    def _build_default_plan(mcs, attrs, default_values):
+        """
+        将default_values转换为按结构顺序排列的步骤(parents, key, factory, value), 设置默认值时只需要顺序执行,
+        parents为需要逐层进入的字典字段, factory不为空时调用factory生成默认值, 否则直接使用value.
+        default_values与类属性一致, 没有定义时使用父类的default_values.
+        """
+        plan = []
+
+        def __build(struct, parents):
+            for key in struct:
+                path = '.'.join(parents + (key,))
+                if path in default_values:
+                    value = default_values[path]
+                    factory = None
+                    if isinstance(struct[key], SchemaOperator):
+                        pass
+                    elif callable(value):
+                        factory = value
+                    elif isinstance(struct[key], dict) and isinstance(value, dict):
+                        factory = lambda v=value: deepcopy(v)
+                    elif isinstance(struct[key], list) and isinstance(value, list):
+                        factory = lambda v=value: v[:]
+                    plan.append((parents, key, factory, value))
+                # 递归处理字典字段, 无需进入列表内部, 因为无法初始化列表的元素个数
+                if isinstance(struct[key], dict) and [i for i in default_values if i.startswith(path + '.')]:
+                    __build(struct[key], parents + (key,))
+
+        __build(attrs['structure'], ())
+        attrs['_default_plan'] = tuple(plan)
+        # 存在嵌套字段的默认值时, 顶层字段存在也不能跳过
+        nested = any(step[0] for step in plan)
+        attrs['_default_roots'] = None if nested else frozenset(step[1] for step in plan)
+
     @classmethod
     def _validate_descriptors(mcs, name, attrs):
         """
@@ -323,6 +712,13 @@ class ModelMetaclass(type):
                     "%s: Error in validators: can't set validators to %s which is a nested structure in list" %
                     (name, v))
 
+        for cc in attrs.get('counter_caches', []):
+            if 'parent' not in cc or 'counter' not in cc:
+                raise StructureError("%s: 'parent' and 'counter' must be specified in counter_caches" % name)
+            for path in [cc['parent']] + list(cc.get('filter', {})) + ([] if 'model' in cc else [cc['counter']]):
+                if path not in valid_paths:
+                    raise StructureError("%s: Error in counter_caches: can't find %s in structure" % (name, path))
+
         # required_fields
         if attrs.get('required_fields'):
             if len(attrs['required_fields']) != len(set(attrs['required_fields'])):
@@ -415,6 +811,10 @@ class Model(dict):
 
     # 字段默认值
     default_values = {}
+    # 由元类根据default_values生成, 参考ModelMetaclass._build_default_plan
+    _default_plan = ()
+    # 设置了默认值的顶层字段, 从数据库加载的文档包含所有这些字段时不再设置默认值, 存在嵌套字段的默认值时为None
+    _default_roots = frozenset()
 
     # 验证器
     validators = {}
@@ -444,6 +844,34 @@ class Model(dict):
     # 当前正在访问的数据库别名, 如果为空, 相当于DEFAULT_CONNECTION_NAME
     db_alias = None
 
+    # 是否记录变更日志, 开启后通过save插入以及通过delete删除的文档会记录在CHANGELOG_COLLECTION中,
+    # 格式为{coll:collection名字, op:insert/delete, docId:文档_id, time:记录时间}, 变更日志的_id可以作为读取进度
+    # 注意类方法insert_one/delete_one等直接调用pymongo, 不会记录变更日志
+    __changelog__ = False
+
+    # 计数缓存, 通过save/delete插入/修改/删除文档时, 自动更新父文档上的计数器, 如:
+    # counter_caches = [{'parent': 'parentId', 'counter': 'total'},
+    #                   {'parent': 'parentId', 'counter': 'processed', 'filter': {'status': 'processed'}}]
+    # parent为保存父文档_id的字段, filter为计数条件, 只支持等于和$in, 父文档为其他数据模型时使用model指定;
+    # 注意update_one等类方法不会维护计数器, 可以使用repair_counters重新计算
+    counter_caches = []
+
+    # 是否开启乐观锁, 开启后会在数据结构中添加版本号字段_v,
+    # save时只有数据库中的版本号与当前版本号一致才会保存成功, 否则触发ConflictError, 可以reload之后重试;
+    # 通过update_one/update_many/find_one_and_update/push更新时也会递增版本号
+    __versioned__ = False
+
+    # 不参与乐观锁的顶层字段, 如浏览次数/评论计数器等, 只修改这些字段的更新不会递增版本号;
+    # 开启__versioned__时save不会覆盖这些字段, 保存后文档中的值可能与数据库不一致
+    unversioned_fields = []
+
+    # 查询条件构建器, 参考Query
+    q = QueryDescriptor()
+
+    # 是否校验insert_one/insert_many/replace_one/update_one/update_many, 也可以在调用时通过validate=True/False指定;
+    # 插入和替换时校验整个文档, 更新时根据数据结构校验更新操作中的字段路径以及$set/$inc/$push/$addToSet的值
+    validate_updates = False
+
     def __init__(self, doc=None, set_default=True):
         """
         :param doc: a dict
@@ -454,11 +882,60 @@ class Model(dict):
         self.validation_errors = {}
 
         if doc is not None:
-            for k, v in doc.iteritems():
-                self[k] = v
+            self.update(doc)
+
+        if set_default and self._default_plan:
+            self._set_default_values()
+
+    @classmethod
+    def _from_db(cls, doc):
+        """
+        使用数据库中读取的文档生成对象, 使用projection时才可能缺少设置了默认值的字段.
+        """
+        roots = cls._default_roots
+        return cls(doc, roots is None or not roots.issubset(doc))
+
+    def __reduce__(self):
+        """
+        pickle时只保存类路径/格式版本/原始文档, 不保存validation_errors以及缓存的代理对象.
+        """
+        return _rebuild_model, (_model_path(self.__class__), SERIALIZATION_VERSION, dict(self))
 
-        if set_default and self.default_values:
-            self._set_default_values(self, self.structure)
+    def __copy__(self):
+        # copy/deepcopy直接使用当前类, 不需要通过类路径导入, 函数内定义的数据模型也可以复制
+        return self.__class__(dict(self), set_default=False)
+
+    def __deepcopy__(self, memo):
+        copied = self.__class__(set_default=False)
+        memo[id(self)] = copied
+        copied.update(deepcopy(dict(self), memo))
+        return copied
+
+    def to_bytes(self, format='bson'):
+        """
+        序列化为{c:类路径, v:格式版本, d:原始文档}, 可以用于缓存或者在进程之间传递.
+
+        :param format: bson或者msgpack, msgpack需要另外安装, 只支持ObjectId/datetime以及msgpack本身支持的类型
+        """
+        data = {'c': _model_path(self.__class__), 'v': SERIALIZATION_VERSION, 'd': dict(self)}
+        if format == 'bson':
+            return BSON.encode(data)
+        if format == 'msgpack':
+            return _msgpack().packb(data, default=_msgpack_default, use_bin_type=True)
+        raise ValueError("format must be bson or msgpack not %s" % format)
+
+    @classmethod
+    def from_bytes(cls, data, format='bson'):
+        """
+        反序列化to_bytes的结果, 返回的对象为序列化时的数据模型, 必须是cls或者cls的子类.
+        """
+        if format == 'bson':
+            data = BSON(data).decode()
+        elif format == 'msgpack':
+            data = _msgpack().unpackb(data, ext_hook=_msgpack_ext_hook, raw=False)
+        else:
+            raise ValueError("format must be bson or msgpack not %s" % format)
+        return _rebuild_model(data['c'], data['v'], data['d'], cls)
 
     def __str__(self):
         """
@@ -594,85 +1071,19 @@ class Model(dict):
 
         return vals
 
-    def _set_default_values(self, doc, struct, path=""):
-        """
-        设置字段的默认值.
-        """
-        for key in struct:
-            new_path = ("%s.%s" % (path, key)).strip('.')
-            # print "setting default value for %s with type %s" % (new_path, struct[key])
-            # type
-            if type(struct[key]) is type:
-                if new_path in self.default_values and key not in doc:
-                    new_value = self.default_values[new_path]
-                    if callable(new_value):
-                        new_value = new_value()
-                    doc[key] = new_value
-            # {}
-            if isinstance(struct[key], dict):
-                # 设置整个字典字段的默认值
-                if new_path in self.default_values and key not in doc:
-                    new_value = self.default_values[new_path]
-                    if callable(new_value):
-                        new_value = new_value()
-                    elif isinstance(new_value, dict):
-                        new_value = deepcopy(new_value)
-                    doc[key] = new_value
-                # 递归处理字典字段
-                if [i for i in self.default_values if i.startswith("%s." % new_path)]:
-                    if key not in doc or doc[key] is None:
-                        doc[key] = {}
-                    self._set_default_values(doc[key], struct[key], new_path)
-            # []
-            if isinstance(struct[key], list):
-                # 设置整个列表字段的默认值
-                # 无需再递归进列表内部设置默认值, 因为无法初始化列表的元素个数
-                if new_path in self.default_values and key not in doc:
-                    new_value = self.default_values[new_path]
-                    if callable(new_value):
-                        new_value = new_value()
-                    elif isinstance(new_value, list):
-                        new_value = new_value[:]
-                    doc[key] = new_value
-            # SchemaOperator
-            if isinstance(struct[key], SchemaOperator):
-                if new_path in self.default_values and key not in doc:
-                    new_value = self.default_values[new_path]
-                    doc[key] = new_value
-
-    def __setattr__(self, key, value):
+    def _set_default_values(self):
         """
-        Support dot notation.
+        设置字段的默认值, 已经存在的字段保持不变.
         """
-        if self.use_dot_notation and key not in self._protected_field_names and key in self.structure:
-            # print "setting attr %s with %s" % (key, value)
-            if isinstance(value, (DotDictProxy, DotListProxy)):
-                self[key] = value._obj_
-            else:
-                self[key] = value
-        else:
-            dict.__setattr__(self, key, value)
-
-    def __getattr__(self, key):
-        """
-        Support dot notation.
-        """
-        if self.use_dot_notation and key not in self._protected_field_names and key in self.structure:
-            s = self.structure[key]
-            found = self.get(key, None)
-            # print "getting attr %s for structure %s with value %s" % (key, s, type(found))
-            if found is None:
-                if isinstance(s, dict):
-                    found = {}
-                elif isinstance(s, list):
-                    found = []
-                else:
-                    found = None
-                self[key] = found
-
-            return proxywrapper(found, s)
-        else:
-            return dict.__getattribute__(self, key)
+        for parents, key, factory, value in self._default_plan:
+            doc = self
+            for p in parents:
+                sub = doc.get(p)
+                if sub is None:
+                    sub = doc[p] = {}
+                doc = sub
+            if key not in doc:
+                doc[key] = factory() if factory else value
 
     #
     #
@@ -731,27 +1142,55 @@ class Model(dict):
     @classmethod
     def insert_one(cls, doc, *args, **kwargs):
         """
-        Please note we do not apply validation here.
+        Please note we do not apply validation here, unless validate_updates or validate=True.
         """
+        if kwargs.pop('validate', cls.validate_updates):
+            cls._validate_document(doc)
         collection = cls.get_collection(**kwargs)
         # InsertOneResult
-        return collection.insert_one(doc, *args, **kwargs)
+        result = collection.insert_one(doc, *args, **kwargs)
+        cls._touch()
+        return result
 
     @classmethod
     def insert_many(cls, docs, *args, **kwargs):
         """
-        Please note we do not apply validation here.
+        Please note we do not apply validation here, unless validate_updates or validate=True.
         """
+        if kwargs.pop('validate', cls.validate_updates):
+            docs = list(docs)
+            for doc in docs:
+                cls._validate_document(doc)
         collection = cls.get_collection(**kwargs)
         # InsertManyResult
-        return collection.insert_many(docs, *args, **kwargs)
+        result = collection.insert_many(docs, *args, **kwargs)
+        cls._touch()
+        return result
 
     @classmethod
     def find_one(cls, filter_or_id=None, *args, **kwargs):
         collection = cls.get_collection(**kwargs)
         doc = collection.find_one(filter_or_id, *args, **kwargs)
         if doc:
-            return cls(doc)
+            return cls._from_db(doc)
+        else:
+            return None
+
+    @classmethod
+    def find_one_and_update(cls, filter, update, *args, **kwargs):
+        """
+        原子地查找并更新一条记录, 可以用于实现计数器/任务队列等, 参数可以参考:
+        https://api.mongodb.com/python/current/api/pymongo/collection.html#pymongo.collection.Collection.find_one_and_update
+        Please note we do not apply validation here.
+        """
+        collection = cls.get_collection(**kwargs)
+        update = cls._inc_version(update)
+        cls._send_bulk_update(pre_bulk_update, filter, update, False)
+        doc = collection.find_one_and_update(filter, update, *args, **kwargs)
+        cls._touch()
+        cls._send_bulk_update(post_bulk_update, filter, update, False, result=doc)
+        if doc:
+            return cls._from_db(doc)
         else:
             return None
 
@@ -764,6 +1203,102 @@ class Model(dict):
         collection = cls.get_collection(**kwargs)
         return ModelCursor(cls, collection, *args, **kwargs)
 
+    @classmethod
+    def iterate(cls, filter=None, batch_size=1000, projection=None, resume_after_id=None, progress=None, **kwargs):
+        """
+        按_id升序遍历所有满足条件的文档, 每次从服务器读取batch_size条, 适合遍历整个collection的离线任务.
+        游标失效(CursorNotFound)或者网络错误(AutoReconnect)时, 从最后读取的_id之后重新查询.
+
+        :param resume_after_id: 从该_id之后开始遍历, 可以用于中断后继续执行
+        :param progress: 每读取batch_size条调用一次progress(count, last_id)
+        """
+        last = resume_after_id
+        count = 0
+        failures = 0
+        while True:
+            condition = filter or {}
+            if last is not None:
+                after = {'_id': {'$gt': last}}
+                condition = dict(condition, **after) if '_id' not in condition else {'$and': [condition, after]}
+            cursor = cls.find(condition, projection, sort=[('_id', pymongo.ASCENDING)], batch_size=batch_size,
+                              **kwargs)
+            try:
+                for doc in cursor:
+                    last = doc['_id']
+                    count += 1
+                    failures = 0
+                    if progress and count % batch_size == 0:
+                        progress(count, last)
+                    yield doc
+                break
+            except (CursorNotFound, AutoReconnect):
+                failures += 1
+                if failures > ITERATE_RETRIES:
+                    raise
+                time.sleep(failures * ITERATE_RETRY_DELAY)
+            finally:
+                cursor.close()
+        if progress and count % batch_size:
+            progress(count, last)
+
+    @classmethod
+    def parallel_scan(cls, n, fn, reducer=None, initial=None, filter=None, projection=None, processes=False,
+                      checkpoint=None, batch_size=1000):
+        """
+        按_id把满足条件的文档分成最多n个区间, 在线程池(processes=True时为进程池)中为每个区间创建单独的游标,
+        调用fn(区间内文档的迭代器)处理. 返回按区间顺序排列的结果列表, 指定reducer时返回reduce(reducer, results, initial).
+
+        :param processes: 使用进程池时fn必须是模块级别的函数, 返回值也必须可以pickle
+        :param checkpoint: checkpoint文件路径, 记录区间边界以及已经完成的区间的结果(json_util格式),
+                           重新执行时只处理未完成的区间
+        """
+        state = _load_scan_checkpoint(checkpoint) if checkpoint else None
+        if state is None:
+            state = {'boundaries': cls._scan_boundaries(n, filter), 'results': {}}
+        boundaries = state['boundaries']
+        ranges = zip([None] + boundaries, boundaries + [None])
+        # json中的key只能是字符串
+        results = state['results']
+
+        pending = [i for i in range(len(ranges)) if str(i) not in results]
+        error = None
+        if pending:
+            executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+            with executor(min(n, len(pending))) as pool:
+                futures = {pool.submit(_scan_range, cls, ranges[i][0], ranges[i][1], fn, filter, projection,
+                                       batch_size): i for i in pending}
+                for f in as_completed(futures):
+                    e, tb = f.exception_info()
+                    if e is not None:
+                        # 等待其他区间完成并记录结果, 最后再抛出异常, 保留worker中的traceback
+                        error = error or (type(e), e, tb)
+                        continue
+                    results[str(futures[f])] = f.result()
+                    if checkpoint:
+                        _save_scan_checkpoint(checkpoint, state)
+        if error:
+            raise error[0], error[1], error[2]
+
+        results = [results[str(i)] for i in range(len(ranges))]
+        if reducer is None:
+            return results
+        return reduce(reducer, results) if initial is None else reduce(reducer, results, initial)
+
+    @classmethod
+    def _scan_boundaries(cls, n, filter=None):
+        """
+        使用$sample采样n * SCAN_SAMPLES个_id, 取分位点作为区间边界, 返回升序且不重复的最多n - 1个_id.
+        """
+        if n <= 1:
+            return []
+        pipeline = [{'$match': filter or {}}, {'$sample': {'size': n * SCAN_SAMPLES}}, {'$project': {'_id': True}}]
+        ids = sorted(d['_id'] for d in cls.aggregate(pipeline))
+        boundaries = []
+        for i in range(1, n):
+            if ids and (not boundaries or ids[len(ids) * i // n] > boundaries[-1]):
+                boundaries.append(ids[len(ids) * i // n])
+        return boundaries
+
     @classmethod
     def find_by_ids(cls, ids, *args, **kwargs):
         """
@@ -773,56 +1308,210 @@ class Model(dict):
         if 'filter' in kwargs:
             filter.update(kwargs.pop('filter'))
         elif len(args) > 0:
-            filter.update(args.pop(0))
+            filter.update(args[0])
+            args = args[1:]
         filter.update({'_id': {'$in': ids}})
 
-        records = list(cls.find(filter, *args, **kwargs))
-        records.sort(key=lambda i: ids.index(i._id))
-        return records
+        records = {r._id: r for r in cls.find(filter, *args, **kwargs)}
+        return [records[id] for id in ids if id in records]
+
+    @classmethod
+    def get_many(cls, ids, missing='skip', projection=None, cache=None, chunk_size=GET_MANY_CHUNK_SIZE, **kwargs):
+        """
+        根据多个id批量获取文档, 返回结果与ids的顺序一致, 重复的id只查询一次.
+        id数量超过chunk_size时拆分成多个$in查询, 在线程池中并发执行.
+
+        :param missing: 文档不存在时的处理方式, skip - 跳过, none - 返回None, raise - 触发DataError
+        :param cache: 可选的dict-like对象{id:文档}, 先从中读取, 查询到的文档也会写入其中; 注意使用projection时不要混用
+        """
+        if missing not in ('skip', 'none', 'raise'):
+            raise ValueError("missing must be skip, none or raise not %s" % missing)
+
+        found = {}
+        pending = []
+        for id in ids:
+            if id in found:
+                continue
+            doc = cache.get(id) if cache is not None else None
+            if doc is not None:
+                found[id] = doc
+            else:
+                # 占位, 同时用于去重
+                found[id] = None
+                pending.append(id)
+
+        def fetch(chunk):
+            return list(cls.find({'_id': {'$in': chunk}}, projection, **kwargs))
+
+        chunks = [pending[i:i + chunk_size] for i in range(0, len(pending), chunk_size)]
+        if len(chunks) > 1:
+            with ThreadPoolExecutor(min(len(chunks), GET_MANY_WORKERS)) as pool:
+                results = list(pool.map(fetch, chunks))
+        else:
+            results = [fetch(c) for c in chunks]
+
+        for docs in results:
+            for doc in docs:
+                found[doc._id] = doc
+                if cache is not None:
+                    cache[doc._id] = doc
+
+        if missing == 'raise':
+            lost = [id for id in pending if found[id] is None]
+            if lost:
+                raise DataError("Can not find %s by %s" % (cls.__name__, lost))
+        if missing == 'none':
+            return [found[id] for id in ids]
+        return [found[id] for id in ids if found[id] is not None]
 
     @classmethod
     def count(cls, filter=None, **kwargs):
         collection = cls.get_collection(**kwargs)
         return collection.count(filter, **kwargs)
 
+    @classmethod
+    def cached_find(cls, filter=None, projection=None, skip=0, limit=0, sort=None, ttl=60, **kwargs):
+        """
+        返回查询结果列表, 结果按查询条件/projection/skip/limit/排序缓存ttl秒,
+        通过数据模型写入该collection后失效, 参考_touch; 注意lru缓存只在进程内有效, 其他进程的写入不会使其失效.
+        """
+        key = '%s:find:%s' % (cls._cache_prefix(), filter_key({
+            'filter': filter or {},
+            'projection': projection,
+            'skip': skip,
+            'limit': limit,
+            'sort': sort,
+        }))
+        docs = _query_cache.get(key)
+        if docs is None:
+            cursor = cls.get_collection(**kwargs).find(filter, projection, skip=skip, limit=limit, sort=sort)
+            docs = list(cursor)
+            _query_cache.set(key, docs, timeout=ttl)
+        # 返回副本, 避免修改缓存中的文档
+        return [cls._from_db(doc) for doc in deepcopy(docs)]
+
+    @classmethod
+    def cached_count(cls, filter=None, ttl=60, **kwargs):
+        """
+        缓存计数结果, 通过数据模型写入后失效, 参考cached_find.
+        """
+        key = '%s:count:%s' % (cls._cache_prefix(), filter_key(filter or {}))
+        count = _query_cache.get(key)
+        if count is None:
+            count = cls.count(filter, **kwargs)
+            _query_cache.set(key, count, timeout=ttl)
+        return count
+
+    @classmethod
+    def _touch(cls):
+        """
+        递增collection的写入版本号, 使缓存的查询结果失效.
+        版本号保存在查询结果缓存中, 使用flask_caching等共享的缓存时, 任何进程的写入都会使所有进程的缓存失效.
+        """
+        key = cls._version_key()
+        if _query_cache.inc(key) is None:
+            # memcached等缓存中不存在key时inc失败, 使用一个不会重复的版本号
+            _query_cache.set(key, int(time.time() * 1000000), timeout=0)
+
+    @classmethod
+    def _version_key(cls):
+        return '%s:%s:version' % (cls.db_alias or DEFAULT_CONNECTION_NAME, cls.__collection__)
+
+    @classmethod
+    def _cache_prefix(cls):
+        version = _query_cache.get(cls._version_key()) or 0
+        return '%s:%s:%s' % (cls.db_alias or DEFAULT_CONNECTION_NAME, cls.__collection__, version)
+
     @classmethod
     def replace_one(cls, filter, replacement, *args, **kwargs):
         """
-        Please note we do not apply validation here.
+        Please note we do not apply validation here, unless validate_updates or validate=True.
         """
+        if kwargs.pop('validate', cls.validate_updates):
+            cls._validate_document(replacement)
         collection = cls.get_collection(**kwargs)
+        cls._send_bulk_update(pre_bulk_update, filter, replacement, False)
         # UpdateResult
-        return collection.replace_one(filter, replacement, *args, **kwargs)
+        result = collection.replace_one(filter, replacement, *args, **kwargs)
+        cls._touch()
+        cls._send_bulk_update(post_bulk_update, filter, replacement, False, result=result)
+        return result
 
     @classmethod
     def update_one(cls, filter, update, *args, **kwargs):
         """
-        Please note we do not apply validation here.
+        Please note we do not apply validation here, unless validate_updates or validate=True.
         """
+        if kwargs.pop('validate', cls.validate_updates):
+            cls._validate_update(update)
         collection = cls.get_collection(**kwargs)
+        update = cls._inc_version(update)
+        cls._send_bulk_update(pre_bulk_update, filter, update, False)
         # UpdateResult
-        return collection.update_one(filter, update, *args, **kwargs)
+        result = collection.update_one(filter, update, *args, **kwargs)
+        cls._touch()
+        cls._send_bulk_update(post_bulk_update, filter, update, False, result=result)
+        return result
 
     @classmethod
     def update_many(cls, filter, update, *args, **kwargs):
         """
-        Please note we do not apply validation here.
+        Please note we do not apply validation here, unless validate_updates or validate=True.
         """
+        if kwargs.pop('validate', cls.validate_updates):
+            cls._validate_update(update)
         collection = cls.get_collection(**kwargs)
+        update = cls._inc_version(update)
+        cls._send_bulk_update(pre_bulk_update, filter, update, True)
         # UpdateResult
-        return collection.update_many(filter, update, *args, **kwargs)
+        result = collection.update_many(filter, update, *args, **kwargs)
+        cls._touch()
+        cls._send_bulk_update(post_bulk_update, filter, update, True, result=result)
+        return result
+
+    @classmethod
+    def _inc_version(cls, update):
+        if cls.__versioned__ and '_v' not in update.get('$inc', {}) and '_v' not in update.get('$set', {}):
+            if cls.unversioned_fields and all(p.split('.')[0] in cls.unversioned_fields
+                                              for p in changed_paths(update)):
+                return update
+            update = dict(update, **{'$inc': dict(update.get('$inc', {}), _v=1)})
+        return update
+
+    @classmethod
+    def _send_bulk_update(cls, signal, filter, update, many, **kwargs):
+        if signal.receivers:
+            signal.send(cls, filter=filter, update=update, changed=changed_paths(update), many=many, **kwargs)
+
+    @classmethod
+    def bulk_write(cls, requests, *args, **kwargs):
+        """
+        批量写入, 一次请求发送多个InsertOne/UpdateOne/ReplaceOne/DeleteOne等操作.
+        Please note we do not apply validation here.
+        """
+        collection = cls.get_collection(**kwargs)
+        try:
+            # BulkWriteResult
+            return collection.bulk_write(requests, *args, **kwargs)
+        finally:
+            # 部分操作失败时其他操作可能已经生效
+            cls._touch()
 
     @classmethod
     def delete_one(cls, filter, **kwargs):
         collection = cls.get_collection(**kwargs)
         # DeleteResult
-        return collection.delete_one(filter)
+        result = collection.delete_one(filter)
+        cls._touch()
+        return result
 
     @classmethod
     def delete_many(cls, filter, **kwargs):
         collection = cls.get_collection(**kwargs)
         # DeleteResult
-        return collection.delete_many(filter)
+        result = collection.delete_many(filter)
+        cls._touch()
+        return result
 
     @classmethod
     def aggregate(cls, pipeline, **kwargs):
@@ -843,6 +1532,106 @@ class Model(dict):
         collection = cls.get_collection(**kwargs)
         return collection.group(key, condition, initial, reduce, finalize, **kwargs)
 
+    @classmethod
+    def pipeline(cls):
+        """
+        创建聚合管道, 参考Pipeline.
+        """
+        return Pipeline(cls)
+
+    @classmethod
+    def push(cls, filter_or_id, path, value, position=None, array_filters=None, update=None, **kwargs):
+        """
+        原子地向数组中添加一个元素, 只校验添加的元素, 不需要读取整个文档, 如:
+        Post.push(post_id, 'comments', cmt, position=0)
+        Post.push({'_id': post_id, 'comments.id': 1}, 'comments.$[c].replys', reply, array_filters=[{'c.id': 1}])
+        :param update: 需要同时执行的其他更新操作, 如{'$inc': {'size': 1}}
+        :return: UpdateResult
+        """
+        struct = cls._get_struct(path)
+        if not isinstance(struct, list):
+            raise StructureError("%s: %s is not a list" % (cls.__name__, path))
+        cls._validate_value(value, struct[0], path + '.$')
+
+        filter = filter_or_id if isinstance(filter_or_id, dict) else {'_id': filter_or_id}
+        if position is None:
+            push = {path: value}
+        else:
+            push = {path: {'$each': [value], '$position': position}}
+        update = dict(update or {}, **{'$push': push})
+        if array_filters:
+            kwargs['array_filters'] = array_filters
+        return cls.update_one(filter, update, **kwargs)
+
+    @classmethod
+    def _get_struct(cls, path):
+        """
+        返回路径对应的结构定义, 路径中的数组下标以及$/$[]/$[x]都表示数组元素.
+        """
+        struct = cls._path_structs.get(_ARRAY_TOKEN.sub('$', path))
+        if struct is None:
+            raise StructureError("%s: %s is not a valid path" % (cls.__name__, path))
+        return struct
+
+    @classmethod
+    def _check_path(cls, path):
+        """
+        校验查询中使用的字段路径, 数组可以省略$, 如comments.uid等同于comments.$.uid, 返回_valid_paths中的路径.
+        """
+        valid = cls._valid_paths
+        current = None
+        for key in path.split('.'):
+            if current is not None and isinstance(valid.get(current), list) and not (key.isdigit() or key == '$'):
+                current += '.$'
+            current = key if current is None else '%s.%s' % (current, '$' if key.isdigit() else key)
+            if current not in valid:
+                if cls.use_schemaless:
+                    return None
+                raise StructureError("%s: %s is not a valid path" % (cls.__name__, path))
+        return current
+
+    @classmethod
+    def _validate_update(cls, update):
+        """
+        校验更新操作, 只检查涉及的字段路径和值, 总是触发异常.
+        """
+        for op, fields in update.iteritems():
+            if not op.startswith('$'):
+                raise DataError("%s: %s is not an update operator" % (cls.__name__, op))
+            for path, value in fields.iteritems():
+                if cls.use_schemaless and _ARRAY_TOKEN.sub('$', path) not in cls._path_structs:
+                    continue
+                struct = cls._get_struct(path)
+                if op in ('$set', '$setOnInsert'):
+                    cls._validate_value(value, struct, path)
+                elif op in ('$inc', '$mul'):
+                    if struct not in NUMBER_TYPES or not isinstance(value, NUMBER_TYPES):
+                        raise DataError("%s: can not apply %s to %s with %s" % (cls.__name__, op, path, value))
+                elif op in ('$push', '$addToSet'):
+                    if not isinstance(struct, list):
+                        raise StructureError("%s: %s is not a list" % (cls.__name__, path))
+                    values = value['$each'] if isinstance(value, dict) and '$each' in value else [value]
+                    for v in values:
+                        cls._validate_value(v, struct[0], path + '.$')
+
+    @classmethod
+    def _validate_document(cls, doc):
+        """
+        校验插入或者替换的整个文档.
+        """
+        model = doc if isinstance(doc, cls) else cls(doc, set_default=False)
+        if not model.validate():
+            raise DataError("It is an illegal %s object with errors, %s" % (cls.__name__, model.validation_errors))
+
+    @classmethod
+    def _validate_value(cls, value, struct, path):
+        """
+        校验部分数据, 总是触发异常.
+        """
+        model = cls(set_default=False)
+        model.raise_validation_errors = True
+        model._validate_doc(value, struct, path)
+
     #
     #
     # Instance level pymongo api
@@ -856,12 +1645,75 @@ class Model(dict):
 
         collection = self.get_collection(**kwargs)
         _id = self.get('_id', None)
-        if insert_with_id or not _id:
+        created = bool(insert_with_id or not _id)
+        if pre_save.receivers:
+            pre_save.send(self.__class__, document=self, created=created)
+        if created:
+            if self.__versioned__:
+                self['_v'] = 1
             # InsertOneResult
-            return collection.insert_one(self)
+            result = collection.insert_one(self)
+            self._log_change('insert')
+            self._update_counters(None, self)
         else:
-            # UpdateResult
-            return collection.replace_one({'_id': _id}, self)
+            filter = {'_id': _id}
+            current = self.get('_v')
+            if self.__versioned__:
+                # 版本号一致时才替换, 没有版本号的旧文档只匹配同样没有版本号的文档
+                filter['_v'] = current if current else {'$exists': False}
+                self['_v'] = (current or 0) + 1
+            if self.__versioned__ and self.unversioned_fields:
+                # 这些字段的修改不会递增版本号, 不能用当前文档覆盖
+                doc = self._versioned_update()
+                replace, find_and_replace = collection.update_one, collection.find_one_and_update
+            else:
+                doc = self
+                replace, find_and_replace = collection.replace_one, collection.find_one_and_replace
+            if self.counter_caches:
+                # 需要替换前的文档来计算计数器的变化
+                old = find_and_replace(filter, doc, return_document=ReturnDocument.BEFORE)
+                matched = 1 if old else 0
+                # UpdateResult
+                result = UpdateResult({'n': matched, 'nModified': matched, 'ok': 1}, True)
+            else:
+                old = None
+                # UpdateResult
+                result = replace(filter, doc)
+            if self.__versioned__ and not result.matched_count:
+                if current:
+                    self['_v'] = current
+                else:
+                    del self['_v']
+                raise ConflictError("%s %s has been changed by others" % (self.__class__.__name__, _id))
+            if old:
+                self._update_counters(old, self)
+        self._touch()
+        if post_save.receivers:
+            post_save.send(self.__class__, document=self, created=created)
+        return result
+
+    def _versioned_update(self):
+        """
+        将替换文档转换为更新操作, 设置除unversioned_fields以外的字段, 删除数据结构中已经不存在的字段.
+        """
+        update = {'$set': {k: v for k, v in self.iteritems() if k != '_id' and k not in self.unversioned_fields}}
+        unset = {k: '' for k in self.structure if k not in self and k not in self.unversioned_fields}
+        if unset:
+            update['$unset'] = unset
+        return update
+
+    def save_with_retry(self, apply, retries=3, **kwargs):
+        """
+        调用apply(self)修改文档后保存, 发生ConflictError时reload之后重新调用apply, 最多重试retries次.
+        """
+        for i in range(retries + 1):
+            apply(self)
+            try:
+                return self.save(**kwargs)
+            except ConflictError:
+                if i == retries:
+                    raise
+                self.reload()
 
     def reload(self, **kwargs):
         existing = self.find_one({'_id': self['_id']}, **kwargs)
@@ -876,8 +1728,100 @@ class Model(dict):
 
     def delete(self, **kwargs):
         collection = self.get_collection(**kwargs)
-        # DeleteResult
-        return collection.delete_one({'_id': self['_id']})
+        if pre_delete.receivers:
+            pre_delete.send(self.__class__, document=self)
+        if self.counter_caches:
+            old = collection.find_one_and_delete({'_id': self['_id']})
+            # DeleteResult
+            result = DeleteResult({'n': 1 if old else 0, 'ok': 1}, True)
+            if old:
+                self._update_counters(old, None)
+        else:
+            # DeleteResult
+            result = collection.delete_one({'_id': self['_id']})
+        if result.deleted_count:
+            self._touch()
+            self._log_change('delete')
+            if post_delete.receivers:
+                post_delete.send(self.__class__, document=self)
+        return result
+
+    #
+    #
+    # Counter cache
+    #
+    #
+
+    def _update_counters(self, old, new):
+        """
+        根据修改前后的文档更新父文档的计数器, 插入时old为None, 删除时new为None.
+        """
+        # {(parent model, parent id):{counter:delta}}
+        incs = {}
+        for cc in self.counter_caches:
+            model = cc.get('model', self.__class__)
+            before = old.get(cc['parent']) if old and _match_filter(old, cc.get('filter')) else None
+            after = new.get(cc['parent']) if new and _match_filter(new, cc.get('filter')) else None
+            if before == after:
+                continue
+            if before:
+                inc = incs.setdefault((model, before), {})
+                inc[cc['counter']] = inc.get(cc['counter'], 0) - 1
+            if after:
+                inc = incs.setdefault((model, after), {})
+                inc[cc['counter']] = inc.get(cc['counter'], 0) + 1
+
+        for (model, parent), inc in incs.iteritems():
+            model.update_one({'_id': parent}, {'$inc': inc})
+
+    @classmethod
+    def repair_counters(cls):
+        """
+        使用聚合重新计算counter_caches定义的计数器, 同一个父字段的计数器只需要一次聚合.
+        """
+        # {(parent model, parent field):[counter cache]}
+        groups = {}
+        for cc in cls.counter_caches:
+            groups.setdefault((cc.get('model', cls), cc['parent']), []).append(cc)
+
+        for (model, parent), ccs in groups.iteritems():
+            accumulators = {cc['counter']: {'$sum': {'$cond': [_filter_expr(cc.get('filter')), 1, 0]}} for cc in ccs}
+            counters = {}
+            for r in cls.pipeline().match({parent: {'$ne': None}}).group(parent, **accumulators).run(
+                    allow_disk_use=True):
+                counters[r.pop('_id')] = r
+            for parent_id, values in counters.iteritems():
+                model.update_one({'_id': parent_id}, {'$set': values})
+            # 没有子文档的父文档计数器清零
+            zeros = {cc['counter']: 0 for cc in ccs}
+            model.update_many({'_id': {'$nin': counters.keys()}, '$or': [{c: {'$nin': [0, None]}} for c in zeros]},
+                              {'$set': zeros})
+
+    #
+    #
+    # Change log
+    #
+    #
+
+    def _log_change(self, op):
+        if self.__changelog__:
+            _get_changelog(self.db_alias).insert_one(
+                {'coll': self.__collection__, 'op': op, 'docId': self['_id'], 'time': datetime.utcnow()})
+
+    @classmethod
+    def get_changes(cls, since=None, until=None):
+        """
+        按顺序返回_id在[since, until)之间的变更日志, since/until可以是上次读取的变更_id或者ObjectId.from_datetime生成的时间点.
+        多个进程同时写入时, _id较小的变更可能稍后才写入, 读取时until应该比当前时间稍早一些.
+        """
+        filter = {'coll': cls.__collection__}
+        if since or until:
+            filter['_id'] = {}
+            if since:
+                filter['_id']['$gte'] = since
+            if until:
+                filter['_id']['$lt'] = until
+        return _get_changelog(cls.db_alias).find(filter, sort=[('_id', pymongo.ASCENDING)])
 
     #
     #
@@ -898,18 +1842,19 @@ class Model(dict):
         Make use of the structure for decoding.
         """
 
-        def json_decode(value, type):
+        def json_decode(value, type, path):
             if value is None:
                 return value
 
             if type is datetime:
-                return datetime.strptime(value, DATETIME_FORMATS[0])
+                # 同一字段的日期格式通常是一致的, 使用模型名和字段路径作为格式缓存的key
+                return parse_datetime(value, (cls.__name__, path))
             elif type is ObjectId:
                 return ObjectId(value)
             else:
                 return type(value)
 
-        def _convert_dict(doc, struct):
+        def _convert_dict(doc, struct, path=''):
             """
             Recursively convert specified type.
             """
@@ -921,36 +1866,38 @@ class Model(dict):
                 if old_value is None:
                     continue
 
+                new_path = ('%s.%s' % (path, key)).strip('.')
                 if type(s) is type:
-                    doc[key] = json_decode(old_value, s)
+                    doc[key] = json_decode(old_value, s, new_path)
                 # {}
                 elif isinstance(s, dict):
-                    _convert_dict(old_value, s)
+                    _convert_dict(old_value, s, new_path)
                 # []
                 elif isinstance(s, list):
-                    _convert_list(old_value, s)
+                    _convert_list(old_value, s, new_path)
                 # IN
                 elif isinstance(s, SchemaOperator):
-                    doc[key] = json_decode(old_value, type(s.operands[0]))
+                    doc[key] = json_decode(old_value, type(s.operands[0]), new_path)
 
-        def _convert_list(doc, struct):
+        def _convert_list(doc, struct, path):
             s = struct[0]
             if doc is None:
                 return
 
+            new_path = path + '.$'
             for i, v in enumerate(doc):
                 old_value = doc[i]
                 if type(s) is type:
-                    doc[i] = json_decode(old_value, s)
+                    doc[i] = json_decode(old_value, s, new_path)
                 # {}
                 elif isinstance(s, dict):
-                    _convert_dict(old_value, s)
+                    _convert_dict(old_value, s, new_path)
                 # []
                 elif isinstance(s, list):
-                    _convert_list(old_value, s)
+                    _convert_list(old_value, s, new_path)
                 # IN
                 elif isinstance(s, SchemaOperator):
-                    doc[i] = json_decode(old_value, type(s.operands[0]))
+                    doc[i] = json_decode(old_value, type(s.operands[0]), new_path)
 
         d = json.loads(doc)
         _convert_dict(d, cls.structure)
@@ -970,16 +1917,320 @@ class ModelCursor(PyMongoCursor):
         super(ModelCursor, self).__init__(collection, *args, **kwargs)
 
     def next(self):
-        return self._document_class(super(ModelCursor, self).next())
+        return self._document_class._from_db(super(ModelCursor, self).next())
 
     def __next__(self):
-        return self._document_class(super(ModelCursor, self).__next__())
+        return self._document_class._from_db(super(ModelCursor, self).__next__())
 
     def __getitem__(self, index):
         if isinstance(index, slice):
             return super(ModelCursor, self).__getitem__(index)
         else:
-            return self._document_class(super(ModelCursor, self).__getitem__(index))
+            return self._document_class._from_db(super(ModelCursor, self).__getitem__(index))
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Query cache - 查询结果缓存
+#
+
+class QueryCache(object):
+    """
+    进程内的LRU缓存, 接口与flask_caching/werkzeug的缓存一致, 可以通过set_query_cache替换.
+    """
+
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        # {key:(expire time, value)}
+        self._items = OrderedDict()
+        # {key:value}, 通过inc维护的计数器, 如collection的写入版本号, 不会被淘汰
+        self._counters = {}
+
+    def get(self, key):
+        with self._lock:
+            if key in self._counters:
+                return self._counters[key]
+            item = self._items.pop(key, None)
+            if item is None:
+                return None
+            if item[0] < time.time():
+                return None
+            # 移到末尾, 表示最近使用过
+            self._items[key] = item
+            return item[1]
+
+    def set(self, key, value, timeout=None):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (time.time() + timeout if timeout else float('inf'), value)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+        return True
+
+    def inc(self, key, delta=1):
+        with self._lock:
+            value = self._counters[key] = self._counters.get(key, 0) + delta
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._counters.clear()
+        return True
+
+
+_query_cache = QueryCache()
+
+
+def set_query_cache(cache):
+    """
+    替换查询结果缓存, cache需要提供get(key)/set(key, value, timeout)/inc(key), 如flask_caching的缓存.
+    多个进程使用同一个共享的缓存时, 写入版本号也是共享的, 参考Model._touch.
+    """
+    global _query_cache
+    _query_cache = cache
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Serialization - Model.__reduce__/to_bytes/from_bytes使用的格式
+#
+
+# 格式版本, 格式不兼容时递增, 新版本可以读取旧版本的数据
+SERIALIZATION_VERSION = 1
+
+# msgpack扩展类型
+MSGPACK_OBJECTID = 1
+MSGPACK_DATETIME = 2
+
+_EPOCH = datetime(1970, 1, 1)
+
+# {类路径:数据模型}
+_model_classes = {}
+
+
+def _model_path(model):
+    return '%s:%s' % (model.__module__, model.__name__)
+
+
+def _rebuild_model(path, version, doc, base=None):
+    """
+    根据类路径重建对象, 定义为模块级别的函数以便pickle.
+    类路径来自序列化的数据, 构造之前先确认是base(默认为Model)的子类, 只缓存数据模型.
+
+    :param base: 数据模型必须是base或者base的子类
+    """
+    if version > SERIALIZATION_VERSION:
+        raise DataError("Unsupported serialization version %s of %s" % (version, path))
+    base = base or Model
+    model = _model_classes.get(path)
+    if model is None:
+        try:
+            module, name = path.split(':')
+            model = getattr(importlib.import_module(module), name)
+        except (ValueError, ImportError, AttributeError):
+            raise DataError("Can not find model %s" % path)
+        if not isinstance(model, ModelMetaclass) or not issubclass(model, Model):
+            raise DataError("%s is not a model" % path)
+        _model_classes[path] = model
+    if not issubclass(model, base):
+        raise DataError("%s is not a %s" % (path, base.__name__))
+    return model(doc, set_default=False)
+
+
+def _msgpack():
+    if msgpack is None:
+        raise MongoSupportError('msgpack is not installed')
+    return msgpack
+
+
+def _msgpack_default(value):
+    if isinstance(value, ObjectId):
+        return msgpack.ExtType(MSGPACK_OBJECTID, value.binary)
+    if isinstance(value, datetime):
+        # 与pymongo一致, 统一转换为UTC时间, 精确到微秒
+        micros = calendar.timegm(value.utctimetuple()) * 1000000 + value.microsecond
+        return msgpack.ExtType(MSGPACK_DATETIME, msgpack.packb(micros))
+    raise TypeError("Can not serialize %r with msgpack" % (value,))
+
+
+def _msgpack_ext_hook(code, data):
+    if code == MSGPACK_OBJECTID:
+        return ObjectId(data)
+    if code == MSGPACK_DATETIME:
+        return _EPOCH + timedelta(microseconds=msgpack.unpackb(data))
+    return msgpack.ExtType(code, data)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Aggregation - 聚合管道构建器
+#
+
+class Pipeline(object):
+    """
+    聚合管道, 在$group/$project等改变文档结构的阶段之前, 会根据数据结构校验使用的字段路径, 如:
+    Keyword.pipeline().match({'level': 2}).group('parentId', total={'$sum': 1}).run(allow_disk_use=True)
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.stages = []
+        # 文档结构是否已经改变, 改变后不再校验字段路径
+        self.reshaped = False
+
+    def match(self, filter):
+        if not self.reshaped:
+            self._check_filter(filter)
+        return self.stage({'$match': filter}, reshape=False)
+
+    def project(self, *fields, **exprs):
+        """
+        project('name', 'status', total='$baiduIndex')
+        """
+        projection = {f: True for f in fields}
+        for f in fields:
+            self._check(f)
+        for e in exprs.itervalues():
+            self._check_expr(e)
+        projection.update(exprs)
+        return self.stage({'$project': projection})
+
+    def group(self, key, **accumulators):
+        """
+        group('parentId', total={'$sum': 1}), key可以是字段路径, 表达式或者None.
+        """
+        if isinstance(key, basestring):
+            self._check(key)
+            key = '$' + key
+        else:
+            self._check_expr(key)
+        for a in accumulators.itervalues():
+            self._check_expr(a)
+        return self.stage({'$group': dict(accumulators, _id=key)})
+
+    def unwind(self, path):
+        self._check(path)
+        return self.stage({'$unwind': '$' + path}, reshape=False)
+
+    def sort(self, *fields):
+        """
+        sort('name', ('baiduIndex', pymongo.DESCENDING))
+        """
+        sort = SON()
+        for f in fields:
+            f = f if isinstance(f, tuple) else (f, pymongo.ASCENDING)
+            self._check(f[0])
+            sort[f[0]] = f[1]
+        return self.stage({'$sort': sort}, reshape=False)
+
+    def skip(self, n):
+        return self.stage({'$skip': n}, reshape=False)
+
+    def limit(self, n):
+        return self.stage({'$limit': n}, reshape=False)
+
+    def stage(self, stage, reshape=True):
+        """
+        添加任意阶段, 不做校验.
+        """
+        self.stages.append(stage)
+        self.reshaped = self.reshaped or reshape
+        return self
+
+    def run(self, allow_disk_use=False, batch_size=None, **kwargs):
+        """
+        执行聚合, 返回CommandCursor, 结果按batch_size分批读取.
+        """
+        if batch_size:
+            kwargs['batchSize'] = batch_size
+        return self.model.get_collection().aggregate(self.stages, allowDiskUse=allow_disk_use, **kwargs)
+
+    def materialize(self, name, refresh=None, merge_on=None, allow_disk_use=False):
+        """
+        将聚合结果保存到名为name的collection中并返回该collection, 距离上次保存不到refresh秒时直接返回.
+        默认使用$out替换整个collection, 指定merge_on时使用$merge按字段合并(MongoDB 4.2+).
+        """
+        db = self.model.get_collection().database
+        meta = db[MATERIALIZED_COLLECTION]
+        now = datetime.utcnow()
+        if refresh:
+            last = meta.find_one({'_id': name})
+            if last and (now - last['time']).total_seconds() < refresh:
+                return db[name]
+
+        if merge_on:
+            out = {'$merge': {'into': name, 'on': merge_on, 'whenMatched': 'replace', 'whenNotMatched': 'insert'}}
+        else:
+            out = {'$out': name}
+        list(self.model.get_collection().aggregate(self.stages + [out], allowDiskUse=allow_disk_use))
+        meta.replace_one({'_id': name}, {'_id': name, 'time': now}, upsert=True)
+        return db[name]
+
+    def _check(self, path):
+        if not self.reshaped:
+            self.model._check_path(path)
+
+    def _check_expr(self, expr):
+        """
+        校验表达式中以$开头的字段引用, $$开头的变量不做校验.
+        """
+        if self.reshaped:
+            return
+        if isinstance(expr, basestring):
+            if expr.startswith('$') and not expr.startswith('$$'):
+                self.model._check_path(expr[1:])
+        elif isinstance(expr, dict):
+            for v in expr.itervalues():
+                self._check_expr(v)
+        elif isinstance(expr, list):
+            for v in expr:
+                self._check_expr(v)
+
+    def _check_filter(self, filter):
+        for k, v in filter.iteritems():
+            if k in ('$and', '$or', '$nor'):
+                for f in v:
+                    self._check_filter(f)
+            elif k == '$expr':
+                self._check_expr(v)
+            elif not k.startswith('$'):
+                self.model._check_path(k)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Parallel scan - Model.parallel_scan使用的模块级别函数, 以便在进程池中执行
+#
+
+def _scan_range(model, start, end, fn, filter, projection, batch_size):
+    """
+    处理[start, end)区间内的文档, start/end为None时表示不限制.
+    """
+    _check_fork()
+    bounds = {}
+    if start is not None:
+        bounds['$gte'] = start
+    if end is not None:
+        bounds['$lt'] = end
+    filter = filter or {}
+    if bounds:
+        filter = dict(filter, _id=bounds) if '_id' not in filter else {'$and': [filter, {'_id': bounds}]}
+    return fn(model.iterate(filter, batch_size=batch_size, projection=projection))
+
+
+def _load_scan_checkpoint(path):
+    try:
+        with open(path) as f:
+            return json_util.loads(f.read())
+    except (IOError, ValueError):
+        return None
+
+
+def _save_scan_checkpoint(path, state):
+    """
+    先写入临时文件再重命名, 避免中断时留下不完整的checkpoint.
+    """
+    # app.tools会导入app.extensions, 在这里导入避免循环引用
+    from app.tools.files import atomic_write
+    atomic_write(path, lambda f: f.write(json_util.dumps(state)), mode='w')
 
 
 # ----------------------------------------------------------------------------------------------------------------------
@@ -994,6 +2245,30 @@ _connection_settings = {}
 _connections = {}
 # {alias:database of pymongo.Database}
 _dbs = {}
+# {alias:changelog collection of pymongo.Collection}
+_changelogs = {}
+# 创建以上连接的进程, 参考_check_fork
+_owner_pid = os.getpid()
+
+
+def _check_fork():
+    """
+    MongoClient不能在fork出的子进程中继续使用, 子进程中丢弃(不关闭)继承的连接以及各个数据模型缓存的collection,
+    使用时重新创建.
+    """
+    global _owner_pid
+    if os.getpid() == _owner_pid:
+        return
+    _owner_pid = os.getpid()
+    _connections.clear()
+    _dbs.clear()
+    _changelogs.clear()
+    models = [Model]
+    while models:
+        model = models.pop()
+        models.extend(model.__subclasses__())
+        if 'collection' in model.__dict__:
+            model.collection = None
 
 
 def _register_connection(alias, name=None, host=None, port=None,
@@ -1148,23 +2423,51 @@ def disconnect(alias=DEFAULT_CONNECTION_NAME):
         del _connections[alias]
     if alias in _dbs:
         del _dbs[alias]
+    if alias in _changelogs:
+        del _changelogs[alias]
+
+
+def _get_changelog(alias=None):
+    """
+    获取变更日志的collection, 第一次获取时创建索引.
+    """
+    alias = alias or DEFAULT_CONNECTION_NAME
+    if alias not in _changelogs:
+        collection = get_db(alias)[CHANGELOG_COLLECTION]
+        collection.create_index([('coll', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)])
+        collection.create_index('time', expireAfterSeconds=CHANGELOG_TTL)
+        _changelogs[alias] = collection
+    return _changelogs[alias]
 
 
 # ----------------------------------------------------------------------------------------------------------------------
 # Proxy - 使用代理机制来支持dot notation的方式来访问, 不会改变内部结构, 只是在访问的时候创建轻量级的proxy对象
 #
 
-class DotDictProxy(MutableMapping, object):
+# 代理对象本身的属性
+_PROXY_SLOTS = frozenset(['_obj_', '_struct_', '_proxies_'])
+
+
+class DotDictProxy(object):
     """
     A proxy for a dictionary that allows attribute access to underlying keys.
+    使用__slots__减少内存分配, 子字段的代理对象缓存在_proxies_中, 重复访问时不会再次创建.
     """
 
+    __slots__ = ('_obj_', '_struct_', '_proxies_')
+    __hash__ = None
+
     def __init__(self, obj, struct):
         self._obj_ = obj
         self._struct_ = struct
+        self._proxies_ = None
+
+    def __reduce__(self):
+        # 不保存缓存的代理对象
+        return DotDictProxy, (self._obj_, self._struct_)
 
     def __getattr__(self, key):
-        if key in ['_obj_', '_struct_'] or key not in self._struct_:
+        if key in _PROXY_SLOTS or key not in self._struct_:
             return object.__getattribute__(self, key)
 
         s = self._struct_[key]
@@ -1179,10 +2482,14 @@ class DotDictProxy(MutableMapping, object):
                 found = None
             self._obj_[key] = found
 
-        return proxywrapper(found, s)
+        if not isinstance(s, (dict, list)):
+            return found
+        if self._proxies_ is None:
+            self._proxies_ = {}
+        return cachedproxy(self._proxies_, key, found, s)
 
     def __setattr__(self, key, value):
-        if key in ['_obj_', '_struct_'] or key not in self._struct_:
+        if key in _PROXY_SLOTS or key not in self._struct_:
             return object.__setattr__(self, key, value)
         # print "dict proxy setting attr %s with %s" % (key, value)
         if isinstance(value, (DotDictProxy, DotListProxy)):
@@ -1199,6 +2506,9 @@ class DotDictProxy(MutableMapping, object):
     def __iter__(self):
         return self._obj_.__iter__()
 
+    def __contains__(self, key):
+        return key in self._obj_
+
     def __str__(self):
         return "DotDictProxy(%s)" % self._obj_.__str__()
 
@@ -1220,21 +2530,42 @@ class DotDictProxy(MutableMapping, object):
         return self._obj_
 
 
-class DotListProxy(MutableSequence, object):
+class DotListProxy(object):
     """
     A proxy for a list that allows for wrapping items.
+    元素的代理对象按下标缓存在_proxies_中, 元素被替换之后重新创建.
     """
 
+    __slots__ = ('_obj_', '_struct_', '_proxies_')
+    __hash__ = None
+
     def __init__(self, obj, struct):
         self._obj_ = obj
         self._struct_ = struct
+        self._proxies_ = None
+
+    def __reduce__(self):
+        # 不保存缓存的代理对象
+        return DotListProxy, (self._obj_, self._struct_)
 
     def __getitem__(self, index):
         # print "list proxy getting index %s for structure %s with value %s" % (index, self._struct_, self._obj_[index])
         if isinstance(index, slice):
             return proxywrapper(self._obj_[index], self._struct_)
-        else:
-            return proxywrapper(self._obj_[index], self._struct_[0])
+        s = self._struct_[0]
+        if not isinstance(s, (dict, list)):
+            return self._obj_[index]
+        if self._proxies_ is None:
+            self._proxies_ = {}
+        return cachedproxy(self._proxies_, index, self._obj_[index], s)
+
+    def __iter__(self):
+        s = self._struct_[0]
+        if not isinstance(s, (dict, list)):
+            return iter(self._obj_)
+        if self._proxies_ is None:
+            self._proxies_ = {}
+        return (cachedproxy(self._proxies_, i, v, s) for i, v in enumerate(self._obj_))
 
     def __setitem__(self, index, value):
         if isinstance(value, (DotDictProxy, DotListProxy)):
@@ -1269,6 +2600,76 @@ class DotListProxy(MutableSequence, object):
         return self._obj_
 
 
+class FieldDescriptor(object):
+    """
+    Support dot notation, 由元类为每个顶层字段生成, 直接读写文档中的值, 只有字典和列表字段才使用代理对象.
+    """
+
+    __slots__ = ('key', 'struct', 'factory')
+
+    def __init__(self, key, struct):
+        self.key = key
+        self.struct = struct
+        self.factory = dict if isinstance(struct, dict) else list if isinstance(struct, list) else None
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        found = instance.get(self.key, None)
+        # print "getting attr %s for structure %s with value %s" % (self.key, self.struct, type(found))
+        if found is None:
+            found = self.factory() if self.factory else None
+            instance[self.key] = found
+        if self.factory is None:
+            return found
+
+        # 缓存字段的代理对象, 字段被重新赋值之后会重新创建
+        proxies = instance.__dict__.get('_proxies')
+        if proxies is None:
+            proxies = instance.__dict__['_proxies'] = {}
+        return cachedproxy(proxies, self.key, found, self.struct)
+
+    def __set__(self, instance, value):
+        # print "setting attr %s with %s" % (self.key, value)
+        if isinstance(value, (DotDictProxy, DotListProxy)):
+            instance[self.key] = value._obj_
+        else:
+            instance[self.key] = value
+
+    def __delete__(self, instance):
+        instance.pop(self.key, None)
+
+
+def _mixin(cls, abc):
+    """
+    Python 2中collections的抽象类没有定义__slots__, 继承之后实例仍然会有__dict__,
+    因此只复制抽象类中已经实现的方法, 并将代理类注册为抽象类的虚拟子类, 保持isinstance的判断结果不变.
+    """
+    for klass in abc.__mro__:
+        for name, value in klass.__dict__.iteritems():
+            if isinstance(value, FunctionType) and name not in cls.__dict__ and \
+                    not getattr(value, '__isabstractmethod__', False):
+                setattr(cls, name, value)
+    abc.register(cls)
+
+
+_mixin(DotDictProxy, MutableMapping)
+_mixin(DotListProxy, MutableSequence)
+
+
+def cachedproxy(cache, key, value, struct):
+    """
+    从cache中获取value的代理对象, 只有代理的仍然是同一个对象时才复用.
+    """
+    proxy = cache.get(key)
+    if proxy is None or proxy._obj_ is not value:
+        proxy = proxywrapper(value, struct)
+        if proxy is value:
+            return value
+        cache[key] = proxy
+    return proxy
+
+
 def proxywrapper(value, struct):
     """
     The top-level API for wrapping an arbitrary object.
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmark
+    ~~~~~~~~~~~~~~
+
+    Micro benchmarks for mongosupport.
+
+    无需连接数据库, 只测试数据模型在内存中的处理性能.
+
+    执行脚本:
+    python2.7 benchmark.py
+
+    :copyright: (c) 2026 by flask-boot contributors.
+    :date: 2026/10/18
+"""
+
+import os
+import sys
+import timeit
+from datetime import datetime
+
+from werkzeug.datastructures import MultiDict
+
+sys.path.append(os.path.join(os.getcwd(), '../../'))
+
+from app.mongosupport import Model, populate_model
+from app.mongosupport.mongosupport import DATETIME_FORMATS
+
+NUMBER = 10000
+
+
+class Bench(Model):
+    __collection__ = 'benchmarks'
+    structure = {
+        'name': unicode,
+        'time': datetime,
+    }
+
+
+class Defaulted(Model):
+    __collection__ = 'benchmarks'
+    structure = {
+        'name': unicode,
+        'status': unicode,
+        'point': int,
+        'roles': [unicode],
+        'createTime': datetime,
+        'profile': {
+            'views': int,
+            'source': unicode,
+        },
+    }
+    default_values = {'status': u'normal', 'point': 0, 'roles': [u'member'], 'createTime': datetime.now,
+                      'profile.views': 0, 'profile.source': u'web'}
+
+
+class Nested(Model):
+    __collection__ = 'benchmarks'
+    structure = {
+        'title': unicode,
+        'comments': [{
+            'id': int,
+            'content': unicode,
+            'replys': [{
+                'content': unicode,
+            }]
+        }]
+    }
+
+
+def _report(name, seconds, number=NUMBER):
+    print '%-48s %8.2f us/op' % (name, seconds * 1000000 / number)
+
+
+def bench_datetime():
+    """
+    比较每种日期格式在表单导入以及JSON导入时的性能.
+    """
+    now = datetime(2016, 11, 17, 8, 30, 15, 123456)
+    for fmt in DATETIME_FORMATS:
+        value = unicode(now.strftime(fmt))
+
+        def strptime():
+            for f in DATETIME_FORMATS:
+                try:
+                    return datetime.strptime(value, f)
+                except ValueError:
+                    pass
+
+        md = MultiDict([('bench.name', u'bench'), ('bench.time', value)])
+        js = '{"name": "bench", "time": "%s"}' % value
+
+        _report('strptime fallback %s' % fmt, timeit.timeit(strptime, number=NUMBER))
+        _report('populate_model %s' % fmt, timeit.timeit(lambda: populate_model(md, Bench), number=NUMBER))
+        _report('from_json %s' % fmt, timeit.timeit(lambda: Bench.from_json(js), number=NUMBER))
+
+
+def bench_proxy():
+    """
+    测试使用dot notation遍历嵌套数据结构的性能, 100条评论, 每条评论5条回复.
+    """
+    doc = Nested({'title': u'bench', 'comments': [
+        {'id': i, 'content': u'comment', 'replys': [{'content': u'reply'} for _ in range(5)]} for i in range(100)]})
+
+    def iterate():
+        for c in doc.comments:
+            c.id
+            for r in c.replys:
+                r.content
+
+    number = NUMBER / 100
+    _report('iterate nested comments', timeit.timeit(iterate, number=number), number)
+    _report('access doc.comments[0].replys[0]', timeit.timeit(lambda: doc.comments[0].replys[0], number=NUMBER))
+    _report('get doc.title', timeit.timeit(lambda: doc.title, number=NUMBER * 10), NUMBER * 10)
+    _report('set doc.title', timeit.timeit(lambda: setattr(doc, 'title', u'bench'), number=NUMBER * 10), NUMBER * 10)
+
+
+def bench_default_values():
+    """
+    测试创建新对象以及加载数据库中的文档时设置默认值的性能.
+    """
+    doc = dict(Defaulted({'name': u'bench'}))
+    _report('new Defaulted()', timeit.timeit(lambda: Defaulted({'name': u'bench'}), number=NUMBER))
+    _report('load Defaulted from db', timeit.timeit(lambda: Defaulted._from_db(doc), number=NUMBER))
+
+
+if __name__ == '__main__':
+    bench_datetime()
+    bench_proxy()
+    bench_default_values()
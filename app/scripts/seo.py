@@ -7,45 +7,34 @@
 
     SEO相关脚本, 比如:
     1) 抓取关键词列表
-    2) 根据关键词列表查询百度指数以及相关长尾关键字并排序
+    2) 根据关键词列表并发查询百度指数以及相关长尾关键字, 进度保存在app/logs/seo.checkpoint中, 中断后重新执行会跳过已处理的关键词
 
     执行脚本:
     export PYTHONIOENCODING=utf-8
     nohup python2.7 seo.py > ~/seo.txt &
 
+    也可以只抓取关键词列表, 将关键词分析任务加入队列, 由python manage.py worker启动的进程执行:
+    python2.7 seo.py enqueue
+
     :copyright: (c) 2016 by fengweimin.
     :date: 2016/10/18
 """
 
 import os
-import random
 import sys
-import time
 
-import requests
 from lxml import html
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
 from werkzeug.urls import url_quote
 
 sys.path.append(os.path.join(os.getcwd(), '../../'))
 
 from app import create_app
+from app.jobs import enqueue
 from app.models import KeywordLevel, Keyword
-
-user_agent = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_4) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/52.0.2743.116 Safari/537.36'
-headers = {
-    'User-Agent': user_agent,
-    'Accept': 'application/json, text/javascript, text/html, */*; q=0.01',
-    'Accept-Language': 'zh-CN,zh;q=0.8,en;q=0.6,zh-TW;q=0.4,ja;q=0.2',
-    'Accept-Encoding': 'gzip, deflate, sdch',
-    'Content-Type': 'application/x-www-form-urlencoded; charset=UTF-8',
-    'X-Requested-With': 'XMLHttpRequest',
-    'Connection': 'keep-alive',
-}
-adapter = requests.adapters.HTTPAdapter(max_retries=5)
-ss = requests.session()
-ss.mount('http://', adapter)
-ss.mount('https://', adapter)
-ss.headers.update(headers)
+from app.tools.crawler import Crawler, HostRateLimiter, parse_5118_keywords
+from app.tools.httpclient import http
 
 ym = 'http://www.yameituku.net'
 
@@ -54,10 +43,9 @@ def fetch_keywords():
     """
     获取站点级别的关键字并插入数据库中.
     """
-    ss.headers['Referer'] = ym
-    r = ss.get(ym + '/girls/all/')
-    r.encoding = 'gbk'
-    tree = html.fromstring(r.text)
+    # 关键词列表会更新, 每次都重新抓取
+    t = http.fetch_text(ym + '/girls/all/', headers={'Referer': ym}, encoding='gbk', cache=False)
+    tree = html.fromstring(t)
     links = tree.xpath('//div[@class="listap"]/a')
     print 'Found %s keywords' % len(links)
     ret = []
@@ -80,60 +68,87 @@ def fetch_keywords():
     return ret
 
 
-def analyze_keyword(k):
+def analyze_keywords(keywords, workers=4, checkpoint=None):
     """
-    分析站点级别的关键字, 获取其百度指数以及其相关的长尾关键字.
+    并发分析站点级别的关键字, 获取其百度指数以及其相关的长尾关键字.
+    多个线程并发抓取5118, 同一站点的请求之间间隔5-15秒, 缓存的页面不需要等待; 解析结果批量写入数据库, 中断后可以通过checkpoint继续执行.
     """
-    keyword = Keyword.find_one({'name': k})
-    if not keyword:
-        print 'Keyword %s does not exist' % k
-        return
-    if keyword.baiduIndex > 0 or keyword.baiduResult > 0:
-        print 'Keyword %s is imported before' % k
+    cursor = Keyword.find({'level': KeywordLevel.SITE, 'name': {'$in': keywords}, 'baiduIndex': 0, 'baiduResult': 0},
+                          {'name': True})
+    items = [(k._id, k.name) for k in cursor]
+    print 'Try to analyze %s keywords, %s are imported before' % (len(items), len(keywords) - len(items))
+
+    crawler = Crawler(url=lambda item: 'http://www.5118.com/seo/words/%s' % url_quote(item[1]),
+                      parse=lambda item, text: parse_5118_keywords(text),
+                      sink=save_keywords,
+                      fetch=lambda url, limiter: http.fetch_text(url, headers={'Referer': 'http://www.5118.com/'},
+                                                                 limiter=limiter),
+                      key=lambda item: item[1],
+                      workers=workers,
+                      limiter=HostRateLimiter(5, 15),
+                      checkpoint=checkpoint)
+    return crawler.run(items)
+
+
+def save_keywords(batch):
+    """
+    批量保存解析结果, 更新站点关键字的百度指数, 并插入不存在的长尾关键字.
+    """
+    ops = []
+    # {op index:parent id}, 用于统计新插入的长尾关键词
+    parents = {}
+    for (keyword_id, k), rows in batch:
+        for name, baidu_index, baidu_result in rows:
+            print 'Found keyword: %s/%s/%s' % (name, baidu_index, baidu_result)
+            if name == k:
+                update = {'baiduIndex': baidu_index, 'baiduResult': baidu_result}
+                # bulk_write不会自动递增版本号, 参考Keyword.__versioned__
+                ops.append(UpdateOne({'_id': keyword_id}, {'$set': update, '$inc': {'_v': 1}}))
+            else:
+                long_tail = Keyword()
+                long_tail.name = name
+                long_tail.level = KeywordLevel.LONG_TAIL
+                long_tail.parentId = keyword_id
+                long_tail.baiduIndex = baidu_index
+                long_tail.baiduResult = baidu_result
+                long_tail._v = 1
+                long_tail.validate()
+                # 已经存在的关键词保持不变
+                parents[len(ops)] = keyword_id
+                ops.append(UpdateOne({'name': name}, {'$setOnInsert': dict(long_tail)}, upsert=True))
+
+    if not ops:
         return
-    print 'Try to analyze keyword %s/%s' % (keyword._id, k)
-
-    ss.headers['Referer'] = 'http://www.5118.com/'
-    t = ss.get('http://www.5118.com/seo/words/%s' % url_quote(k)).text
-    tree = html.fromstring(t)
-    dls = tree.xpath('//div[@class="Fn-ui-list dig-list"]/dl')
-    total = len(dls)
-    for dl in dls:
-        if dl.get('class', '') == 'dl-word':
-            continue
-        name = unicode(dl.xpath('./dd[1]//a[1]/@title')[0].strip())
-        baidu_index = dl.xpath('./dd[2]/text()')[0].strip()
-        baidu_result = dl.xpath('./dd[3]/text()')[0].strip()
-        if not baidu_index.isdigit():
-            baidu_index = 0
-        if not baidu_result.isdigit():
-            baidu_result = 0
-        print 'Found keyword: %s/%s/%s' % (name, baidu_index, baidu_result)
-
-        if name == k:
-            keyword.baiduIndex = int(baidu_index)
-            keyword.baiduResult = int(baidu_result)
-            if total > 2:
-                keyword.total = total - 2
-            keyword.save()
-        else:
-            if Keyword.count({'name': name}) > 0:
-                print 'This keyword already exists'
-                continue
-            long_tail = Keyword()
-            long_tail.name = name
-            long_tail.level = KeywordLevel.LONG_TAIL
-            long_tail.parentId = keyword._id
-            long_tail.baiduIndex = int(baidu_index)
-            long_tail.baiduResult = int(baidu_result)
-            long_tail.save()
-
-    time.sleep(random.randint(5, 15))
+    try:
+        upserted = Keyword.bulk_write(ops, ordered=False).upserted_ids.keys()
+    except BulkWriteError as e:
+        # 并发插入同名关键词时会出现重复键错误, 可以忽略
+        errors = [err for err in e.details['writeErrors'] if err['code'] != 11000]
+        if errors:
+            raise
+        upserted = [u['index'] for u in e.details['upserted']]
+
+    # bulk_write不会触发counter_caches, 根据实际插入的长尾关键词递增站点关键词的total
+    totals = {}
+    for index in upserted:
+        totals[parents[index]] = totals.get(parents[index], 0) + 1
+    for keyword_id, n in totals.iteritems():
+        Keyword.update_one({'_id': keyword_id}, {'$inc': {'total': n}})
 
 
 if __name__ == '__main__':
     app = create_app()
     with app.app_context():
         keywords = fetch_keywords()
-        for k in keywords:
-            analyze_keyword(k)
+        if len(sys.argv) > 1 and sys.argv[1] == 'enqueue':
+            for k in keywords:
+                keyword = Keyword.find_one({'name': k})
+                if not keyword:
+                    print 'Keyword %s is not found' % k
+                    continue
+                if keyword.baiduIndex > 0 or keyword.baiduResult > 0:
+                    continue
+                enqueue('seo.analyze_keyword', keyword_id=keyword._id)
+                print 'Keyword %s is enqueued' % k
+        else:
+            analyze_keywords(keywords, checkpoint=os.path.join(app.root_path, 'logs', 'seo.checkpoint'))
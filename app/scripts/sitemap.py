@@ -7,18 +7,33 @@
 
     关于sitemap的生成请参考, http://zhanzhang.baidu.com/college/courseinfo?id=267&page=2
 
+    文章按_id升序分成多个分片, 每个分片写入static/sitemap.<index>.xml.gz, 并生成索引文件static/sitemap_index.xml.
+    分片的起始_id以及内容指纹记录在static/sitemap.manifest.json中, 重新生成时分片边界保持不变,
+    新文章追加到最后一个分片, 只有指纹发生变化的分片才会被重写.
+
+    Post开启了变更日志, manifest中同时记录了变更日志的读取进度, 再次执行时只重新扫描有新增或者删除文章的分片.
+    距离上次执行超过变更日志的保留时间时, 变更可能已经丢失, 重新扫描所有分片.
+
     执行脚本:
     export PYTHONIOENCODING=utf-8
     python2.7 sitemap.py
 
+    强制重写所有分片:
+    python2.7 sitemap.py force
+
     :copyright: (c) 2016 by fengweimin.
     :date: 16/10/14
 """
 
+import bisect
+import gzip
+import hashlib
+import json
 import os
 import sys
+from datetime import datetime, timedelta
 
-import pymongo
+from bson.objectid import ObjectId
 from flask import current_app
 from lxml import etree
 
@@ -26,71 +41,223 @@ sys.path.append(os.path.join(os.getcwd(), '../../'))
 
 from app import create_app
 from app.models import Post
+from app.mongosupport.mongosupport import CHANGELOG_TTL
+from app.tools.files import atomic_write
 
 LIMIT = 30000
 
+NS = 'http://www.sitemaps.org/schemas/sitemap/0.9'
+
+INDEX_FILE = 'sitemap_index.xml'
+MANIFEST_FILE = 'sitemap.manifest.json'
+
+# 只读取若干秒之前的变更日志, 避免遗漏其他进程正在写入的变更
+CHANGELOG_LAG = 60
+# checkpoint距今超过CHANGELOG_TTL - CHANGELOG_MARGIN秒时, 之后的变更日志可能已被删除, 需要重新生成所有分片
+CHANGELOG_MARGIN = 24 * 3600
+
 
-def generate_site_map():
+def generate_site_map(force=False):
     """
     生成站点地图, 将站点地图保存在static文件夹中.
     """
     print 'Try to generate site map ...'
 
-    domain = current_app.config['DOMAIN']
-    index = 0
-    pending = ['http://%s/' % domain]
+    manifest = _load_manifest()
+    old = {s['start']: s for s in manifest['shards']}
+    until = ObjectId.from_datetime(datetime.utcnow() - timedelta(seconds=CHANGELOG_LAG))
+
+    shards = None
+    if not force and manifest['shards'] and manifest.get('checkpoint'):
+        checkpoint = ObjectId(manifest['checkpoint'])
+        if _expired(checkpoint):
+            print 'Checkpoint %s is older than the change log, rescan all shards' % checkpoint
+        else:
+            shards = _update_shards(manifest['shards'], checkpoint, until)
+    if shards is None:
+        shards = _scan_shards([ObjectId(s['start']) for s in manifest['shards']])
+
+    written = 0
+    for index, shard in enumerate(shards):
+        shard['file'] = 'sitemap.%s.xml.gz' % index
+        prev = old.get(shard['start'])
+        if force or not prev or prev['file'] != shard['file'] or prev['fingerprint'] != shard['fingerprint']:
+            _write_shard(index, shard, shards[index + 1]['start'] if index + 1 < len(shards) else None)
+            written += 1
+
+    # 删除多余的分片文件
+    for s in manifest['shards'][len(shards):]:
+        _remove(s['file'])
+
+    _write_index(shards)
+    _save_manifest({'shards': shards, 'checkpoint': str(until)})
+    print 'Successfully generate %s shards, %s are rewritten' % (len(shards), written)
+
+
+def _expired(checkpoint):
+    age = datetime.utcnow() - checkpoint.generation_time.replace(tzinfo=None)
+    return age > timedelta(seconds=CHANGELOG_TTL - CHANGELOG_MARGIN)
+
+
+def _update_shards(shards, since, until):
+    """
+    根据变更日志只重新扫描受影响的分片, 无法增量更新时返回None.
+    """
+    starts = [ObjectId(s['start']) for s in shards]
+    affected = set()
+    for c in Post.get_changes(since, until):
+        index = bisect.bisect_right(starts, c['docId']) - 1
+        if index < 0:
+            return None
+        affected.add(index)
+    print 'Found changes in %s shards' % len(affected)
+
+    shards = list(shards)
+    # 从后往前处理, 最后一个分片可能拆分成多个
+    for index in sorted(affected, reverse=True):
+        end = starts[index + 1] if index + 1 < len(starts) else None
+        scanned = _scan_shards([starts[index]], starts[index], end)
+        if not scanned or (end and len(scanned) > 1):
+            # 分片中的文章全部被删除了, 重新生成所有分片
+            return None
+        shards[index:index + 1] = scanned
+    return shards
+
+
+def _scan_shards(starts, start=None, end=None):
+    """
+    只读取_id和createTime, 计算每个分片的起始_id/数量/最后修改时间/指纹.
+    已有分片的起始_id保持不变, 最后一个分片满了之后再创建新的分片.
+    """
+    shards = []
+    shard, sha1 = None, None
+    for p in _iterate(start, end):
+        next_start = None
+        while starts and p['_id'] >= starts[0]:
+            next_start = starts.pop(0)
+        if shard is None or next_start or (not starts and shard['count'] >= LIMIT):
+            if shard:
+                shard['fingerprint'] = sha1.hexdigest()
+                shards.append(shard)
+            # 沿用已有分片的起始_id, 保证删除文章后分片边界不变
+            start = next_start or p['_id']
+            shard, sha1 = {'start': str(start), 'count': 0, 'lastmod': None}, hashlib.sha1()
 
-    cursor_post = Post.find({}, sort=[('_id', pymongo.DESCENDING)])
-    for p in cursor_post:
-        print 'Generating post %s/%s' % (p._id, p.title)
-        pending.append('http://%s/blog/post/%s' % (domain, p._id))
-        if len(pending) >= LIMIT:
-            write_site_map(index, pending)
-            index += 1
-            del pending[:]
+        lastmod = p['createTime'].strftime('%Y-%m-%d')
+        shard['count'] += 1
+        shard['lastmod'] = max(shard['lastmod'], lastmod)
+        sha1.update('%s %s\n' % (p['_id'], lastmod))
 
-    if len(pending) > 0:
-        write_site_map(index, pending)
+    if shard:
+        shard['fingerprint'] = sha1.hexdigest()
+        shards.append(shard)
+    return shards
 
 
-def write_site_map(index, urls):
-    _write_site_map_txt(index, urls)
+def _iterate(start, end):
+    """
+    按_id升序读取区间内文章的_id和createTime, 游标超时或者网络错误时从最后读取的_id继续.
+    """
+    return Post.iterate(_range(start, end), projection={'_id': True, 'createTime': True}, batch_size=1000)
+
 
+def _range(start, end):
+    filter = {}
+    if start:
+        filter['_id'] = {'$gte': ObjectId(start)}
+    if end:
+        filter.setdefault('_id', {})['$lt'] = ObjectId(end)
+    return filter
 
-def _write_site_map_txt(index, urls):
+
+def _write_shard(index, shard, end):
     """
-    生成txt格式的sitemap.
+    使用etree.xmlfile增量写入gzip压缩的xml.
     """
-    site_map_file = os.path.join(current_app.root_path, 'static', 'sitemap.%s.txt' % index)
-    with open(site_map_file, 'w') as f:
-        for u in urls:
-            f.write(u + '\n')
-    print 'Successfully write sitemap file %s' % site_map_file
+    domain = current_app.config['DOMAIN']
+
+    def write(f):
+        with etree.xmlfile(f, encoding='utf-8') as xf:
+            xf.write_declaration()
+            with xf.element('urlset', xmlns=NS):
+                if index == 0:
+                    _write_url(xf, 'http://%s/' % domain)
+                for p in _iterate(shard['start'], end):
+                    _write_url(xf, 'http://%s/blog/post/%s' % (domain, p['_id']), p['createTime'].strftime('%Y-%m-%d'))
+
+    _atomic_write(shard['file'], write, compress=True)
+    print 'Successfully write sitemap file %s with %s posts' % (shard['file'], shard['count'])
+
+
+def _write_url(xf, loc, lastmod=None):
+    with xf.element('url'):
+        with xf.element('loc'):
+            xf.write(loc)
+        if lastmod:
+            with xf.element('lastmod'):
+                xf.write(lastmod)
+
+
+def _write_index(shards):
+    domain = current_app.config['DOMAIN']
+
+    def write(f):
+        with etree.xmlfile(f, encoding='utf-8') as xf:
+            xf.write_declaration()
+            with xf.element('sitemapindex', xmlns=NS):
+                for s in shards:
+                    with xf.element('sitemap'):
+                        with xf.element('loc'):
+                            xf.write('http://%s/static/%s' % (domain, s['file']))
+                        with xf.element('lastmod'):
+                            xf.write(s['lastmod'])
+
+    _atomic_write(INDEX_FILE, write)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Files
+#
+
+def _static_path(name):
+    return os.path.join(current_app.root_path, 'static', name)
 
 
-def _write_site_map_xml(index, urls):
+def _atomic_write(name, write, compress=False):
     """
-    生成xml格式的sitemap.
+    先写入临时文件再重命名, 避免搜索引擎读到不完整的文件.
     """
-    site_map_file = os.path.join(current_app.root_path, 'static', 'sitemap.%s.xml' % index)
-    urlset = etree.Element('urlset')
-    for u in urls:
-        url = etree.Element('url')
-        loc = etree.Element('loc')
-        loc.text = u
-        lastmod = etree.Element('lastmod')
-        lastmod.text = '2016-10-18'
-        url.append(loc)
-        url.append(lastmod)
-        urlset.append(url)
+    def write_file(f):
+        if compress:
+            # 固定mtime, 内容不变时压缩结果也不变
+            with gzip.GzipFile(filename='', mode='wb', fileobj=f, mtime=0) as gz:
+                write(gz)
+        else:
+            write(f)
+
+    atomic_write(_static_path(name), write_file)
+
+
+def _remove(name):
+    path = _static_path(name)
+    if os.path.exists(path):
+        os.remove(path)
+        print 'Remove sitemap file %s' % name
+
+
+def _load_manifest():
+    try:
+        with open(_static_path(MANIFEST_FILE)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {'shards': []}
 
-    et = etree.ElementTree(urlset)
-    et.write(site_map_file, pretty_print=True)
 
-    print 'Successfully write sitemap file %s' % site_map_file
+def _save_manifest(manifest):
+    _atomic_write(MANIFEST_FILE, lambda f: json.dump(manifest, f, indent=2))
 
 
 if __name__ == '__main__':
     app = create_app()
     with app.app_context():
-        generate_site_map()
+        generate_site_map(force=len(sys.argv) > 1 and sys.argv[1] == 'force')
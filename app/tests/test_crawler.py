@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+    test_crawler
+    ~~~~~~~~~~~~~~
+
+    Test cases for crawler, pages are served from saved fixtures by a local http server.
+
+    :copyright: (c) 2026 by flask-boot contributors.
+    :date: 2026/10/18
+"""
+
+import os
+import threading
+import time
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+from app.tools.crawler import Crawler, HostRateLimiter, parse_5118_keywords
+from app.tools.httpclient import HttpClient
+
+FIXTURE = os.path.join(os.path.dirname(__file__), 'fixtures', '5118.html')
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    requests = []
+
+    def do_GET(self):
+        FixtureHandler.requests.append(self.headers.get('If-None-Match'))
+        if self.headers.get('If-None-Match') == '"5118"':
+            self.send_response(304)
+            self.end_headers()
+            return
+        with open(FIXTURE) as f:
+            body = f.read()
+        self.send_response(200)
+        self.send_header('ETag', '"5118"')
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    s = HTTPServer(('127.0.0.1', 0), FixtureHandler)
+    t = threading.Thread(target=s.serve_forever)
+    t.setDaemon(True)
+    t.start()
+    yield 'http://127.0.0.1:%s' % s.server_port
+    s.shutdown()
+
+
+def test_parse_5118_keywords():
+    with open(FIXTURE) as f:
+        rows = parse_5118_keywords(f.read().decode('utf-8'))
+    assert rows == [(u'美女', 12345, 100000000), (u'美女图片', 2345, 9800000), (u'美女壁纸', 0, 560000)]
+
+
+def test_crawler(server, tmpdir):
+    checkpoint = str(tmpdir.join('checkpoint'))
+    written = []
+
+    def crawl(items):
+        crawler = Crawler(url=lambda item: '%s/seo/words/%s' % (server, item),
+                          parse=lambda item, text: parse_5118_keywords(text),
+                          sink=written.extend,
+                          workers=3,
+                          limiter=HostRateLimiter(0, 0),
+                          batch_size=2,
+                          checkpoint=checkpoint)
+        return crawler.run(items)
+
+    stats = crawl(['a', 'b', 'c'])
+    assert stats['written'] == 3 and stats['failed'] == 0
+    assert sorted(item for item, _ in written) == ['a', 'b', 'c']
+    assert all(len(rows) == 3 for _, rows in written)
+
+    # 已经处理过的条目会被跳过
+    stats = crawl(['a', 'b', 'c', 'd'])
+    assert stats['skipped'] == 3 and stats['written'] == 1
+    assert written[-1][0] == 'd'
+
+
+def test_fetch_text(server, tmpdir):
+    client = HttpClient(max_retries=0, cache_dir=str(tmpdir), cache_ttl=60)
+    del FixtureHandler.requests[:]
+
+    text = client.fetch_text(server + '/seo/words/a')
+    assert len(parse_5118_keywords(text)) == 3
+    # 缓存有效期内不会发送请求
+    assert client.fetch_text(server + '/seo/words/a') == text
+    assert FixtureHandler.requests == [None]
+
+    # 过期后发送条件请求, 304时使用缓存
+    client.cache_ttl = 0
+    assert client.fetch_text(server + '/seo/words/a') == text
+    assert FixtureHandler.requests == [None, '"5118"']
+
+    # 缓存的内容文件被删除时发送普通请求
+    os.remove(client._cache_path(server + '/seo/words/a'))
+    assert client.fetch_text(server + '/seo/words/a') == text
+    assert FixtureHandler.requests == [None, '"5118"', None]
+
+
+def test_fetch_text_limiter(server, tmpdir):
+    class Limiter(object):
+        hosts = []
+
+        def wait(self, host):
+            self.hosts.append(host)
+
+    client = HttpClient(max_retries=0, cache_dir=str(tmpdir), cache_ttl=60)
+    limiter = Limiter()
+    client.fetch_text(server + '/seo/words/a', limiter=limiter)
+    assert len(limiter.hosts) == 1
+    # 从缓存读取时不需要等待
+    client.fetch_text(server + '/seo/words/a', limiter=limiter)
+    assert len(limiter.hosts) == 1
+
+
+def test_prune_cache(server, tmpdir):
+    client = HttpClient(max_retries=0, cache_dir=str(tmpdir), cache_ttl=60)
+    urls = [server + '/seo/words/%s' % c for c in 'abc']
+    for i, url in enumerate(urls):
+        client.fetch_text(url)
+        path = client._cache_path(url)
+        mtime = time.time() - 300 + i
+        os.utime(path + '.json', (mtime, mtime))
+    assert client.prune_cache() == 0
+
+    # 总大小超过上限时从最久未更新的缓存开始删除
+    client.cache_max_size = os.path.getsize(client._cache_path(urls[0])) * 2 + 1000
+    assert client.prune_cache() == 1
+    assert client._load_meta(client._cache_path(urls[0])) is None
+    assert not os.path.exists(client._cache_path(urls[0]))
+
+    # 超过cache_max_age未更新的缓存都会被删除
+    client.cache_max_age = 60
+    assert client.prune_cache() == 2
+    assert all(client._load_meta(client._cache_path(url)) is None for url in urls)
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+    test_executor
+    ~~~~~~~~~~~~~~
+
+    Test cases for the bounded task executor.
+
+    :copyright: (c) 2026 by flask-boot contributors.
+    :date: 2026/10/19
+"""
+
+import logging
+import threading
+
+from app.tools.executor import TaskExecutor
+
+
+class RecordingHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+def _executor(**kwargs):
+    e = TaskExecutor(**kwargs)
+    e.logger = logging.getLogger('test_executor')
+    e.logger.propagate = False
+    handler = RecordingHandler()
+    e.logger.addHandler(handler)
+    return e, handler
+
+
+def test_backpressure():
+    e, _ = _executor(max_workers=1, queue_size=1, queue_timeout=0.05)
+    release = threading.Event()
+
+    def block():
+        release.wait(5)
+        return 1
+
+    running = e.submit(block)
+    queued = e.submit(block)
+    # 线程池和队列都已满, 等待超时后放弃
+    assert e.submit(block) is None
+    assert e.stats()['block']['rejected'] == 1
+
+    release.set()
+    assert running.result(5) == 1 and queued.result(5) == 1
+    e.shutdown()
+    stats = e.stats()['block']
+    assert stats['submitted'] == 2 and stats['completed'] == 2 and stats['running'] == 0 and e._pending == 0
+
+
+def test_failure():
+    e, handler = _executor(max_workers=2)
+
+    def fail():
+        raise ValueError('boom')
+
+    future = e.submit(fail)
+    assert isinstance(future.exception(5), ValueError)
+    e.shutdown()
+    assert e.stats()['fail']['failed'] == 1
+    # 失败的任务记录错误日志, 包含任务中的traceback
+    record = [r for r in handler.records if r.levelno == logging.ERROR][0]
+    assert record.exc_info[0] is ValueError and record.exc_info[2] is not None
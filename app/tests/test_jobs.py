@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+    test_jobs
+    ~~~~~~~~~~~~~~
+
+    Test cases for the durable job queue, database operations are recorded instead of being executed.
+
+    :copyright: (c) 2026 by flask-boot contributors.
+    :date: 2026/10/19
+"""
+
+import logging
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from bson.objectid import ObjectId
+
+from app import jobs
+from app.models import Job, JobStatus
+
+
+class FakeApp(object):
+    logger = logging.getLogger('test_jobs')
+
+    @contextmanager
+    def app_context(self):
+        yield
+
+
+class UpdateResult(object):
+    matched_count = 1
+
+
+def _record_updates(monkeypatch):
+    updates = []
+
+    def update_one(cls, filter, update, **kwargs):
+        updates.append((filter, update))
+        return UpdateResult()
+
+    monkeypatch.setattr(Job, 'update_one', classmethod(update_one))
+    return updates
+
+
+def _job(name, attempts=1):
+    return Job({'_id': ObjectId(), 'name': unicode(name), 'params': u'{"n": 1}', 'status': JobStatus.RUNNING,
+                'attempts': attempts, 'maxAttempts': 3})
+
+
+def test_claim_job(monkeypatch):
+    calls = []
+    monkeypatch.setattr(Job, 'find_one_and_update', classmethod(lambda cls, *args, **kwargs: calls.append(args)))
+    monkeypatch.setitem(jobs.job_handlers, 'test.claim', (None, 300))
+
+    jobs.claim_job(u'w1', ['test.claim'])
+    condition, update = calls[0]
+    # 可以领取等待执行的任务以及租约已经过期的任务
+    assert condition['name'] == {'$in': ['test.claim']}
+    assert [c['status'] for c in condition['$or']] == [JobStatus.PENDING, JobStatus.RUNNING]
+    assert update['$set']['worker'] == u'w1' and update['$set']['status'] == JobStatus.RUNNING
+    assert update['$set']['leaseExpire'] > datetime.now() and update['$inc'] == {'attempts': 1}
+
+
+def test_heartbeat(monkeypatch):
+    updates = _record_updates(monkeypatch)
+    params = []
+    monkeypatch.setitem(jobs.job_handlers, 'test.slow', (lambda app, n: params.append(n) or time.sleep(0.5), 0.3))
+
+    j = _job('test.slow')
+    jobs.run_job(FakeApp(), j, u'w1')
+    assert params == [1]
+    # 执行期间持续续约, 只有持有租约的worker才能续约
+    renewals = [f for f, u in updates if 'leaseExpire' in u['$set']]
+    assert len(renewals) >= 3
+    assert all(f == {'_id': j._id, 'worker': u'w1', 'status': JobStatus.RUNNING} for f in renewals)
+    assert updates[-1] == ({'_id': j._id, 'worker': u'w1'},
+                           {'$set': {'status': JobStatus.DONE, 'updateTime': updates[-1][1]['$set']['updateTime']}})
+
+    # 结束之后不再续约
+    count = len(updates)
+    time.sleep(0.2)
+    assert len(updates) == count
+
+
+def test_failure(monkeypatch):
+    updates = _record_updates(monkeypatch)
+
+    def fail(app, n):
+        raise ValueError('boom')
+
+    monkeypatch.setitem(jobs.job_handlers, 'test.fail', (fail, 300))
+
+    # 没有超过最大次数时退避后重试
+    jobs.run_job(FakeApp(), _job('test.fail', 1), u'w1')
+    update = updates[-1][1]['$set']
+    assert update['status'] == JobStatus.PENDING and 'ValueError' in update['error'] and update['runAfter']
+
+    jobs.run_job(FakeApp(), _job('test.fail', 3), u'w1')
+    assert updates[-1][1]['$set']['status'] == JobStatus.FAILED
+
+    # 租约过期被重新领取的次数超过最大次数时不再执行
+    del updates[:]
+    jobs.run_job(FakeApp(), _job('test.fail', 4), u'w1')
+    assert len(updates) == 1 and updates[0][1]['$set']['status'] == JobStatus.FAILED
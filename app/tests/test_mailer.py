@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+    test_mailer
+    ~~~~~~~~~~~~~~
+
+    Test cases for mail dispatcher, emails are sent through a fake smtp connection.
+
+    :copyright: (c) 2026 by flask-boot contributors.
+    :date: 2026/10/19
+"""
+
+import logging
+import time
+from contextlib import contextmanager
+
+from app.tools.mailer import MailDispatcher
+
+
+class FakeApp(object):
+    def __init__(self, **config):
+        self.config = dict({'MAIL_WORKERS': 1, 'MAIL_RETRY_BACKOFF': 0, 'MAIL_MAX_RETRIES': 2}, **config)
+        self.logger = logging.getLogger('test_mailer')
+
+    @contextmanager
+    def app_context(self):
+        yield
+
+
+class Message(object):
+    def __init__(self, subject, body=u'', recipients=None):
+        self.subject = subject
+        self.body = body
+        self.recipients = recipients or [u'admin@test.com']
+
+
+class FakeMail(object):
+    """
+    记录发出的邮件, failures为{主题:失败次数}.
+    """
+
+    def __init__(self, failures=None):
+        self.failures = dict(failures or {})
+        self.sent = []
+
+    @contextmanager
+    def connect(self):
+        yield self
+
+    def send(self, msg):
+        if self.failures.get(msg.subject, 0) > 0:
+            self.failures[msg.subject] -= 1
+            raise IOError('smtp error')
+        self.sent.append(msg.subject)
+
+
+def _dispatcher(mail, **config):
+    d = MailDispatcher(mail)
+    d.app = FakeApp(**config)
+    return d
+
+
+def test_coalesce():
+    d = _dispatcher(FakeMail())
+    batch = [(Message(u'error', u'a'), True, 0), (Message(u'order'), False, 0), (Message(u'error', u'b'), True, 0),
+             (Message(u'error', u'c', [u'other@test.com']), True, 0)]
+    merged = d._coalesce(batch)
+    # 只合并主题和收件人都相同的支持邮件, 业务邮件保持不变
+    assert [m.subject for m, _, _ in merged] == [u'error', u'order', u'error']
+    assert merged[0][0].body == u'a\n\nb'
+
+
+def test_retry_unsent():
+    mail = FakeMail({u'b': 1})
+    d = _dispatcher(mail)
+    d._send_batch([(Message(u'a'), False, 0), (Message(u'b'), False, 0), (Message(u'c'), True, 0)])
+    assert mail.sent == [u'a']
+    # 失败的邮件以及剩余的邮件都加入重试列表, 重试次数加1
+    retries = d._due_retries(10)
+    assert sorted((m.subject, attempts) for m, _, attempts in retries) == [(u'b', 1), (u'c', 1)]
+
+    d._send_batch(retries)
+    assert sorted(mail.sent) == [u'a', u'b', u'c'] and d.retries == []
+
+    # 超过最大重试次数后放弃
+    mail.failures[u'd'] = 10
+    d._send_batch([(Message(u'd'), False, 2)])
+    assert d.retries == []
+
+
+def test_stop_flushes_retries():
+    mail = FakeMail({u'a': 1})
+    d = _dispatcher(mail, MAIL_RETRY_BACKOFF=60)
+    d._send_batch([(Message(u'a'), False, 0)])
+    # 还没有到期, 停止时不再等待直接发送
+    assert d._due_retries(10) == [] and len(d.retries) == 1
+    d.stop()
+    assert mail.sent == [u'a'] and d.retries == []
+
+
+def test_workers():
+    mail = FakeMail({u'b': 2})
+    d = MailDispatcher(mail)
+    app = FakeApp()
+    for subject in [u'a', u'b', u'c']:
+        d.send(app, Message(subject))
+
+    deadline = time.time() + 5
+    while len(mail.sent) < 3 and time.time() < deadline:
+        time.sleep(0.01)
+    d.stop()
+    assert sorted(mail.sent) == [u'a', u'b', u'c']
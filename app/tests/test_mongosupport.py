@@ -0,0 +1,554 @@
+# -*- coding: utf-8 -*-
+"""
+    test_mongosupport
+    ~~~~~~~~~~~~~~
+
+    Test cases for mongosupport.
+
+    :copyright: (c) 2026 by flask-boot contributors.
+    :date: 2026/10/18
+"""
+
+import copy
+import pickle
+import sys
+import traceback
+from collections import MutableMapping, MutableSequence
+from datetime import datetime
+
+from bson import BSON
+from bson.objectid import ObjectId
+from pymongo.errors import CursorNotFound
+
+from app.mongosupport import Model, DataError, StructureError, ConflictError, convert_from_string, changed_paths, \
+    post_save, post_bulk_update, Pipeline, Query, QueryCache
+from app.mongosupport import mongosupport
+from app.mongosupport.mongosupport import DATETIME_FORMATS, FieldDescriptor, parse_datetime
+
+
+class FakeCollection(object):
+    """
+    记录调用的方法, 不访问数据库.
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.calls.append((name, args, kwargs))
+
+
+class Signaled(Model):
+    __collection__ = 'signaled'
+    structure = {
+        'name': unicode,
+        'views': int,
+        'entries': [{
+            'id': int,
+            'tags': [unicode],
+        }],
+    }
+    collection = FakeCollection()
+
+
+def test_parse_datetime():
+    dt = datetime(2016, 5, 3, 8, 9, 10, 123000)
+    for fmt in DATETIME_FORMATS:
+        value = unicode(dt.strftime(fmt))
+        expected = datetime.strptime(value, fmt)
+        # 第一次猜测格式, 第二次使用缓存的格式
+        assert parse_datetime(value, ('Test', fmt)) == expected
+        assert parse_datetime(value, ('Test', fmt)) == expected
+        assert convert_from_string(value, datetime) == expected
+    # 未补零的写法由strptime处理
+    assert parse_datetime(u'2016-5-3') == datetime(2016, 5, 3)
+    for value in [u'2016-05-03 ', u'2016-13-03', u'20160503']:
+        try:
+            parse_datetime(value)
+            assert False
+        except ValueError:
+            pass
+
+
+def test_changed_paths():
+    assert changed_paths({'$set': {'a.b': 1}, '$inc': {'c': 1}}) == ['a.b', 'c']
+    assert changed_paths({'$rename': {'a': 'b'}}) == ['a', 'b']
+    assert changed_paths({'name': u'x', '_id': 1}) == ['_id', 'name']
+
+
+def test_proxy():
+    s = Signaled({'entries': [{'id': 1, 'tags': [u'a']}]})
+    entries = s.entries
+    assert isinstance(entries, MutableSequence) and isinstance(entries[0], MutableMapping)
+    assert not hasattr(entries, '__dict__') and not hasattr(entries[0], '__dict__')
+
+    # 重复访问时复用代理对象, 重新赋值之后重新创建
+    assert s.entries is entries and entries[0] is list(entries)[0]
+    assert entries[0].tags is entries[0].tags
+    entries[0] = {'id': 2}
+    assert entries[0].id == 2 and entries[0].get('tags') is None
+    s.entries = [{'id': 3}]
+    assert s.entries is not entries and [e.id for e in s.entries] == [3]
+
+    # 字段通过元类生成的描述符访问, 子类可以重新定义同名字段
+    assert isinstance(Signaled.name, FieldDescriptor) and 'validation_errors' in s.__dict__
+    s.name = u'x'
+    del s.views
+    assert s['name'] == u'x' and 'views' not in s
+    sub = type('Sub', (Signaled,), {'structure': {'name': int}})({'name': 1})
+    assert sub.name == 1 and 'name' not in Signaled._protected_field_names
+
+    # 抽象类中的方法仍然可用
+    s.entries.append({'id': 4})
+    s.entries[0].update(tags=[u'b'])
+    assert len(s.entries) == 2 and sorted(s.entries[0].keys()) == ['id', 'tags'] and u'b' in s.entries[0].tags
+
+
+class Defaulted(Model):
+    __collection__ = 'defaulted'
+    structure = {
+        'name': unicode,
+        'tags': [unicode],
+        'time': datetime,
+        'meta': {
+            'views': int,
+            'extra': {'source': unicode},
+        },
+    }
+    default_values = {'tags': [u'a'], 'time': datetime.now, 'meta.views': 0, 'meta.extra': {'source': u'web'}}
+
+
+def test_default_values():
+    nested = sorted(step[:2] for step in Defaulted._default_plan if step[0])
+    assert nested == [(('meta',), 'extra'), (('meta',), 'views')]
+    # 存在嵌套字段的默认值, 不能根据顶层字段跳过
+    assert Defaulted._default_roots is None
+
+    d = Defaulted()
+    assert d['tags'] == [u'a'] and d.meta.views == 0 and d.meta.extra.source == u'web' and isinstance(d.time, datetime)
+    # 可变的默认值每次都会复制
+    d.tags.append(u'b')
+    d.meta.extra.source = u'app'
+    assert Defaulted()['tags'] == [u'a'] and Defaulted().meta.extra.source == u'web'
+
+    # 已经存在的字段保持不变, 缺少的嵌套字段会被补上
+    d = Defaulted({'tags': [], 'meta': {'views': 3}})
+    assert d['tags'] == [] and d['meta'] == {'views': 3, 'extra': {'source': u'web'}}
+
+    # 从数据库加载的文档同样按路径补上缺少的默认值
+    d = Defaulted._from_db({'tags': [], 'time': None, 'meta': {}})
+    assert d['meta'] == {'views': 0, 'extra': {'source': u'web'}} and d['time'] is None
+    assert Defaulted._from_db({'name': u'x'})['meta']['views'] == 0
+
+    # 没有定义default_values的子类使用父类的default_values
+    Inherited = type('Inherited', (Defaulted,), {'structure': {'name': unicode, 'tags': [unicode]}})
+    assert Inherited()['tags'] == [u'a'] and Inherited._default_roots == {'tags'}
+    assert Inherited._from_db({'tags': []})['tags'] == [] and Inherited._from_db({})['tags'] == [u'a']
+
+
+def test_get_many(monkeypatch):
+    ids = [ObjectId() for _ in range(5)]
+    queries = []
+
+    def find(cls, filter, *args, **kwargs):
+        queries.append(filter['_id']['$in'])
+        return [cls({'_id': id}) for id in filter['_id']['$in'] if id != ids[3]]
+
+    monkeypatch.setattr(Signaled, 'find', classmethod(find))
+    cache = {ids[0]: Signaled({'_id': ids[0], 'name': u'cached'})}
+    lookup = [ids[4], ids[0], ids[3], ids[1], ids[4], ids[2]]
+
+    # 缓存中的id不再查询, 重复的id只查询一次
+    docs = Signaled.get_many(lookup, cache=cache, chunk_size=2)
+    assert [d._id for d in docs] == [ids[4], ids[0], ids[1], ids[4], ids[2]] and docs[1].name == u'cached'
+    assert sorted(sum(queries, [])) == sorted([ids[4], ids[3], ids[1], ids[2]]) and len(queries) == 2
+    assert set(cache) == set(ids) - {ids[3]}
+
+    assert [d and d._id for d in Signaled.get_many(lookup, missing='none', cache=cache)][2:4] == [None, ids[1]]
+    try:
+        Signaled.get_many(lookup, missing='raise', cache=cache)
+        assert False
+    except DataError:
+        pass
+
+
+def test_signals():
+    received = []
+
+    def receiver(sender, **kwargs):
+        received.append((sender, kwargs))
+
+    with post_save.connected_to(receiver, sender=Signaled), post_bulk_update.connected_to(receiver):
+        Signaled({'name': u'x'}).save()
+        Signaled.update_many({}, {'$inc': {'views': 1}})
+
+    assert [c[0] for c in Signaled.collection.calls] == ['insert_one', 'update_many']
+    assert received[0][0] is Signaled and received[0][1]['created'] and 'changed' not in received[0][1]
+    assert received[1][1]['changed'] == ['views'] and received[1][1]['many'] and received[1][1]['result'] is None
+
+    # 断开后不再接收
+    Signaled.update_one({}, {'$set': {'name': u'y'}})
+    assert len(received) == 2
+
+
+def test_push():
+    Signaled.collection.calls = []
+    Signaled.push(1, 'entries', {'id': 1, 'tags': [u'a']}, position=0)
+    Signaled.push({'_id': 1}, 'entries.$[i].tags', u'b', array_filters=[{'i.id': 1}], update={'$inc': {'views': 1}})
+    assert [c[1] for c in Signaled.collection.calls] == [
+        ({'_id': 1}, {'$push': {'entries': {'$each': [{'id': 1, 'tags': [u'a']}], '$position': 0}}}),
+        ({'_id': 1}, {'$push': {'entries.$[i].tags': u'b'}, '$inc': {'views': 1}}),
+    ]
+    assert Signaled.collection.calls[1][2]['array_filters'] == [{'i.id': 1}]
+
+    # 只校验添加的元素
+    for path, value in [('entries', {'id': u'1'}), ('entries.$.tags', 1), ('name', u'x'), ('entries.$.unknown', 1)]:
+        try:
+            Signaled.push(1, path, value)
+            assert False
+        except (DataError, StructureError):
+            pass
+
+
+def test_validate_update():
+    Signaled._validate_update({'$set': {'name': u'x', 'entries.0.tags': [u'a'], 'entries.$[e].id': 1},
+                               '$inc': {'views': 1}, '$unset': {'entries.$.tags': ''},
+                               '$push': {'entries.$.tags': {'$each': [u'a', u'b']}},
+                               '$addToSet': {'entries': {'id': 1}}})
+    for update in [{'$set': {'name': 1}}, {'$set': {'unknown': 1}}, {'$inc': {'name': 1}}, {'$inc': {'views': u'1'}},
+                   {'$push': {'name': u'x'}}, {'$push': {'entries.0.tags': {'$each': [1]}}}, {'$unset': {'name.0': ''}},
+                   {'name': u'x'}]:
+        try:
+            Signaled._validate_update(update)
+            assert False
+        except (DataError, StructureError):
+            pass
+
+    # 只有指定validate=True时才校验
+    Signaled.update_one({}, {'$set': {'name': 1}})
+    try:
+        Signaled.update_many({}, {'$set': {'name': 1}}, validate=True)
+        assert False
+    except DataError:
+        pass
+    try:
+        Signaled.insert_one({'name': 1}, validate=True)
+        assert False
+    except DataError:
+        pass
+
+
+def test_query():
+    q = Signaled.q
+    oid = ObjectId()
+    query = (q.views == 3) & q.entries.tags.in_(('a',)) & (q['entries.$.id'] > 1L) & (q.entries.id < 5)
+    assert query == {'views': 3, 'entries.tags': {'$in': ['a']}, 'entries.id': {'$gt': 1, '$lt': 5}}
+    assert (q._id == oid) == {'_id': oid}
+
+    # 字段顺序不影响规范化表示
+    assert query.key == Query(reversed(query.items())).key
+    assert ((q.name == u'x') | (q.name == u'y') | q.views.exists()) == {
+        '$or': [{'name': u'x'}, {'name': u'y'}, {'views': {'$exists': True}}]}
+    assert ((q.views == 1) & (q.views == 2)) == {'$and': [{'views': 1}, {'views': 2}]}
+    assert (Query() & (q.name == u'x')) == {'name': u'x'} and (Query() | (q.name == u'x')) == {}
+
+    # 不做类型转换, 类型不一致或者in_/nin_的参数不是列表时触发异常
+    for f in [lambda: q.unknown == 1, lambda: q.views == u'3', lambda: q.views == True, lambda: q._id == str(oid),
+              lambda: q.entries.id.in_([u'1']), lambda: q.entries.tags.in_(u'a'), lambda: q.views.nin_({'a': 1})]:
+        try:
+            f()
+            assert False
+        except (DataError, StructureError):
+            pass
+
+
+def test_query_cache(monkeypatch):
+    cache = QueryCache(max_size=2)
+    cache.set('a', 1)
+    cache.set('b', 2, timeout=-1)
+    assert cache.get('a') == 1 and cache.get('b') is None
+    cache.set('c', 3)
+    cache.get('a')
+    # 超出大小时淘汰最久没有使用的
+    cache.set('d', 4)
+    assert cache.get('c') is None and cache.get('a') == 1 and cache.get('d') == 4
+
+    queries = []
+
+    def find(filter, projection, skip=0, limit=0, sort=None):
+        queries.append((filter, skip, limit, sort))
+        return iter([{'_id': 1, 'name': u'x'}])
+
+    monkeypatch.setattr(Signaled.collection, 'find', find)
+    docs = Signaled.cached_find({'name': u'x'}, sort=[('views', -1)], limit=10)
+    docs[0].name = u'changed'
+    # 命中缓存时不再查询, 返回的是副本
+    assert Signaled.cached_find({'name': u'x'}, sort=[('views', -1)], limit=10)[0].name == u'x' and len(queries) == 1
+    assert Signaled.cached_find({'name': u'x'}, skip=10, sort=[('views', -1)], limit=10) and len(queries) == 2
+    assert queries[-1] == ({'name': u'x'}, 10, 10, [('views', -1)])
+
+    # 写入之后缓存失效
+    Signaled.update_one({}, {'$set': {'name': u'y'}})
+    assert Signaled.cached_find({'name': u'x'}, sort=[('views', -1)], limit=10) and len(queries) == 3
+
+    # 写入版本号保存在缓存中, 不会被淘汰; 不存在key时inc失败的缓存(如memcached)直接设置新的版本号
+    cache.inc('version')
+    cache.set('e', 5)
+    cache.set('f', 6)
+    assert cache.get('version') == 1
+
+    class Memcached(QueryCache):
+        def inc(self, key, delta=1):
+            return None
+
+    monkeypatch.setattr(mongosupport, '_query_cache', Memcached())
+    prefix = Signaled._cache_prefix()
+    Signaled.update_one({}, {'$set': {'name': u'z'}})
+    assert Signaled._cache_prefix() != prefix
+
+
+def test_iterate(monkeypatch):
+    docs = [{'_id': i} for i in range(5)]
+    queries = []
+
+    class Cursor(object):
+        def __init__(self, filter):
+            self.filter = filter
+
+        def __iter__(self):
+            f = self.filter['$and'][1] if '$and' in self.filter else self.filter
+            last = f.get('_id', {}).get('$gt', -1)
+            for d in docs:
+                if d['_id'] > last:
+                    yield d
+                    # 第一次查询读取两条之后游标失效
+                    if len(queries) == 1 and d['_id'] == 1:
+                        raise CursorNotFound('cursor id not found')
+
+        def close(self):
+            pass
+
+    def find(filter, projection, **kwargs):
+        queries.append(filter)
+        return Cursor(filter)
+
+    monkeypatch.setattr(Signaled, 'find', staticmethod(find))
+    monkeypatch.setattr(mongosupport, 'ITERATE_RETRY_DELAY', 0)
+    progress = []
+    assert [d['_id'] for d in Signaled.iterate({'name': u'x'}, batch_size=2, progress=lambda *a: progress.append(a))] \
+        == range(5)
+    assert queries == [{'name': u'x'}, {'name': u'x', '_id': {'$gt': 1}}]
+    assert progress == [(2, 1), (4, 3), (5, 4)]
+
+    del queries[:]
+    assert [d['_id'] for d in Signaled.iterate({'_id': {'$lt': 4}}, resume_after_id=2)] == [3, 4]
+    assert queries == [{'$and': [{'_id': {'$lt': 4}}, {'_id': {'$gt': 2}}]}]
+
+
+def test_parallel_scan(monkeypatch, tmpdir):
+    docs = [{'_id': i} for i in range(10)]
+
+    class Cursor(list):
+        def close(self):
+            pass
+
+    monkeypatch.setattr(Signaled, 'aggregate', classmethod(lambda cls, pipeline: iter(docs)))
+
+    def find(filter, projection, **kwargs):
+        bounds = filter['_id']
+        return Cursor([d for d in docs if bounds.get('$gte', -1) <= d['_id'] < bounds.get('$lt', 10)])
+
+    monkeypatch.setattr(Signaled, 'find', staticmethod(find))
+    assert Signaled._scan_boundaries(3) == [3, 6]
+    assert Signaled.parallel_scan(3, lambda it: [d['_id'] for d in it]) == [[0, 1, 2], [3, 4, 5], [6, 7, 8, 9]]
+    assert Signaled.parallel_scan(3, lambda it: sum(d['_id'] for d in it), reducer=lambda a, b: a + b) == 45
+
+    # 失败的区间重新执行时只处理该区间
+    checkpoint = str(tmpdir.join('scan.json'))
+    scanned = []
+
+    def fail(it):
+        ids = [d['_id'] for d in it]
+        scanned.append(ids[0])
+        if ids[0] == 3 and len(scanned) < 4:
+            raise ValueError(ids)
+        return len(ids)
+
+    try:
+        Signaled.parallel_scan(3, fail, checkpoint=checkpoint)
+        assert False
+    except ValueError:
+        # 保留worker中的traceback
+        assert traceback.extract_tb(sys.exc_info()[2])[-1][2] == 'fail'
+    assert Signaled.parallel_scan(3, fail, checkpoint=checkpoint) == [3, 3, 4]
+    assert sorted(scanned) == [0, 3, 3, 6]
+
+
+def test_serialization():
+    doc = {'_id': ObjectId(), 'name': u'x', 'views': 1, 'entries': [{'id': 1, 'tags': [u'a']}]}
+    s = Signaled(doc)
+    s.validation_errors['name'] = [DataError('x')]
+    s.entries[0].tags.append(u'b')
+
+    for protocol in [0, pickle.HIGHEST_PROTOCOL]:
+        data = pickle.dumps(s, protocol)
+        # 不包含validation_errors以及缓存的代理对象
+        assert 'validation_errors' not in data and 'Proxy' not in data
+        loaded = pickle.loads(data)
+        assert type(loaded) is Signaled and loaded == s and loaded.validation_errors == {}
+        proxy = pickle.loads(pickle.dumps(s.entries, protocol))
+        assert proxy[0].tags[1] == u'b'
+
+    formats = ['bson'] + (['msgpack'] if mongosupport.msgpack else [])
+    s['createTime'] = datetime(2016, 5, 3, 8, 9, 10, 123000)
+    for format in formats:
+        loaded = Model.from_bytes(s.to_bytes(format), format)
+        assert type(loaded) is Signaled and loaded == s
+    try:
+        Versioned.from_bytes(s.to_bytes())
+        assert False
+    except DataError:
+        pass
+    # 类路径不是数据模型时不会构造对象, 也不会被缓存
+    for path in ['collections:OrderedDict', 'os:system', 'app.unknown:Model', 'Signaled']:
+        try:
+            Model.from_bytes(BSON.encode({'c': path, 'v': mongosupport.SERIALIZATION_VERSION, 'd': {}}))
+            assert False
+        except DataError:
+            assert path not in mongosupport._model_classes
+    try:
+        mongosupport._rebuild_model(mongosupport._model_path(Signaled), mongosupport.SERIALIZATION_VERSION + 1, {})
+        assert False
+    except DataError:
+        pass
+
+    # copy/deepcopy不需要通过类路径导入
+    class Local(Model):
+        structure = {'tags': [unicode]}
+
+    local = Local({'tags': [u'a']})
+    for copied in [copy.copy(local), copy.deepcopy(local)]:
+        assert type(copied) is Local and copied == local
+    assert copy.copy(local)['tags'] is local['tags'] and copy.deepcopy(local)['tags'] is not local['tags']
+
+
+class Versioned(Model):
+    __collection__ = 'versioned'
+    __versioned__ = True
+    structure = {
+        'name': unicode,
+    }
+    collection = FakeCollection()
+
+
+def test_versioned():
+    assert Versioned.structure['_v'] is int
+    assert Versioned._inc_version({'$set': {'name': u'x'}}) == {'$set': {'name': u'x'}, '$inc': {'_v': 1}}
+
+    v = Versioned({'name': u'x'})
+    v.save()
+    assert v._v == 1
+
+    class Result(object):
+        matched_count = 0
+
+    v._id = ObjectId()
+    Versioned.collection.replace_one = lambda filter, doc: Result()
+    try:
+        v.save()
+        assert False
+    except ConflictError:
+        assert v._v == 1
+
+
+class Viewed(Model):
+    __collection__ = 'viewed'
+    __versioned__ = True
+    structure = {
+        'name': unicode,
+        'remark': unicode,
+        'views': int,
+    }
+    unversioned_fields = ['views']
+    collection = FakeCollection()
+
+
+def test_unversioned_fields():
+    # 只修改计数器时不递增版本号
+    assert Viewed._inc_version({'$inc': {'views': 1}}) == {'$inc': {'views': 1}}
+    assert Viewed._inc_version({'$inc': {'views': 1}, '$set': {'name': u'x'}}) == \
+        {'$inc': {'views': 1, '_v': 1}, '$set': {'name': u'x'}}
+
+    class Result(object):
+        matched_count = 1
+
+    calls = []
+    Viewed.collection.update_one = lambda filter, update: calls.append((filter, update)) or Result()
+    v = Viewed({'_id': ObjectId(), '_v': 2, 'name': u'x', 'views': 3})
+    v.save()
+    # save不覆盖计数器
+    assert calls == [({'_id': v._id, '_v': 2}, {'$set': {'_v': 3, 'name': u'x'}, '$unset': {'remark': ''}})]
+
+
+class Counted(Model):
+    __collection__ = 'counted'
+    structure = {
+        'status': unicode,
+        'parentId': ObjectId,
+        'processed': int,
+        'total': int,
+    }
+    counter_caches = [
+        {'parent': 'parentId', 'counter': 'total'},
+        {'parent': 'parentId', 'counter': 'processed', 'filter': {'status': {'$in': [u'processed']}}},
+    ]
+    collection = FakeCollection()
+
+
+def test_counter_caches():
+    parent = ObjectId()
+    c = Counted({'status': u'bare', 'parentId': parent})
+    c.save()
+    assert Counted.collection.calls[-1][1] == ({'_id': parent}, {'$inc': {'total': 1}})
+
+    # 状态变化时只更新processed
+    c._id = ObjectId()
+    old = dict(c)
+    c.status = u'processed'
+    Counted.collection.calls = []
+    Counted.collection.find_one_and_replace = lambda filter, doc, **kwargs: old
+    assert c.save().matched_count == 1
+    assert [call[1] for call in Counted.collection.calls] == [({'_id': parent}, {'$inc': {'processed': 1}})]
+
+    Counted.collection.calls = []
+    Counted.collection.find_one_and_delete = lambda filter: dict(c)
+    assert c.delete().deleted_count == 1
+    assert Counted.collection.calls[-1][1] == ({'_id': parent}, {'$inc': {'total': -1, 'processed': -1}})
+
+    try:
+        type('Broken', (Model,), {'structure': {'name': unicode}, 'counter_caches': [{'parent': 'parentId'}]})
+        assert False
+    except StructureError:
+        pass
+
+
+def test_pipeline():
+    p = Signaled.pipeline() \
+        .match({'$or': [{'name': u'x'}, {'entries.tags': u'a'}], 'entries.0.id': 1}) \
+        .unwind('entries') \
+        .group('entries.id', total={'$sum': '$views'}) \
+        .sort(('total', -1))
+    assert isinstance(p, Pipeline)
+    assert p.stages[2] == {'$group': {'_id': '$entries.id', 'total': {'$sum': '$views'}}}
+    # $group之后的字段不再校验
+    assert p.reshaped
+
+    for build in [lambda: Signaled.pipeline().match({'unknown': 1}),
+                  lambda: Signaled.pipeline().match({'$and': [{'entries.unknown': 1}]}),
+                  lambda: Signaled.pipeline().group(None, total={'$sum': '$unknown'}),
+                  lambda: Signaled.pipeline().sort('name.x')]:
+        try:
+            build()
+            assert False
+        except StructureError:
+            pass
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+    test_sslsmtphandler
+    ~~~~~~~~~~~~~~
+
+    Test cases for the queued smtp logging handler, digests are collected by a fake target handler.
+
+    :copyright: (c) 2026 by flask-boot contributors.
+    :date: 2026/10/19
+"""
+
+import logging
+from StringIO import StringIO
+
+from app.tools.sslsmtphandler import QueueSMTPHandler
+
+
+class FakeTarget(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.digests = []
+
+    def emit(self, record):
+        self.digests.append(record.getMessage())
+
+
+def _logger(name, *handlers):
+    logger = logging.getLogger(name)
+    logger.propagate = False
+    for h in handlers:
+        logger.addHandler(h)
+    return logger
+
+
+def _error(logger):
+    try:
+        1 / 0
+    except ZeroDivisionError:
+        logger.exception('Failed with %s', 'args')
+
+
+def test_digest_and_shared_record():
+    target = FakeTarget()
+    handler = QueueSMTPHandler(target, interval=60)
+    stream = StringIO()
+    logger = _logger('test_digest', handler, logging.StreamHandler(stream))
+
+    _error(logger)
+    _error(logger)
+    logger.error('Another error')
+    handler.stop()
+
+    # 其他handler使用的记录不会被修改, 每条记录的traceback只输出一次
+    assert stream.getvalue().count('Traceback') == 2
+    assert stream.getvalue().count('Failed with args') == 2
+
+    # 相同的错误合并成一条
+    assert len(target.digests) == 1
+    digest = target.digests[0]
+    assert digest.count('Traceback') == 1 and '[Repeated 2 times]' in digest and 'Another error' in digest
+
+
+def test_dedup_window():
+    target = FakeTarget()
+    handler = QueueSMTPHandler(target, dedup_window=600)
+    records = []
+    logger = _logger('test_dedup', handler)
+    handler.emit = lambda record: records.append(handler.prepare(record))
+
+    _error(logger)
+    _error(logger)
+    handler._flush(records[:1])
+    # 时间窗口内重复出现的错误不再发送, 计入下一封邮件的重复次数
+    handler._flush(records[1:])
+    assert len(target.digests) == 1
+
+    handler.dedup_window = 0
+    _error(logger)
+    handler._flush(records[2:])
+    assert len(target.digests) == 2 and '[Repeated 2 times]' in target.digests[1]
+    handler.stop()
@@ -10,4 +10,4 @@
 """
 
 from notifier import send_support_email, send_service_mail
-from sslsmtphandler import SSLSMTPHandler
+from sslsmtphandler import SSLSMTPHandler, QueueSMTPHandler
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+    crawler
+    ~~~~~~~~~~~~~~
+
+    A small crawler engine: fetch -> parse -> bulk write.
+
+    多个线程并发抓取和解析页面, 同一个站点的请求之间保持一定的间隔;
+    解析结果由单独的线程批量写入数据库, 写入成功的条目记录在checkpoint文件中, 重新执行时会跳过.
+
+    :copyright: (c) 2026 by flask-boot contributors.
+    :date: 2026/10/18
+"""
+
+import Queue
+import logging
+import os
+import random
+import threading
+import time
+
+from lxml import html
+
+from app.tools.httpclient import http
+
+
+class HostRateLimiter(object):
+    """
+    为每个站点分配请求时间, 同一个站点的两次请求之间间隔min_interval到max_interval秒.
+    """
+
+    def __init__(self, min_interval=5, max_interval=15):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.lock = threading.Lock()
+        # {host:next available time}
+        self.slots = {}
+
+    def wait(self, host):
+        with self.lock:
+            now = time.time()
+            slot = max(now, self.slots.get(host, now))
+            self.slots[host] = slot + random.uniform(self.min_interval, self.max_interval)
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class Crawler(object):
+    """
+    :param url: item -> url
+    :param parse: (item, text) -> result
+    :param sink: [(item, result)] -> None, 批量写入解析结果
+    :param fetch: (url, limiter) -> text, 默认使用共享的http client; 只有实际发送请求时才需要调用limiter.wait(host),
+                  读取缓存时不需要等待
+    :param key: item -> unicode, 用于记录checkpoint, 默认为item本身
+    :param checkpoint: checkpoint文件路径, 为空时不记录
+    """
+
+    _STOP = object()
+
+    def __init__(self, url, parse, sink, fetch=None, key=None, workers=4, limiter=None, batch_size=50,
+                 checkpoint=None, logger=None):
+        self.url = url
+        self.parse = parse
+        self.sink = sink
+        self.fetch = fetch or (lambda url, limiter: http.fetch_text(url, limiter=limiter))
+        self.key = key or (lambda item: item)
+        self.workers = workers
+        self.limiter = limiter or HostRateLimiter()
+        self.batch_size = batch_size
+        self.checkpoint = checkpoint
+        self.logger = logger or logging.getLogger(__name__)
+        self.stats = {'skipped': 0, 'fetched': 0, 'failed': 0, 'written': 0}
+        self._lock = threading.Lock()
+
+    def run(self, items):
+        done = self._load_checkpoint()
+        pending = Queue.Queue(self.workers * 2)
+        results = Queue.Queue(self.batch_size * 2)
+
+        fetchers = [threading.Thread(target=self._fetch_and_parse, args=(pending, results)) for _ in
+                    range(self.workers)]
+        writer = threading.Thread(target=self._write, args=(results,))
+        for t in fetchers + [writer]:
+            t.setDaemon(True)
+            t.start()
+
+        for item in items:
+            if unicode(self.key(item)) in done:
+                self._count('skipped')
+                continue
+            pending.put(item)
+
+        for _ in fetchers:
+            pending.put(self._STOP)
+        for t in fetchers:
+            t.join()
+        results.put(self._STOP)
+        writer.join()
+
+        self.logger.info('Crawler finished, %s' % self.stats)
+        return self.stats
+
+    def _fetch_and_parse(self, pending, results):
+        while True:
+            item = pending.get()
+            if item is self._STOP:
+                break
+            try:
+                url = self.url(item)
+                text = self.fetch(url, self.limiter)
+                results.put((item, self.parse(item, text)))
+                self._count('fetched')
+            except Exception:
+                self._count('failed')
+                self.logger.exception('Failed when crawling %s' % (item,))
+
+    def _write(self, results):
+        batch = []
+        stop = False
+        while not stop:
+            try:
+                r = results.get(timeout=1)
+                if r is self._STOP:
+                    stop = True
+                else:
+                    batch.append(r)
+            except Queue.Empty:
+                pass
+
+            if batch and (stop or len(batch) >= self.batch_size or results.empty()):
+                try:
+                    self.sink(batch)
+                    self._count('written', len(batch))
+                    self._save_checkpoint([self.key(item) for item, _ in batch])
+                except Exception:
+                    self._count('failed', len(batch))
+                    self.logger.exception('Failed when writing %s results' % len(batch))
+                batch = []
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self.stats[name] += n
+
+    def _load_checkpoint(self):
+        if not self.checkpoint or not os.path.exists(self.checkpoint):
+            return set()
+        with open(self.checkpoint) as f:
+            return set(line.rstrip('\n').decode('utf-8') for line in f if line.strip())
+
+    def _save_checkpoint(self, keys):
+        if not self.checkpoint:
+            return
+        with open(self.checkpoint, 'a') as f:
+            for k in keys:
+                f.write(unicode(k).encode('utf-8') + '\n')
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Parsers
+#
+
+def parse_5118_keywords(text):
+    """
+    解析5118的关键词挖掘页面, 返回[(关键词, 百度指数, 百度搜索结果)].
+    """
+    tree = html.fromstring(text)
+    rows = []
+    for dl in tree.xpath('//div[@class="Fn-ui-list dig-list"]/dl'):
+        if dl.get('class', '') == 'dl-word':
+            continue
+        name = unicode(dl.xpath('./dd[1]//a[1]/@title')[0].strip())
+        baidu_index = dl.xpath('./dd[2]/text()')[0].strip()
+        baidu_result = dl.xpath('./dd[3]/text()')[0].strip()
+        rows.append((name,
+                     int(baidu_index) if baidu_index.isdigit() else 0,
+                     int(baidu_result) if baidu_result.isdigit() else 0))
+    return rows
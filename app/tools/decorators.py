@@ -10,26 +10,22 @@
 """
 
 from functools import wraps
-from threading import Thread
 
 from flask import abort
 from flask_login import current_user
 
 from app.extensions import cache
+from app.tools.executor import executor
 
 
 def async(f):
     """
-    异步执行函数.
+    异步执行函数, 在后台线程池中执行, 返回concurrent.futures.Future.
     """
 
     @wraps(f)
     def wrapper(*args, **kwargs):
-        thr = Thread(target=f, args=args, kwargs=kwargs)
-        # https://docs.python.org/2/library/threading.html#threading.Thread.daemon
-        # 重启Flask服务器时中止正在执行的异步线程
-        thr.setDaemon(True)
-        thr.start()
+        return executor.submit(f, *args, **kwargs)
 
     return wrapper
 
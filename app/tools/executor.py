@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+    executor
+    ~~~~~~~~~~~~~~
+
+    Background task executor, which runs functions decorated by @async in a bounded thread pool.
+
+    可用的配置项:
+    TASK_WORKERS - 线程池大小
+    TASK_QUEUE_SIZE - 等待执行的任务数上限, 超出时提交任务的线程会被阻塞
+    TASK_QUEUE_TIMEOUT - 提交任务时最长的阻塞秒数, 超时后放弃该任务
+
+    进程退出时(包括gunicorn的worker正常退出), 会等待已提交的任务执行完毕.
+
+    :copyright: (c) 2026 by flask-boot contributors.
+    :date: 2026/10/18
+"""
+
+import atexit
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class TaskExecutor(object):
+    """
+    带有背压的线程池.
+    """
+
+    def __init__(self, max_workers=4, queue_size=100, queue_timeout=5):
+        self.max_workers = max_workers
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.logger = logging.getLogger(__name__)
+        self._pool = None
+        self._pending = 0
+        self._cond = threading.Condition()
+        # {task name:{submitted/rejected/completed/failed/running/time/max_time}}
+        self._metrics = {}
+
+    def init_app(self, app):
+        self.max_workers = app.config.get('TASK_WORKERS', self.max_workers)
+        self.queue_size = app.config.get('TASK_QUEUE_SIZE', self.queue_size)
+        self.queue_timeout = app.config.get('TASK_QUEUE_TIMEOUT', self.queue_timeout)
+        self.logger = app.logger
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            with self._cond:
+                if self._pool is None:
+                    self._pool = ThreadPoolExecutor(self.max_workers)
+                    atexit.register(self.shutdown)
+        return self._pool
+
+    def submit(self, f, *args, **kwargs):
+        """
+        提交任务, 返回concurrent.futures.Future; 等待超时时返回None.
+        """
+        name = getattr(f, '__name__', repr(f))
+        metrics = self._get_metrics(name)
+
+        with self._cond:
+            deadline = time.time() + self.queue_timeout
+            while self._pending >= self.max_workers + self.queue_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    metrics['rejected'] += 1
+                    self.logger.error('Task queue is full, reject task %s' % name)
+                    return None
+                self._cond.wait(remaining)
+            self._pending += 1
+            metrics['submitted'] += 1
+
+        def run():
+            start = time.time()
+            with self._cond:
+                metrics['running'] += 1
+            try:
+                return f(*args, **kwargs)
+            finally:
+                elapsed = time.time() - start
+                with self._cond:
+                    metrics['running'] -= 1
+                    metrics['time'] += elapsed
+                    metrics['max_time'] = max(metrics['max_time'], elapsed)
+
+        try:
+            future = self.pool.submit(run)
+        except RuntimeError:
+            # 线程池已经关闭
+            self._done(metrics, None)
+            raise
+        future.add_done_callback(lambda fu: self._done(metrics, fu, name))
+        return future
+
+    def _done(self, metrics, future, name=None):
+        e = future.exception() if future is not None else None
+        with self._cond:
+            self._pending -= 1
+            self._cond.notify()
+            if future is not None:
+                metrics['failed' if e is not None else 'completed'] += 1
+
+        if e is not None:
+            # futures在python2下通过exception_info()提供traceback
+            tb = future.exception_info()[1] if hasattr(future, 'exception_info') else None
+            self.logger.error('Task %s failed: %s' % (name, e), exc_info=(type(e), e, tb))
+
+    def _get_metrics(self, name):
+        metrics = self._metrics.get(name)
+        if metrics is None:
+            with self._cond:
+                metrics = self._metrics.setdefault(name, {'submitted': 0, 'rejected': 0, 'completed': 0, 'failed': 0,
+                                                          'running': 0, 'time': 0.0, 'max_time': 0.0})
+        return metrics
+
+    def stats(self):
+        """
+        每种任务的统计信息.
+        """
+        with self._cond:
+            return {k: dict(v) for k, v in self._metrics.iteritems()}
+
+    def shutdown(self, wait=True):
+        """
+        停止接收新任务, 并等待已提交的任务执行完毕.
+        """
+        if self._pool is not None:
+            self.logger.info('Shutting down task executor, pending tasks %s, stats %s' % (self._pending, self.stats()))
+            self._pool.shutdown(wait)
+
+
+executor = TaskExecutor()
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+"""
+    files
+    ~~~~~~~~~~~~~~
+
+    File helpers.
+
+    :copyright: (c) 2026 by flask-boot contributors.
+    :date: 2026/10/19
+"""
+
+import os
+import threading
+
+
+def atomic_write(path, write, mode='wb'):
+    """
+    先写入临时文件再重命名, 避免其他线程或进程读到不完整的文件.
+
+    :param write: f -> None, 向打开的临时文件中写入内容
+    """
+    d = os.path.dirname(path)
+    if d and not os.path.exists(d):
+        try:
+            os.makedirs(d)
+        except OSError:
+            # 其他线程已经创建
+            pass
+    tmp = '%s.%s-%s.tmp' % (path, os.getpid(), threading.current_thread().ident)
+    try:
+        with open(tmp, mode) as f:
+            write(f)
+        os.rename(tmp, path)
+    except Exception:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
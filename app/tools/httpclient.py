@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+    httpclient
+    ~~~~~~~~~~~~~~
+
+    Shared http client with connection pooling, timeouts and an on-disk conditional-get cache.
+
+    所有请求共用一个requests.Session, 请求头只通过参数传入, 不修改session的全局设置, 因此可以在多个线程中使用.
+
+    可用的配置项:
+    HTTP_POOL_SIZE - 每个站点的连接池大小
+    HTTP_MAX_RETRIES - 连接失败时的重试次数
+    HTTP_CONNECT_TIMEOUT/HTTP_READ_TIMEOUT - 连接/读取超时秒数
+    HTTP_CACHE_DIR - 缓存目录, 为空时不缓存
+    HTTP_CACHE_TTL - 缓存有效秒数, 过期后使用ETag/Last-Modified发送条件请求
+    HTTP_CACHE_MAX_AGE - 超过该秒数未更新的缓存会被删除
+    HTTP_CACHE_MAX_SIZE - 缓存目录的最大字节数, 超过时从最久未更新的缓存开始删除
+
+    :copyright: (c) 2026 by flask-boot contributors.
+    :date: 2026/10/18
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from urlparse import urlparse
+
+import requests
+
+from app.tools.files import atomic_write
+
+USER_AGENT = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_4) AppleWebKit/537.36 (KHTML, like Gecko) ' \
+             'Chrome/52.0.2743.116 Safari/537.36'
+
+DEFAULT_HEADERS = {
+    'User-Agent': USER_AGENT,
+    'Accept': 'application/json, text/javascript, text/html, */*; q=0.01',
+    'Accept-Language': 'zh-CN,zh;q=0.8,en;q=0.6,zh-TW;q=0.4,ja;q=0.2',
+    'Accept-Encoding': 'gzip, deflate, sdch',
+    'Content-Type': 'application/x-www-form-urlencoded; charset=UTF-8',
+    'X-Requested-With': 'XMLHttpRequest',
+    'Connection': 'keep-alive',
+}
+
+
+class HttpClient(object):
+    # 写入缓存后最多每隔多少秒清理一次
+    PRUNE_INTERVAL = 3600
+
+    def __init__(self, pool_size=10, max_retries=5, timeout=(5, 30), cache_dir=None, cache_ttl=86400,
+                 cache_max_age=30 * 86400, cache_max_size=512 * 1024 * 1024):
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.cache_dir = cache_dir
+        self.cache_ttl = cache_ttl
+        self.cache_max_age = cache_max_age
+        self.cache_max_size = cache_max_size
+        self._session = None
+        self._lock = threading.Lock()
+        self._pruned = 0
+
+    def init_app(self, app):
+        self.pool_size = app.config.get('HTTP_POOL_SIZE', self.pool_size)
+        self.max_retries = app.config.get('HTTP_MAX_RETRIES', self.max_retries)
+        self.timeout = (app.config.get('HTTP_CONNECT_TIMEOUT', self.timeout[0]),
+                        app.config.get('HTTP_READ_TIMEOUT', self.timeout[1]))
+        self.cache_dir = app.config.get('HTTP_CACHE_DIR', os.path.join(app.instance_path, 'http_cache'))
+        self.cache_ttl = app.config.get('HTTP_CACHE_TTL', self.cache_ttl)
+        self.cache_max_age = app.config.get('HTTP_CACHE_MAX_AGE', self.cache_max_age)
+        self.cache_max_size = app.config.get('HTTP_CACHE_MAX_SIZE', self.cache_max_size)
+        self._session = None
+
+    @property
+    def session(self):
+        if self._session is None:
+            # 多个线程可能同时第一次访问
+            with self._lock:
+                if self._session is None:
+                    adapter = requests.adapters.HTTPAdapter(pool_connections=self.pool_size,
+                                                            pool_maxsize=self.pool_size, max_retries=self.max_retries)
+                    ss = requests.Session()
+                    ss.mount('http://', adapter)
+                    ss.mount('https://', adapter)
+                    ss.headers.update(DEFAULT_HEADERS)
+                    self._session = ss
+        return self._session
+
+    def request(self, method, url, headers=None, timeout=None, **kwargs):
+        return self.session.request(method, url, headers=headers, timeout=timeout or self.timeout, **kwargs)
+
+    def get(self, url, headers=None, timeout=None, **kwargs):
+        return self.request('GET', url, headers, timeout, **kwargs)
+
+    def post(self, url, headers=None, timeout=None, **kwargs):
+        return self.request('POST', url, headers, timeout, **kwargs)
+
+    def fetch_text(self, url, headers=None, encoding=None, cache=True, limiter=None):
+        """
+        获取页面内容, 缓存有效期内直接返回缓存; 过期后发送条件请求, 返回304时继续使用缓存.
+        缓存的内容文件已经被删除时发送普通请求.
+
+        :param limiter: 如crawler.HostRateLimiter, 只在实际发送请求之前调用limiter.wait(host)
+        """
+        path = self._cache_path(url) if cache and self.cache_dir else None
+        meta = self._load_meta(path) if path else None
+        body = self._load_body(path) if meta else None
+        if body is None:
+            meta = None
+        elif time.time() - meta['time'] < self.cache_ttl:
+            return body
+
+        headers = dict(headers or {})
+        if meta:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+
+        if limiter:
+            limiter.wait(urlparse(url).netloc)
+        r = self.get(url, headers)
+        if meta and r.status_code == 304:
+            meta['time'] = time.time()
+            self._save(path, meta)
+            return body
+
+        r.raise_for_status()
+        if encoding:
+            r.encoding = encoding
+        text = r.text
+        if path:
+            self._save(path, {'url': url, 'time': time.time(), 'etag': r.headers.get('ETag'),
+                              'last_modified': r.headers.get('Last-Modified')}, text)
+            self._maybe_prune()
+        return text
+
+    def prune_cache(self):
+        """
+        删除超过cache_max_age未更新的缓存, 总大小仍然超过cache_max_size时从最久未更新的缓存开始删除, 返回删除的数量.
+        """
+        if not self.cache_dir or not os.path.isdir(self.cache_dir):
+            return 0
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if not name.endswith('.json'):
+                    continue
+                path = os.path.join(root, name[:-len('.json')])
+                try:
+                    mtime = os.path.getmtime(path + '.json')
+                    size = os.path.getsize(path + '.json') + (os.path.getsize(path) if os.path.exists(path) else 0)
+                except OSError:
+                    # 其他线程已经删除
+                    continue
+                entries.append((mtime, size, path))
+
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        now = time.time()
+        removed = 0
+        for mtime, size, path in entries:
+            if now - mtime < self.cache_max_age and total <= self.cache_max_size:
+                break
+            # 先删除meta, 读取时找不到meta会直接发送普通请求
+            for p in (path + '.json', path):
+                try:
+                    os.remove(p)
+                except OSError:
+                    pass
+            total -= size
+            removed += 1
+        return removed
+
+    def _maybe_prune(self):
+        with self._lock:
+            if time.time() - self._pruned < self.PRUNE_INTERVAL:
+                return
+            self._pruned = time.time()
+        self.prune_cache()
+
+    def _cache_path(self, url):
+        key = hashlib.sha1(url.encode('utf-8') if isinstance(url, unicode) else url).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def _load_meta(self, path):
+        try:
+            with open(path + '.json') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _load_body(self, path):
+        try:
+            with open(path) as f:
+                return f.read().decode('utf-8')
+        except IOError:
+            return None
+
+    def _save(self, path, meta, text=None):
+        if text is not None:
+            atomic_write(path, lambda f: f.write(text.encode('utf-8')))
+        atomic_write(path + '.json', lambda f: json.dump(meta, f), mode='w')
+
+
+http = HttpClient()
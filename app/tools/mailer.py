@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+    mailer
+    ~~~~~~~~~~~~~~
+
+    Mail dispatcher, which sends emails from a bounded queue with a fixed pool of workers.
+
+    每个worker批量地从队列中取出邮件, 复用同一个SMTP连接发送, 失败的邮件会按指数退避重试.
+    等待重试的邮件保存在单独的列表中, 由worker在到期后取出发送, 停止时不再等待直接发送.
+    队列已满时, 支持邮件直接丢弃, 业务邮件则阻塞等待一段时间.
+    同一批次中主题和收件人相同的支持邮件会被合并成一封.
+
+    :copyright: (c) 2026 by flask-boot contributors.
+    :date: 2026/10/18
+"""
+
+import Queue
+import atexit
+import heapq
+import threading
+import time
+
+
+class MailDispatcher(object):
+    """
+    邮件发送队列.
+
+    可用的配置项:
+    MAIL_QUEUE_SIZE - 队列长度
+    MAIL_QUEUE_TIMEOUT - 队列已满时业务邮件的最长等待秒数
+    MAIL_WORKERS - 发送线程个数
+    MAIL_BATCH_SIZE - 每个连接最多发送的邮件数
+    MAIL_MAX_RETRIES - 最大重试次数
+    MAIL_RETRY_BACKOFF - 重试的退避基数(秒), 第n次重试等待MAIL_RETRY_BACKOFF ** n秒
+    """
+
+    # 用于停止worker的标记
+    _STOP = object()
+
+    def __init__(self, mail):
+        self.mail = mail
+        self.app = None
+        self.queue = None
+        self.workers = []
+        self.lock = threading.Lock()
+        # 等待重试的邮件, [(到期时间, item)]的最小堆
+        self.retries = []
+        self.retries_lock = threading.Lock()
+
+    def start(self, app):
+        """
+        启动worker, 只在第一次发送邮件时执行.
+        """
+        if self.workers:
+            return
+
+        with self.lock:
+            if self.workers:
+                return
+
+            self.app = app
+            self.queue = Queue.Queue(app.config.get('MAIL_QUEUE_SIZE', 1000))
+            for i in range(app.config.get('MAIL_WORKERS', 2)):
+                t = threading.Thread(target=self._work, name='mailer-%s' % i)
+                t.setDaemon(True)
+                t.start()
+                self.workers.append(t)
+
+            atexit.register(self.stop)
+
+    def stop(self, timeout=10):
+        """
+        停止所有worker, 并等待队列中的邮件发送完毕.
+        """
+        with self.lock:
+            workers, self.workers = self.workers, []
+
+        for _ in workers:
+            try:
+                self.queue.put(self._STOP, timeout=timeout)
+            except Queue.Full:
+                pass
+        for t in workers:
+            t.join(timeout)
+
+        # 不再等待退避时间, 立即发送剩余的重试邮件, 失败时放弃
+        with self.retries_lock:
+            retries, self.retries = self.retries, []
+        if retries:
+            try:
+                self._send_batch(self._coalesce([item for _, item in sorted(retries)]))
+            except:
+                self.app.logger.exception('Unexpected error when sending emails')
+            with self.retries_lock:
+                lost, self.retries = self.retries, []
+            for _, (msg, support, attempts) in lost:
+                self.app.logger.error('Give up email %s to %s when stopping' % (msg.subject, msg.recipients))
+
+    def send(self, app, msg, support=False):
+        """
+        将邮件放入发送队列.
+
+        :param msg: flask_mail.Message
+        :param support: 是否是支持邮件, 支持邮件在队列已满时会被丢弃, 并且可以被合并
+        """
+        self.start(app)
+        self._put((msg, support, 0), support)
+
+    def _put(self, item, support):
+        try:
+            if support:
+                self.queue.put_nowait(item)
+            else:
+                self.queue.put(item, timeout=self.app.config.get('MAIL_QUEUE_TIMEOUT', 5))
+        except Queue.Full:
+            self.app.logger.error('Mail queue is full, drop email %s to %s' % (item[0].subject, item[0].recipients))
+
+    def _work(self):
+        batch_size = self.app.config.get('MAIL_BATCH_SIZE', 20)
+        stop = False
+        while not stop:
+            batch = self._due_retries(batch_size)
+            try:
+                # 有到期的重试邮件时不等待, 否则最多等到下一封重试邮件到期
+                item = self.queue.get_nowait() if batch else self.queue.get(timeout=self._retry_wait())
+            except Queue.Empty:
+                item = None
+
+            while item is not None:
+                if item is self._STOP:
+                    stop = True
+                    break
+                batch.append(item)
+                if len(batch) >= batch_size:
+                    break
+                try:
+                    item = self.queue.get_nowait()
+                except Queue.Empty:
+                    item = None
+
+            if batch:
+                try:
+                    self._send_batch(self._coalesce(batch))
+                except:
+                    self.app.logger.exception('Unexpected error when sending emails')
+
+    def _due_retries(self, limit):
+        """
+        取出最多limit封已经到期的重试邮件.
+        """
+        now = time.time()
+        ret = []
+        with self.retries_lock:
+            while self.retries and self.retries[0][0] <= now and len(ret) < limit:
+                ret.append(heapq.heappop(self.retries)[1])
+        return ret
+
+    def _retry_wait(self):
+        """
+        距离下一封重试邮件到期的秒数, 没有重试邮件时返回None.
+        """
+        with self.retries_lock:
+            if not self.retries:
+                return None
+            return max(self.retries[0][0] - time.time(), 0)
+
+    def _coalesce(self, batch):
+        """
+        合并主题和收件人相同的支持邮件.
+        """
+        ret = []
+        merged = {}
+        for item in batch:
+            msg, support, attempts = item
+            if not support:
+                ret.append(item)
+                continue
+            key = (msg.subject, tuple(msg.recipients))
+            if key in merged:
+                merged[key][0].body += u'\n\n' + msg.body
+            else:
+                merged[key] = item
+                ret.append(item)
+        return ret
+
+    def _send_batch(self, batch):
+        """
+        使用同一个SMTP连接发送一批邮件, 发送失败时当前邮件以及剩余的邮件都加入重试列表.
+        """
+        sent = 0
+        with self.app.app_context():
+            try:
+                with self.mail.connect() as conn:
+                    for msg, support, attempts in batch:
+                        conn.send(msg)
+                        sent += 1
+            except:
+                if sent >= len(batch):
+                    # 邮件都已发出, 只是关闭连接时出错
+                    self.app.logger.exception('Failed when closing smtp connection')
+                    return
+                msg, support, attempts = batch[sent]
+                self.app.logger.exception('Failed when sending email %s to %s' % (msg.subject, msg.recipients))
+                for item in batch[sent:]:
+                    self._retry(item)
+
+    def _retry(self, item):
+        msg, support, attempts = item
+        if attempts >= self.app.config.get('MAIL_MAX_RETRIES', 3):
+            self.app.logger.error('Give up email %s to %s after %s retries' % (msg.subject, msg.recipients, attempts))
+            return
+
+        attempts += 1
+        due = time.time() + self.app.config.get('MAIL_RETRY_BACKOFF', 2) ** attempts
+        with self.retries_lock:
+            heapq.heappush(self.retries, (due, (msg, support, attempts)))
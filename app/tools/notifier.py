@@ -15,7 +15,10 @@ from flask import current_app
 from flask_mail import Message
 
 from app.extensions import mail
-from app.tools.decorators import async
+from app.tools.mailer import MailDispatcher
+
+# 所有邮件都通过此队列发送
+dispatcher = MailDispatcher(mail)
 
 
 def send_support_email(type, body, **kwargs):
@@ -47,15 +50,14 @@ def send_service_mail(subject, recipients, html, **kwargs):
     send_async_service_email(app, subject, recipients, html)
 
 
-@async
 def send_async_email(app, subject, recipients, body):
     with app.app_context():
         msg = Message(subject, recipients, body)
-        mail.send(msg)
+    # 支持邮件在队列已满时丢弃, 同一批次中相同主题的会被合并
+    dispatcher.send(app, msg, support=True)
 
 
-@async
 def send_async_service_email(app, subject, recipients, html):
     with app.app_context():
         msg = Message(subject, recipients, html=html)
-        mail.send(msg)
+    dispatcher.send(app, msg)
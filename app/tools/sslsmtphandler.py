@@ -9,7 +9,13 @@
     :date: 16/6/24
 """
 
+import Queue
+import atexit
+import copy
+import logging
 import smtplib
+import threading
+import time
 from logging.handlers import SMTPHandler
 from email.utils import formatdate
 
@@ -38,3 +44,134 @@ class SSLSMTPHandler(SMTPHandler):
             raise
         except:
             self.handleError(record)
+
+
+class QueueSMTPHandler(logging.Handler):
+    """
+    A non-blocking handler which sends records with a background thread.
+
+    与python3中QueueHandler/QueueListener的处理方式一致, 记录在当前线程中格式化后放入队列, 由后台线程发送.
+    后台线程将一段时间内的记录合并成一封摘要邮件, 在dedup_window秒内重复出现的相同错误只会发送一次.
+
+    :param target: 实际发送邮件的SMTPHandler或者SSLSMTPHandler
+    :param capacity: 每封摘要邮件最多包含的记录数
+    :param interval: 收到第一条记录后最多等待多少秒发送摘要邮件
+    :param dedup_window: 相同错误的去重时间窗口(秒)
+    :param queue_size: 队列长度, 队列已满时丢弃记录
+    """
+
+    _STOP = object()
+
+    def __init__(self, target, capacity=50, interval=60, dedup_window=600, queue_size=1000):
+        logging.Handler.__init__(self)
+        self.target = target
+        self.capacity = capacity
+        self.interval = interval
+        self.dedup_window = dedup_window
+        self.queue = Queue.Queue(queue_size)
+        # {signature:last sent time}
+        self.sent = {}
+        # {signature:suppressed count}
+        self.suppressed = {}
+        self._thread = threading.Thread(target=self._monitor, name='queue-smtp-handler')
+        self._thread.setDaemon(True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def prepare(self, record):
+        """
+        格式化记录, 返回去掉了exc_info和args的副本, 不修改其他handler共用的记录.
+        去重的签名在修改前根据原始的消息和异常计算.
+        """
+        msg = self.format(record)
+        signature = record.levelno, record.pathname, record.lineno, record.exc_text or record.getMessage()
+        record = copy.copy(record)
+        record.msg = msg
+        record.args = None
+        record.exc_info = None
+        record.exc_text = None
+        record.signature = signature
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Queue.Full:
+            pass
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            self.handleError(record)
+
+    def stop(self):
+        """
+        发送队列中剩余的记录并停止后台线程.
+        """
+        if self._thread.is_alive():
+            try:
+                self.queue.put(self._STOP, timeout=1)
+            except Queue.Full:
+                return
+            self._thread.join(10)
+
+    def _monitor(self):
+        pending = []
+        deadline = None
+        while True:
+            timeout = max(deadline - time.time(), 0) if deadline else None
+            try:
+                record = self.queue.get(timeout=timeout)
+            except Queue.Empty:
+                record = None
+
+            if record is self._STOP:
+                self._flush(pending)
+                break
+
+            if record is not None:
+                pending.append(record)
+                if deadline is None:
+                    deadline = time.time() + self.interval
+
+            if pending and (len(pending) >= self.capacity or time.time() >= deadline):
+                self._flush(pending)
+                pending = []
+                deadline = None
+
+    def _flush(self, records):
+        """
+        合并并去重后发送一封摘要邮件.
+        """
+        now = time.time()
+        counts = {}
+        unique = []
+        for record in records:
+            sig = record.signature
+            if sig in counts:
+                counts[sig] += 1
+            elif now - self.sent.get(sig, 0) < self.dedup_window:
+                self.suppressed[sig] = self.suppressed.get(sig, 0) + 1
+            else:
+                counts[sig] = 1
+                unique.append((sig, record))
+
+        if not unique:
+            return
+
+        sections = []
+        for sig, record in unique:
+            self.sent[sig] = now
+            repeated = counts[sig] + self.suppressed.pop(sig, 0)
+            section = record.getMessage()
+            if repeated > 1:
+                section = '[Repeated %s times]\n%s' % (repeated, section)
+            sections.append(section)
+
+        # 清理过期的去重记录
+        for sig in [s for s, t in self.sent.iteritems() if now - t >= self.dedup_window]:
+            del self.sent[sig]
+
+        digest = logging.makeLogRecord({'msg': ('\n\n' + '-' * 80 + '\n\n').join(sections),
+                                        'levelno': unique[0][1].levelno,
+                                        'levelname': unique[0][1].levelname})
+        self.target.emit(digest)
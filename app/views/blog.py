@@ -16,10 +16,11 @@ from bson.objectid import ObjectId
 from flask import Blueprint, request, render_template, abort, jsonify, current_app
 from flask_babel import gettext as _
 from flask_login import current_user, login_required
+from pymongo.errors import DuplicateKeyError
 
 from app.jobs import post_view_times_counter
-from app.models import Post, Tag, User
-from app.mongosupport import Pagination, populate_model
+from app.models import Post, Tag, User, PostComments
+from app.mongosupport import Pagination, populate_model, Query
 from app.tools import send_support_email
 from app.tools.decorators import user_not_rejected, user_not_evil
 
@@ -27,6 +28,9 @@ blog = Blueprint('blog', __name__)
 
 PAGE_COUNT = 10
 
+# 博文列表的缓存秒数, 通过Post写入后自动失效
+LIST_CACHE_TTL = 60
+
 
 @blog.route('/')
 @blog.route('/index')
@@ -37,13 +41,16 @@ def index():
     tid = request.args.get('t', None)
     page = int(request.args.get('p', 1))
     start = (page - 1) * PAGE_COUNT
-    condition = {}
+    condition = Query()
     if tid:
-        condition = {'tids': ObjectId(tid)}
-    count = Post.count(condition)
-    cursor = Post.find(condition, skip=start, limit=PAGE_COUNT, sort=[('createTime', pymongo.DESCENDING)])
+        if not ObjectId.is_valid(tid):
+            abort(404)
+        condition = Post.q.tids == ObjectId(tid)
+    count = Post.cached_count(condition, LIST_CACHE_TTL)
+    posts = Post.cached_find(condition, skip=start, limit=PAGE_COUNT, sort=[('createTime', pymongo.DESCENDING)],
+                             ttl=LIST_CACHE_TTL)
     pagination = Pagination(page, PAGE_COUNT, count)
-    return render_template('blog/index.html', posts=list(cursor), pagination=pagination, tags=all_tags())
+    return render_template('blog/index.html', posts=posts, pagination=pagination, tags=all_tags())
 
 
 def all_tags():
@@ -59,19 +66,35 @@ def post(post_id):
     """
     Post.
     """
-    p = Post.find_one({'_id': post_id})
+    bucket = _use_comment_bucket()
+    p = Post.find_one({'_id': post_id}, {'comments': False} if bucket else None)
     if not p:
         abort(404)
 
     post_view_times_counter[post_id] += 1
 
+    pagination = None
+    if bucket:
+        # 第1页显示最新的评论分页
+        size = current_app.config['BLOG_COMMENT_PAGE_SIZE']
+        comment_count = p.commentCount or 0
+        pagination = Pagination(1, size, comment_count)
+        # 非法的页码显示第1页, 超出范围时显示最后一页
+        pagination.page = min(max(request.args.get('cp', 1, type=int), 1), max(pagination.pages, 1))
+        comments = PostComments.find_one({'postId': post_id, 'page': pagination.pages - pagination.page})
+        comments = comments.comments if comments else []
+    else:
+        comments = p.comments
+        comment_count = len(p.comments)
+
     uids = set()
-    for c in p.comments:
+    for c in comments:
         uids.add(c.uid)
         for r in c.replys:
             uids.add(r.uid)
-    user_dict = {u._id: u for u in User.find({'_id': {'$in': list(uids)}})}
-    return render_template('blog/post.html', id=post_id, post=p, tags=all_tags(), user_dict=user_dict)
+    user_dict = {u._id: u for u in User.get_many(uids)}
+    return render_template('blog/post.html', id=post_id, post=p, tags=all_tags(), user_dict=user_dict,
+                           comments=comments, comment_count=comment_count, pagination=pagination)
 
 
 @blog.route('/post/new', methods=('GET', 'POST'))
@@ -108,12 +131,12 @@ def new(post_id=None):
                 current_app.logger.info('Successfully new a post %s' % post._id)
             # Change
             else:
-                existing = Post.find_one({'_id': post_id})
-                existing.title = post.title
-                existing.tids = post.tids
-                existing.body = post.body
-                existing.save()
-                current_app.logger.info('Successfully change a post %s' % post._id)
+                result = Post.update_one({'_id': post_id},
+                                         {'$set': {'title': post['title'], 'tids': post['tids'], 'body': post['body']}},
+                                         validate=True)
+                if not result.matched_count:
+                    return jsonify(success=False, message=_('The post does not exist!'))
+                current_app.logger.info('Successfully change a post %s' % post_id)
         except:
             current_app.logger.exception('Failed when saving post')
             return jsonify(success=False, message=_('Failed when saving the post, please try again later!'))
@@ -129,33 +152,29 @@ def comment(post_id):
     """
     评论博文.
     """
-    post = Post.find_one({'_id': post_id})
-    if not post:
-        return jsonify(success=False, message=_('The post does not exist!'))
-
     content = request.form.get('content', None)
     if not content or not content.strip():
         return jsonify(success=False, message=_('Comment content can not be blank!'))
 
-    max = -1
-    for c in post.comments:
-        if max < c.id:
-            max = c.id
-
-    now = datetime.now()
+    id = Post.next_comment_id(post_id)
+    if id is None:
+        return jsonify(success=False, message=_('The post does not exist!'))
 
     cmt = {
-        'id': max + 1,
+        'id': id,
         'uid': current_user._id,
         'content': content,
-        'time': now
+        'time': datetime.now(),
+        'replys': []
     }
 
-    post.comments.insert(0, cmt)
-    post.save()
+    if _use_comment_bucket():
+        _push_comment_bucket(post_id, cmt)
+    else:
+        Post.push(post_id, 'comments', cmt, position=0)
 
     send_support_email('comment()',
-                       u'New comment %s on post %s.' % (content, post._id))
+                       u'New comment %s on post %s.' % (content, post_id))
 
     return jsonify(success=True, message=_('Save comment successfully.'))
 
@@ -168,30 +187,45 @@ def reply(post_id, comment_id):
     """
     回复.
     """
-    post = Post.find_one({'_id': post_id})
-    if not post:
-        return jsonify(success=False, message=_('The post does not exist!'))
-
     content = request.form.get('content', None)
     if not content or not content.strip():
         return jsonify(success=False, message=_('Reply content can not be blank!'))
 
-    cmt = next((c for c in post.comments if c.id == comment_id), -1)
-    if cmt == -1:
-        return jsonify(success=False, message=_('The comment you would like to reply does not exist!'))
-
-    now = datetime.now()
-
     reply = {
         'uid': current_user._id,
         'rid': ObjectId(request.form.get('rid', None)),
         'content': content,
-        'time': now
+        'time': datetime.now()
     }
 
-    cmt.replys.append(reply)
-    post.save()
+    if _use_comment_bucket():
+        r = PostComments.push({'postId': post_id,
+                               'page': comment_id // current_app.config['BLOG_COMMENT_PAGE_SIZE'],
+                               'comments.id': comment_id},
+                              'comments.$[c].replys', reply, array_filters=[{'c.id': comment_id}])
+    else:
+        r = Post.push({'_id': post_id, 'comments.id': comment_id},
+                      'comments.$[c].replys', reply, array_filters=[{'c.id': comment_id}])
+    if not r.matched_count:
+        return jsonify(success=False, message=_('The comment you would like to reply does not exist!'))
 
-    send_support_email('reply()', u'New reply %s on post %s.' % (content, post._id))
+    send_support_email('reply()', u'New reply %s on post %s.' % (content, post_id))
 
     return jsonify(success=True, message=_('Save reply successfully.'))
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Comment bucket - 评论分页保存在post_comments中, 参考app.models.PostComments
+#
+
+def _use_comment_bucket():
+    return current_app.config.get('BLOG_COMMENT_STORAGE') == 'bucket'
+
+
+def _push_comment_bucket(post_id, cmt):
+    filter = {'postId': post_id, 'page': cmt['id'] // current_app.config['BLOG_COMMENT_PAGE_SIZE']}
+    try:
+        PostComments.push(filter, 'comments', cmt, position=0, update={'$inc': {'size': 1}}, upsert=True)
+    except DuplicateKeyError:
+        # 其他请求同时创建了这一页
+        PostComments.push(filter, 'comments', cmt, position=0, update={'$inc': {'size': 1}})
@@ -11,12 +11,13 @@
 
 from collections import OrderedDict
 
+from bson.errors import InvalidId
 from bson.objectid import ObjectId
 from flask import Blueprint, render_template, abort, current_app, request, jsonify, make_response
 from pymongo.errors import DuplicateKeyError
 
 from app.extensions import mdb
-from app.mongosupport import Pagination, populate_model, MongoSupportError, convert_from_string
+from app.mongosupport import Pagination, populate_model, MongoSupportError, Query, DataError, convert_from_string
 from app.permissions import admin_permission
 
 crud = Blueprint('crud', __name__)
@@ -61,12 +62,16 @@ def index(model_name=None):
     # 将数据对象中非空的值提取出来, 构造成一个mongoDB查询的条件
     condition = {f: v for f, v in search_record.iteritems() if v}
     '''
-    condition = {}
+    condition = Query()
     for k, t in index_dict.iteritems():
         v = request.args.get(k, None)
         if v:
-            cv = convert_from_string(v, t)
-            condition[k.replace('.$', '')] = cv
+            if isinstance(t, list):
+                t = model._valid_paths[k + '.$']
+            try:
+                condition &= model.q[k] == convert_from_string(v, t, (model.__name__, k))
+            except (ValueError, InvalidId, DataError):
+                abort(400)
 
     # 翻页支持
     page = int(request.args.get('_p', 1))
@@ -156,7 +161,9 @@ def save(model_name, record_id=None):
         current_app.logger.exception('Failed when saving %s' % model_name)
         return jsonify(success=False, message='Save failed!')
 
-    return jsonify(success=True, message='Save successfully. (%s)' % unicode(record._id), rid=str(record._id))
+    # 开启了__versioned__的数据模型, 返回新的版本号
+    return jsonify(success=True, message='Save successfully. (%s)' % unicode(record._id), rid=str(record._id),
+                   v=record.get('_v'))
 
 
 @crud.route('/delete/<string:model_name>/<ObjectId:record_id>', methods=('GET', 'POST'))
@@ -11,36 +11,24 @@
 from datetime import datetime
 
 import pymongo
-import requests
+from bson.objectid import ObjectId
 from flask import Blueprint, render_template, request, abort, jsonify, current_app
-from lxml import html
 from werkzeug.urls import url_quote
 
+from app.jobs import job, enqueue
 from app.models import KeywordLevel, KeywordStatus, Keyword
 from app.mongosupport import Pagination
 from app.permissions import admin_permission
+from app.tools.crawler import parse_5118_keywords
 from app.tools.decorators import async
+from app.tools.httpclient import http
 
 seo = Blueprint('seo', __name__)
 
 PAGE_COUNT = 100
 
-user_agent = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_4) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/52.0.2743.116 Safari/537.36'
-headers = {
-    'User-Agent': user_agent,
-    'Accept': 'application/json, text/javascript, text/html, */*; q=0.01',
-    'Accept-Language': 'zh-CN,zh;q=0.8,en;q=0.6,zh-TW;q=0.4,ja;q=0.2',
-    'Accept-Encoding': 'gzip, deflate, sdch',
-    'Content-Type': 'application/x-www-form-urlencoded; charset=UTF-8',
-    'X-Requested-With': 'XMLHttpRequest',
-    'Connection': 'keep-alive',
-}
-adapter = requests.adapters.HTTPAdapter(max_retries=5)
-ss = requests.session()
-ss.mount('http://', adapter)
-ss.mount('https://', adapter)
-ss.headers.update(headers)
-
+# 长尾关键词统计的刷新间隔
+STATS_REFRESH = 600
 
 @seo.route('/')
 @seo.route('/index')
@@ -55,23 +43,38 @@ def index():
     p = int(request.args.get('page', '1'))
     start = (p - 1) * PAGE_COUNT
 
-    condition = {'level': KeywordLevel.SITE}
+    condition = Keyword.q.level == KeywordLevel.SITE
     if k:
-        condition['name'] = k.strip()
+        condition &= Keyword.q.name == k.strip()
     if o:
-        condition['owner'] = o.strip()
+        condition &= Keyword.q.owner == o.strip()
     status = s.split(u',')
     if status:
-        condition['status'] = {'$in': status}
+        condition &= Keyword.q.status.in_(status)
 
+    # 关键词由多个进程中的后台任务修改, 列表不使用进程内的查询缓存
     count = Keyword.count(condition)
-    cursor = Keyword.find(condition, skip=start, limit=PAGE_COUNT, sort=[('baiduIndex', pymongo.DESCENDING)])
-    keywords = []
-    for c in cursor:
+    keywords = list(Keyword.find(condition, skip=start, limit=PAGE_COUNT, sort=[('baiduIndex', pymongo.DESCENDING)]))
+    for c in keywords:
         set_index(c)
-        keywords.append(c)
+
+    # processed/total由counter_caches实时维护, 其他状态的数量使用预先计算的统计结果
+    stats = {st['_id']: st for st in keyword_stats().find({'_id': {'$in': [c._id for c in keywords]}})}
+
     pagination = Pagination(p, PAGE_COUNT, count)
-    return render_template('seo/index.html', keywords=keywords, pagination=pagination)
+    return render_template('seo/index.html', keywords=keywords, stats=stats, pagination=pagination)
+
+
+def keyword_stats():
+    """
+    统计每个站点关键词下标记为重复以及已屏蔽的长尾关键词数量, 结果保存在keyword_stats中, 每STATS_REFRESH秒重新计算一次.
+    """
+    return Keyword.pipeline() \
+        .match({'level': KeywordLevel.LONG_TAIL, 'status': {'$in': [KeywordStatus.REPEATED, KeywordStatus.REJECTED]}}) \
+        .group('parentId',
+               repeated={'$sum': {'$cond': [{'$eq': ['$status', KeywordStatus.REPEATED]}, 1, 0]}},
+               rejected={'$sum': {'$cond': [{'$eq': ['$status', KeywordStatus.REJECTED]}, 1, 0]}}) \
+        .materialize('keyword_stats', refresh=STATS_REFRESH, allow_disk_use=True)
 
 
 def set_index(k):
@@ -98,10 +101,10 @@ def longtail(keyword_id):
     s = request.args.get('status', u'bare,processed,repeated')
     p = int(request.args.get('page', '1'))
     start = (p - 1) * PAGE_COUNT
-    condition = {'level': KeywordLevel.LONG_TAIL, 'parentId': keyword_id}
+    condition = (Keyword.q.level == KeywordLevel.LONG_TAIL) & (Keyword.q.parentId == keyword_id)
     status = s.split(u',')
     if status:
-        condition['status'] = {'$in': status}
+        condition &= Keyword.q.status.in_(status)
 
     count = Keyword.count(condition)
     cursor = Keyword.find(condition, skip=start, limit=PAGE_COUNT, sort=[('baiduIndex', pymongo.DESCENDING)])
@@ -137,13 +140,15 @@ def hearsay(keyword_id):
             return jsonify(success=False, message='文章内容不能为空！')
 
         is_new = True if not keyword.hearsay else False
-        keyword.hearsay.title = title
-        keyword.hearsay.body = body
-        keyword.updateTime = datetime.now()
-        if is_new:
-            keyword.status = KeywordStatus.PROCESSED
 
-        keyword.save()
+        def apply(k):
+            k.hearsay.title = title
+            k.hearsay.body = body
+            k.updateTime = datetime.now()
+            if is_new:
+                k.status = KeywordStatus.PROCESSED
+
+        keyword.save_with_retry(apply)
 
         if not current_app.debug and is_new:
             notify_baidu(current_app._get_current_object(), keyword._id)
@@ -160,8 +165,8 @@ def notify_baidu(app, id):
     url = 'http://www.girl-atlas.com/hearsay/%s' % id
     app.logger.info('Try to nofity baidu this new url %s' % url)
     with app.app_context():
-        j = requests.post('http://data.zz.baidu.com/urls?site=www.girl-atlas.com&token=umKKIO97UfMdq9P6',
-                          data=url, headers={'Content-Type': 'text/plain'}).json()
+        j = http.post('http://data.zz.baidu.com/urls?site=www.girl-atlas.com&token=umKKIO97UfMdq9P6',
+                      data=url, headers={'Content-Type': 'text/plain'}).json()
         app.logger.info('Notify baidu result is %s' % j)
 
 
@@ -175,41 +180,44 @@ def refresh(keyword_id):
     if not keyword:
         abort(404)
 
-    analyze_keyword(current_app._get_current_object(), keyword)
+    # 由manage.py worker启动的进程执行, 进程重启也不会丢失
+    enqueue('seo.analyze_keyword', priority=1, keyword_id=keyword._id, refresh=True)
     return jsonify(success=True, message='成功触发了刷新请求，请稍候查看最新数据。')
 
 
-@async
-def analyze_keyword(app, keyword):
+@job('seo.analyze_keyword', lease=600)
+def analyze_keyword_job(app, keyword_id, refresh=False):
+    """
+    分析关键字的后台任务, refresh为True时不使用缓存的结果页.
+    """
+    keyword = Keyword.find_one({'_id': ObjectId(keyword_id)})
+    if not keyword:
+        app.logger.warning('Keyword %s does not exist' % keyword_id)
+        return
+    analyze_keyword(app, keyword, refresh)
+
+
+def analyze_keyword(app, keyword, refresh=False):
     """
     分析站点级别的关键字, 获取其百度指数以及其相关的长尾关键字.
     目前是从5118抓取.
     """
     app.logger.info('Try to analyze keyword %s/%s' % (keyword._id, keyword.name))
 
-    ss.headers['Referer'] = 'http://www.5118.com/'
-    t = ss.get('http://www.5118.com/seo/words/%s' % url_quote(keyword.name)).text
-    tree = html.fromstring(t)
-    dls = tree.xpath('//div[@class="Fn-ui-list dig-list"]/dl')
-    total = len(dls)
-    for dl in dls:
-        if dl.get('class', '') == 'dl-word':
-            continue
-        name = unicode(dl.xpath('./dd[1]//a[1]/@title')[0].strip())
-        baidu_index = dl.xpath('./dd[2]/text()')[0].strip()
-        baidu_result = dl.xpath('./dd[3]/text()')[0].strip()
-        if not baidu_index.isdigit():
-            baidu_index = 0
-        if not baidu_result.isdigit():
-            baidu_result = 0
+    # 相同关键字的结果页在缓存有效期内不会重复抓取, 手动刷新时除外
+    t = http.fetch_text('http://www.5118.com/seo/words/%s' % url_quote(keyword.name),
+                        headers={'Referer': 'http://www.5118.com/'}, cache=not refresh)
+    rows = parse_5118_keywords(t)
+    for name, baidu_index, baidu_result in rows:
         app.logger.info('Found keyword: %s/%s/%s' % (name, baidu_index, baidu_result))
 
         if name == keyword.name:
-            keyword.baiduIndex = int(baidu_index)
-            keyword.baiduResult = int(baidu_result)
-            if total > 2:
-                keyword.total = total - 2
-            keyword.save()
+            result = Keyword.update_one({'_id': keyword._id},
+                                        {'$set': {'baiduIndex': baidu_index, 'baiduResult': baidu_result}},
+                                        validate=True)
+            if not result.matched_count:
+                app.logger.warning('Keyword %s has been deleted during analyzing' % keyword._id)
+                return
         else:
             long_tail = Keyword.find_one({'name': name})
             if not long_tail:
@@ -218,6 +226,8 @@ def analyze_keyword(app, keyword):
                 long_tail.level = KeywordLevel.LONG_TAIL
                 long_tail.parentId = keyword._id
 
-            long_tail.baiduIndex = int(baidu_index)
-            long_tail.baiduResult = int(baidu_result)
-            long_tail.save()
+            def apply(k):
+                k.baiduIndex = baidu_index
+                k.baiduResult = baidu_result
+
+            long_tail.save_with_retry(apply)
@@ -18,6 +18,8 @@ env.password = ''
 env.hosts = ['']
 # www folder
 project_folder = '/appl/projects/fb/www'
+# 后台任务worker的线程数
+worker_concurrency = 2
 
 
 def deploy():
@@ -39,8 +41,36 @@ def deploy():
             # run('killall -9 gunicorn')
             # run('gunicorn wsgi:app -p wsgi.pid -b 0.0.0.0:6060 -D --log-file app/logs/gunicorn.log')
             run('kill -HUP `cat wsgi.pid`')
+            # 后台任务由独立的worker进程执行, 也需要重启才能加载新代码
+            wrestart()
 
 
 def ustart():
     with cd(project_folder):
         run('gunicorn wsgi:app -p wsgi.pid -b 0.0.0.0:6060 --log-file app/logs/gunicorn.log')
+
+
+def wstart():
+    """
+    启动执行后台任务(如seo.analyze_keyword)的worker进程, 已经启动时不做任何操作.
+    """
+    with cd(project_folder):
+        if run('test -f worker.pid && kill -0 `cat worker.pid`', warn_only=True).succeeded:
+            print('- worker已经启动')
+            return
+        run('nohup python manage.py worker -c %s -p worker.pid >> app/logs/worker.log 2>&1 &' % worker_concurrency,
+            pty=False)
+
+
+def wstop():
+    """
+    停止worker进程, worker收到SIGTERM后执行完当前的任务再退出.
+    """
+    with cd(project_folder):
+        run('if [ -f worker.pid ]; then pid=`cat worker.pid`; kill -TERM $pid; '
+            'while kill -0 $pid 2>/dev/null; do sleep 1; done; fi', warn_only=True)
+
+
+def wrestart():
+    wstop()
+    wstart()
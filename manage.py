@@ -9,9 +9,15 @@
     :date: 16/6/11
 """
 
+import operator
+import os
+
 from flask_script import Server, Shell, Manager
 
 from app import create_app
+from app.jobs import run_worker
+from app.extensions import mdb
+from app.models import Post, PostComments
 
 app = create_app()
 manager = Manager(app)
@@ -25,5 +31,71 @@ def _make_context():
 
 manager.add_command('shell', Shell(make_context=_make_context))
 
+
+@manager.option('-j', '--jobs', dest='jobs', default=None, help='Comma separated job names, default to all')
+@manager.option('-c', '--concurrency', dest='concurrency', type=int, default=1, help='Number of worker threads')
+@manager.option('-p', '--pidfile', dest='pidfile', default=None, help='Write the process id into this file')
+def worker(jobs, concurrency, pidfile):
+    """
+    Run durable background jobs, e.g. python manage.py worker -j seo.analyze_keyword -c 2 -p worker.pid
+    """
+    if pidfile:
+        with open(pidfile, 'w') as f:
+            f.write(str(os.getpid()))
+    try:
+        run_worker(app, jobs.split(',') if jobs else None, concurrency)
+    finally:
+        if pidfile and os.path.exists(pidfile):
+            os.remove(pidfile)
+
+
+@manager.command
+def migrate_comments():
+    """
+    Move embedded post comments into post_comments, run before setting BLOG_COMMENT_STORAGE = 'bucket'
+
+    评论合并到已有的分页中, 已经迁移过的评论会被跳过, 博文中只删除本次迁移的评论, 因此可以重复执行.
+    """
+    size = app.config['BLOG_COMMENT_PAGE_SIZE']
+
+    def migrate(posts):
+        migrated = 0
+        for post in posts:
+            pages = {}
+            for c in post['comments']:
+                pages.setdefault(c['id'] // size, []).append(c)
+            for page, comments in pages.iteritems():
+                filter = {'postId': post._id, 'page': page}
+                existing = PostComments.find_one(filter, {'comments.id': True})
+                ids = set(c['id'] for c in existing['comments']) if existing else set()
+                comments = [c for c in comments if c['id'] not in ids]
+                if comments:
+                    # 页内新评论在前
+                    PostComments.update_one(filter, {'$push': {'comments': {'$each': comments, '$sort': {'id': -1}}},
+                                                     '$inc': {'size': len(comments)}}, upsert=True)
+            ids = [c['id'] for c in post['comments']]
+            # 迁移期间新增的评论保留在博文中, 计数器已经更大时保持不变
+            Post.update_one({'_id': post._id}, {'$max': {'commentCount': max(ids) + 1},
+                                                '$pull': {'comments': {'id': {'$in': ids}}}})
+            print 'Post %s: %s comments are moved into %s pages' % (post._id, len(post['comments']), len(pages))
+            migrated += 1
+        return migrated
+
+    total = Post.parallel_scan(4, migrate, reducer=operator.add, filter={'comments.0': {'$exists': True}},
+                               projection={'comments': True})
+    print 'Successfully migrate comments of %s posts' % total
+
+
+@manager.command
+def repair_counters():
+    """
+    Recompute all counter caches with aggregation, e.g. Keyword.processed/total
+    """
+    for m in mdb.registered_models:
+        if m.counter_caches:
+            m.repair_counters()
+            print 'Counters of %s are repaired' % m.__name__
+
+
 if __name__ == '__main__':
     manager.run()